@@ -1,4 +1,5 @@
 import bpy
+import numpy as np
 from mathutils import Vector
 from mathutils.geometry import area_tri, delaunay_2d_cdt
 from numpy.random import default_rng
@@ -6,6 +7,8 @@ from numpy.random import default_rng
 import bmesh
 from bmesh.types import BMEdge, BMesh, BMVert
 
+from ..timer import span
+
 RNG = default_rng(12345)
 
 
@@ -29,23 +32,123 @@ def sample_tri_rand_desnity(a, b, c, density):
     yield from sample_tri_randn(a, b, c, n)
 
 
+def tris_area_2d(tris: np.ndarray):
+    """Areas of (F, 3, 2) array of 2D triangles"""
+    ab = tris[:, 0] - tris[:, 2]
+    cb = tris[:, 1] - tris[:, 2]
+    return 0.5 * np.abs(ab[:, 0] * cb[:, 1] - ab[:, 1] * cb[:, 0])
+
+
+def sample_tris_density(tris: np.ndarray, density: float, rng=RNG):
+    """Vectorized sample_tri_rand_desnity for all triangles of a (F, 3, D) array at once,
+    returns (M, D) points"""
+    counts = (density * tris_area_2d(tris[:, :, :2])).astype(np.int64)
+    face_index = np.repeat(np.arange(len(tris)), counts)
+    u, v = rng.random((2, len(face_index), 1))
+    flip = (u + v) > 1
+    u = np.where(flip, 1 - u, u)
+    v = np.where(flip, 1 - v, v)
+    a, b, c = tris[face_index, 0], tris[face_index, 1], tris[face_index, 2]
+    return c + u * (a - c) + v * (b - c)
+
+
+def _close_pairs(points: np.ndarray, radius: float):
+    """All (earlier, later) index pairs of points closer than radius, found with a grid of cell size
+    radius / sqrt(2), where only cells up to two steps away can hold close points"""
+    cell_size = radius / np.sqrt(2)
+    cells = np.floor((points - points.min(axis=0)) / cell_size).astype(np.int64)
+    num_rows = cells[:, 1].max() + 5
+    keys = cells[:, 0] * num_rows + cells[:, 1]
+    # Work in key order so neighbor lookups are monotone, indices are mapped back at the end
+    key_order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[key_order]
+    sorted_points = points[key_order]
+
+    radius_sq = radius * radius
+    earlier, later = [], []
+    # Each pair of distinct cells is visited from one side only, pairs inside a cell once per direction
+    for dx in range(0, 3):
+        for dy in range(-2, 3):
+            if (dx, dy) < (0, 0):
+                continue
+            neighbor_keys = sorted_keys + dx * num_rows + dy
+            lo = np.searchsorted(sorted_keys, neighbor_keys, side="left")
+            counts = np.searchsorted(sorted_keys, neighbor_keys, side="right") - lo
+            i = np.repeat(np.arange(len(points)), counts)
+            offsets = np.cumsum(counts) - counts
+            j = np.repeat(lo - offsets, counts) + np.arange(counts.sum())
+            close = ((sorted_points[i] - sorted_points[j]) ** 2).sum(axis=1) < radius_sq
+            if (dx, dy) == (0, 0):
+                close &= i < j
+            i, j = key_order[i[close]], key_order[j[close]]
+            earlier.append(np.minimum(i, j))
+            later.append(np.maximum(i, j))
+    return np.concatenate(earlier), np.concatenate(later)
+
+
+def _poisson_disk_filter(points: np.ndarray, radius: float):
+    """Greedily keep points (in given order) that are at least radius apart from earlier kept points,
+    same result as checking the points one by one, conflicts are resolved in rounds over all close pairs:
+    a point is removed once an earlier neighbor is kept and kept once all earlier neighbors are removed"""
+    earlier, later = _close_pairs(points, radius)
+
+    undecided, kept, removed = 0, 1, 2
+    state = np.zeros(len(points), dtype=np.int8)
+    while True:
+        # Pairs whose later point is decided can't change anything anymore
+        open_pairs = state[later] == undecided
+        earlier, later = earlier[open_pairs], later[open_pairs]
+        state[later[state[earlier] == kept]] = removed
+
+        waiting = np.zeros(len(points), dtype=bool)
+        waiting[later[state[earlier] == undecided]] = True
+        # The first undecided point never waits, so every round decides at least one point
+        ready = (state == undecided) & ~waiting
+        if not ready.any():
+            break
+        state[ready] = kept
+
+    return points[state == kept]
+
+
+def sample_tris_poisson_disk(tris: np.ndarray, radius: float, rng=RNG, oversampling: float = 4.0):
+    """Blue noise (Poisson-disk) samples over (F, 3, 2) array of 2D triangles,
+    points are at least radius apart, dart throwing over oversampled uniform candidates"""
+    candidates = sample_tris_density(tris, oversampling / (radius * radius), rng)
+    if len(candidates) == 0:
+        return candidates
+    return _poisson_disk_filter(candidates, radius)
+
+
 def project_point_to_plane(point_co, plane_co, plane_normal):
     return point_co - (point_co - plane_co).dot(plane_normal) * plane_normal
 
 
-def bisect_fill(bm: BMesh, plane_co: Vector, plane_normal: Vector):
+def bisect_fill(
+    bm: BMesh,
+    plane_co: Vector,
+    plane_normal: Vector,
+    density: float = 10,
+    cap_sampling: str = "UNIFORM",
+    poisson_radius: float = None,
+):
+    """Cut mesh with a plane and fill the cut with a triangulated cap, extra cap points are sampled
+    uniformly with density (points per area unit) or as blue noise ("POISSON") with minimum distance
+    poisson_radius (defaults to 1 / sqrt(density)) which needs far fewer points for the same quality"""
+    assert cap_sampling in {"UNIFORM", "POISSON"}
     plane_co = Vector(plane_co)
     plane_normal = Vector(plane_normal).normalized()
-    geom_cut = bmesh.ops.bisect_plane(
-        bm,
-        geom=bm.faces[:] + bm.edges[:] + bm.verts[:],
-        dist=0.0001,
-        plane_co=plane_co,
-        plane_no=plane_normal,
-        use_snap_center=False,
-        clear_outer=True,
-        clear_inner=False,
-    ).get("geom_cut", None)
+    with span("bisect_fill.bisect_plane"):
+        geom_cut = bmesh.ops.bisect_plane(
+            bm,
+            geom=bm.faces[:] + bm.edges[:] + bm.verts[:],
+            dist=0.0001,
+            plane_co=plane_co,
+            plane_no=plane_normal,
+            use_snap_center=False,
+            clear_outer=True,
+            clear_inner=False,
+        ).get("geom_cut", None)
 
     if geom_cut is None:
         return
@@ -69,42 +172,45 @@ def bisect_fill(bm: BMesh, plane_co: Vector, plane_normal: Vector):
 
     delauny_input_verts_co = [(rot_mat @ v.co).to_2d() for v in delauny_verts_input]
 
-    (
-        delauny_verts_co,
-        delauny_edges,
-        delauny_faces,
-        delauny_orig_verts,
-        delauny_orig_edges,
-        delauny_orig_faces,
-    ) = delaunay_2d_cdt(
-        delauny_input_verts_co,
-        delauny_edges_input,
-        [],
-        1,
-        0.00001,
-    )
-
-    extra_delauny_input_points = []
-    for df in delauny_faces:
-        v0 = delauny_verts_co[df[0]]
-        v1 = delauny_verts_co[df[1]]
-        v2 = delauny_verts_co[df[2]]
-        extra_delauny_input_points.extend(co for co in sample_tri_rand_desnity(v0, v1, v2, 10))
-
-    (
-        delauny_verts_co,
-        delauny_edges,
-        delauny_faces,
-        delauny_orig_verts,
-        delauny_orig_edges,
-        delauny_orig_faces,
-    ) = delaunay_2d_cdt(
-        delauny_input_verts_co + extra_delauny_input_points,
-        delauny_edges_input,
-        [],
-        1,
-        0.00001,
-    )
+    with span("bisect_fill.delaunay"):
+        (
+            delauny_verts_co,
+            delauny_edges,
+            delauny_faces,
+            delauny_orig_verts,
+            delauny_orig_edges,
+            delauny_orig_faces,
+        ) = delaunay_2d_cdt(
+            delauny_input_verts_co,
+            delauny_edges_input,
+            [],
+            1,
+            0.00001,
+        )
+
+    with span("bisect_fill.sample_cap_points"):
+        tris = np.array(delauny_verts_co, dtype=np.float64)[np.array(delauny_faces, dtype=np.int64).reshape(-1, 3)]
+        if cap_sampling == "POISSON":
+            radius = poisson_radius if poisson_radius is not None else 1 / np.sqrt(density)
+            extra_delauny_input_points = sample_tris_poisson_disk(tris, radius).tolist()
+        else:
+            extra_delauny_input_points = sample_tris_density(tris, density).tolist()
+
+    with span("bisect_fill.delaunay_steiner"):
+        (
+            delauny_verts_co,
+            delauny_edges,
+            delauny_faces,
+            delauny_orig_verts,
+            delauny_orig_edges,
+            delauny_orig_faces,
+        ) = delaunay_2d_cdt(
+            delauny_input_verts_co + extra_delauny_input_points,
+            delauny_edges_input,
+            [],
+            1,
+            0.00001,
+        )
 
     delauny_verts_bm_out = [
         bm.verts.new(project_point_to_plane(rot_mat_inv @ co.to_3d(), plane_co, plane_normal))
@@ -125,10 +231,11 @@ def bisect_fill(bm: BMesh, plane_co: Vector, plane_normal: Vector):
         else:
             boundary_verts.append(v)
 
-    for _ in range(10):
-        bmesh.ops.smooth_vert(
-            bm, verts=verts_to_be_smoothed, factor=1, use_axis_x=True, use_axis_y=True, use_axis_z=True
-        )
+    with span("bisect_fill.smooth"):
+        for _ in range(10):
+            bmesh.ops.smooth_vert(
+                bm, verts=verts_to_be_smoothed, factor=1, use_axis_x=True, use_axis_y=True, use_axis_z=True
+            )
 
     bmesh.ops.remove_doubles(bm, verts=delauny_verts_input + boundary_verts, dist=0.0001)
 
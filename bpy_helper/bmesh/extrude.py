@@ -1,10 +1,23 @@
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Set
 
+import bpy
+import numpy as np
 from mathutils import Vector
 
 import bmesh
 from bmesh.types import BMEdge, BMesh, BMFace, BMVert
 
+from ..mesh import (
+    mesh_has_deform_data,
+    mesh_read_attributes,
+    mesh_read_geometry,
+    mesh_set_geometry,
+    mesh_write_attributes,
+    subset_attributes,
+)
+from ..timer import span
+from .loose_parts import connected_components
+
 
 def _bm_creat_edge_unique(bm: BMesh, v0: BMVert, v1: BMVert):
     e: BMEdge
@@ -37,44 +50,49 @@ def bm_extrude_faces_move(
     wavefront_faces: List[BMFace] = []
     side_edge_ring: Set[BMEdge] = set()
     vert_map: Dict[BMVert, BMVert] = dict()  # Maps verts to extruded verts
+    shape_layers = list(bm.verts.layers.shape.values())
 
-    for f in faces_to_be_extruded:
-        new_verts = [None] * len(f.verts)
-        for i, v in enumerate(f.verts):
-            if not v.tag:
-                new_vert = bm.verts.new(v.co + translation)
-                vert_map[v] = new_vert
-                v.tag = True
-            else:
-                new_vert = vert_map[v]
-            new_verts[i] = new_vert
-
-        # Extrude extrusion faces edge boundary
-        for e in f.edges:
-            if e.tag:
-                continue
-            # TODO: support edges with more than two linked faces
-            is_extrusion_boundary = len([f for f in e.link_faces if f.tag]) == 1
-            if not is_extrusion_boundary:
-                continue
+    with span("extrude_faces_move"):
+        for f in faces_to_be_extruded:
+            new_verts = [None] * len(f.verts)
+            for i, v in enumerate(f.verts):
+                if not v.tag:
+                    # Example vert copies custom data (deform weights, shape keys), shape keys move along
+                    new_vert = bm.verts.new(v.co + translation, v)
+                    for layer in shape_layers:
+                        new_vert[layer] = v[layer] + translation
+                    vert_map[v] = new_vert
+                    v.tag = True
+                else:
+                    new_vert = vert_map[v]
+                new_verts[i] = new_vert
 
-            v0 = e.verts[0]
-            v1 = e.verts[1]
-            nv0 = vert_map[v0]
-            nv1 = vert_map[v1]
+            # Extrude extrusion faces edge boundary
+            for e in f.edges:
+                if e.tag:
+                    continue
+                # TODO: support edges with more than two linked faces
+                is_extrusion_boundary = len([f for f in e.link_faces if f.tag]) == 1
+                if not is_extrusion_boundary:
+                    continue
 
-            se0 = _bm_creat_edge_unique(bm, v0, nv0)
-            se1 = _bm_creat_edge_unique(bm, v1, nv1)
-            side_edge_ring.update((se0, se1))
+                v0 = e.verts[0]
+                v1 = e.verts[1]
+                nv0 = vert_map[v0]
+                nv1 = vert_map[v1]
 
-            bm.faces.new((v1, v0, nv0, nv1))
-            e.tag = True
+                se0 = _bm_creat_edge_unique(bm, v0, nv0)
+                se1 = _bm_creat_edge_unique(bm, v1, nv1)
+                side_edge_ring.update((se0, se1))
 
-        new_face = bm.faces.new(new_verts)
-        wavefront_faces.append(new_face)
+                bm.faces.new((v1, v0, nv0, nv1), f)
+                e.tag = True
 
-    if delete_input_faces:
-        bmesh.ops.delete(bm, geom=faces_to_be_extruded, context="FACES")
+            new_face = bm.faces.new(new_verts, f)
+            wavefront_faces.append(new_face)
+
+        if delete_input_faces:
+            bmesh.ops.delete(bm, geom=faces_to_be_extruded, context="FACES")
 
     return wavefront_faces, side_edge_ring
 
@@ -83,4 +101,250 @@ def bm_extrude_faces_move_steps(
     bm: BMesh, faces_to_be_extruded: List[BMFace], translation: Vector, num_steps: int, delete_input_faces: bool = True
 ):
     _, side_edge_ring = bm_extrude_faces_move(bm, faces_to_be_extruded, translation, delete_input_faces)
-    bmesh.ops.subdivide_edgering(bm, edges=list(side_edge_ring), interp_mode="LINEAR", smooth=0.0, cuts=num_steps)
+    with span("extrude_faces_move.subdivide_edgering"):
+        bmesh.ops.subdivide_edgering(bm, edges=list(side_edge_ring), interp_mode="LINEAR", smooth=0.0, cuts=num_steps)
+
+
+def face_regions(faces_loop_total: np.ndarray, loops_edge: np.ndarray):
+    """Label faces connected through shared edges, loops must be in face order,
+    returns (number of regions, per-face region labels)"""
+    face_of_loop = np.repeat(np.arange(len(faces_loop_total)), faces_loop_total)
+    order = np.argsort(loops_edge, kind="stable")
+    sorted_edges = loops_edge[order]
+    # Consecutive loops on the same edge link their faces
+    same_edge = sorted_edges[1:] == sorted_edges[:-1]
+    links = np.stack((face_of_loop[order[:-1]][same_edge], face_of_loop[order[1:]][same_edge]), axis=1)
+    return connected_components(len(faces_loop_total), links)
+
+
+def extrude_faces_move_arrays(
+    geometry,
+    face_indices: np.ndarray,
+    translations: np.ndarray,
+    region_labels: Optional[np.ndarray] = None,
+    delete_input_faces: bool = True,
+):
+    """Array version of bm_extrude_faces_move working on geometry arrays (same layout as mesh_read_geometry),
+    faces are extruded per region (faces connected through edges unless region_labels are given),
+    translations is a single vector or one vector per region, vertices shared by regions are split.
+    Returns (new geometry arrays, (vert_src, edge_src, face_src, loop_src), wavefront_faces, side_edge_ring),
+    src arrays map new elements to the elements they were copied from (-1 for side edges)"""
+    verts_co, edges_verts, faces_loop_start, faces_loop_total, loops_vert, loops_edge = geometry
+    num_verts, num_edges, num_faces = len(verts_co), len(edges_verts), len(faces_loop_start)
+    face_indices = np.asarray(face_indices, dtype=np.int64)
+    num_sel = len(face_indices)
+
+    with span("extrude_faces_move_arrays.boundary"):
+        # Loops of selected faces, next_loop is the following corner of the same face
+        sel_totals = faces_loop_total[face_indices].astype(np.int64)
+        sel_start = np.zeros(num_sel, dtype=np.int64)
+        np.cumsum(sel_totals[:-1], out=sel_start[1:])
+        num_sel_loops = int(sel_totals.sum())
+        loop_face = np.repeat(np.arange(num_sel), sel_totals)
+        local = np.arange(num_sel_loops) - sel_start[loop_face]
+        sel_loops = faces_loop_start[face_indices][loop_face] + local
+        next_local = np.where(local == sel_totals[loop_face] - 1, 0, local + 1)
+        next_loop = sel_start[loop_face] + next_local
+        loop_v = loops_vert[sel_loops].astype(np.int64)
+        loop_e = loops_edge[sel_loops].astype(np.int64)
+
+        if region_labels is None:
+            num_regions, region_labels = face_regions(sel_totals, loop_e)
+        else:
+            region_labels = np.asarray(region_labels, dtype=np.int64)
+            assert len(region_labels) == num_sel
+            num_regions = int(region_labels.max()) + 1 if num_sel else 0
+
+        translations = np.asarray(translations, dtype=np.float64)
+        if translations.ndim == 1:
+            translations = np.broadcast_to(translations, (num_regions, 3))
+        assert translations.shape == (num_regions, 3)
+
+        loop_region = region_labels[loop_face]
+
+        # One new vertex per (region, vertex) and one wavefront edge per (region, edge)
+        new_vert_keys, loop_new_vert = np.unique(loop_region * num_verts + loop_v, return_inverse=True)
+        new_edge_keys, first_loop, loop_new_edge, edge_uses = np.unique(
+            loop_region * num_edges + loop_e, return_index=True, return_inverse=True, return_counts=True
+        )
+        loop_new_vert = loop_new_vert.ravel()
+        loop_new_edge = loop_new_edge.ravel()
+        num_new_verts, num_new_edges = len(new_vert_keys), len(new_edge_keys)
+
+        # Edges used by a single face of a region are on the boundary of that region
+        boundary_loops = np.flatnonzero(edge_uses[loop_new_edge] == 1)
+        boundary_next = next_loop[boundary_loops]
+
+        side_new_verts = np.unique(
+            np.concatenate((loop_new_vert[boundary_loops], loop_new_vert[boundary_next]))
+        )
+        side_edge_of_new_vert = np.full(num_new_verts, -1, dtype=np.int64)
+        side_edge_of_new_vert[side_new_verts] = np.arange(len(side_new_verts))
+
+    with span("extrude_faces_move_arrays.delete"):
+        vert_keep = np.ones(num_verts, dtype=bool)
+        edge_keep = np.ones(num_edges, dtype=bool)
+        face_keep = np.ones(num_faces, dtype=bool)
+        if delete_input_faces:
+            face_keep[face_indices] = False
+            edge_used_sel = np.bincount(loop_e, minlength=num_edges) > 0
+            edge_used_kept = np.bincount(loops_edge, weights=np.repeat(face_keep, faces_loop_total), minlength=num_edges)
+            edge_boundary = np.zeros(num_edges, dtype=bool)
+            edge_boundary[loop_e[boundary_loops]] = True
+            edge_keep = ~edge_used_sel | (edge_used_kept > 0) | edge_boundary
+            vert_used_sel = np.zeros(num_verts, dtype=bool)
+            vert_used_sel[loop_v] = True
+            vert_in_edge = np.zeros(num_verts, dtype=bool)
+            vert_in_edge[edges_verts[edge_keep].ravel()] = True
+            vert_keep = ~vert_used_sel | vert_in_edge
+
+        kept_verts = np.flatnonzero(vert_keep)
+        kept_edges = np.flatnonzero(edge_keep)
+        kept_faces = np.flatnonzero(face_keep)
+        vert_new_index = np.full(num_verts, -1, dtype=np.int64)
+        vert_new_index[kept_verts] = np.arange(len(kept_verts))
+        edge_new_index = np.full(num_edges, -1, dtype=np.int64)
+        edge_new_index[kept_edges] = np.arange(len(kept_edges))
+
+    with span("extrude_faces_move_arrays.build"):
+        new_vert_base = len(kept_verts)
+        top_edge_base = len(kept_edges)
+        side_edge_base = top_edge_base + num_new_edges
+        wavefront_base = len(kept_faces)
+        side_face_base = wavefront_base + num_sel
+
+        new_vert_src = new_vert_keys % num_verts
+        new_vert_region = new_vert_keys // num_verts
+        new_verts_co = verts_co[new_vert_src] + translations[new_vert_region]
+
+        top_edges_verts = np.stack((loop_new_vert[first_loop], loop_new_vert[next_loop[first_loop]]), axis=1)
+        side_vert_src = new_vert_src[side_new_verts]
+        side_edges_verts = np.stack((vert_new_index[side_vert_src], side_new_verts + new_vert_base), axis=1)
+
+        # Kept faces loops keep their order
+        kept_totals = faces_loop_total[kept_faces].astype(np.int64)
+        kept_start = np.zeros(len(kept_faces), dtype=np.int64)
+        np.cumsum(kept_totals[:-1], out=kept_start[1:])
+        kept_loops = np.repeat(faces_loop_start[kept_faces] - kept_start, kept_totals) + np.arange(kept_totals.sum())
+
+        # Side quads (a, b, b', a') for a boundary corner a -> b, winding follows the extruded face
+        a = loop_new_vert[boundary_loops]
+        b = loop_new_vert[boundary_next]
+        side_loops_vert = np.stack(
+            (
+                vert_new_index[loop_v[boundary_loops]],
+                vert_new_index[loop_v[boundary_next]],
+                b + new_vert_base,
+                a + new_vert_base,
+            ),
+            axis=1,
+        )
+        side_loops_edge = np.stack(
+            (
+                edge_new_index[loop_e[boundary_loops]],
+                side_edge_of_new_vert[b] + side_edge_base,
+                loop_new_edge[boundary_loops] + top_edge_base,
+                side_edge_of_new_vert[a] + side_edge_base,
+            ),
+            axis=1,
+        )
+        side_loops_src = np.stack(
+            (sel_loops[boundary_loops], sel_loops[boundary_next], sel_loops[boundary_next], sel_loops[boundary_loops]),
+            axis=1,
+        )
+
+        num_side = len(boundary_loops)
+        out_loops_vert = np.concatenate(
+            (vert_new_index[loops_vert[kept_loops]], loop_new_vert + new_vert_base, side_loops_vert.ravel())
+        )
+        out_loops_edge = np.concatenate(
+            (edge_new_index[loops_edge[kept_loops]], loop_new_edge + top_edge_base, side_loops_edge.ravel())
+        )
+        out_totals = np.concatenate((kept_totals, sel_totals, np.full(num_side, 4, dtype=np.int64)))
+        out_loop_start = np.zeros(len(out_totals), dtype=np.int64)
+        np.cumsum(out_totals[:-1], out=out_loop_start[1:])
+
+        new_geometry = (
+            np.concatenate((verts_co[kept_verts], new_verts_co.astype(verts_co.dtype))),
+            np.concatenate(
+                (vert_new_index[edges_verts[kept_edges]], top_edges_verts + new_vert_base, side_edges_verts)
+            ).astype(np.int32),
+            out_loop_start.astype(np.int32),
+            out_totals.astype(np.int32),
+            out_loops_vert.astype(np.int32),
+            out_loops_edge.astype(np.int32),
+        )
+        src = (
+            np.concatenate((kept_verts, new_vert_src)),
+            np.concatenate((kept_edges, new_edge_keys % num_edges, np.full(len(side_new_verts), -1))),
+            np.concatenate((kept_faces, face_indices, face_indices[loop_face[boundary_loops]])),
+            np.concatenate((kept_loops, sel_loops, side_loops_src.ravel())),
+        )
+
+    wavefront_faces = np.arange(wavefront_base, side_face_base)
+    side_edge_ring = np.arange(side_edge_base, side_edge_base + len(side_new_verts))
+    return new_geometry, src, wavefront_faces, side_edge_ring
+
+
+def _mesh_extrude_faces_move_bmesh(mesh, face_indices, translations, region_labels, delete_input_faces):
+    """bm_extrude_faces_move per region in a BMesh round trip, which keeps shape keys and vertex group weights"""
+    _, _, faces_loop_start, faces_loop_total, _, loops_edge = mesh_read_geometry(mesh)
+    if region_labels is None:
+        sel_totals = faces_loop_total[face_indices].astype(np.int64)
+        sel_start = np.zeros(len(face_indices), dtype=np.int64)
+        np.cumsum(sel_totals[:-1], out=sel_start[1:])
+        sel_loops = np.repeat(faces_loop_start[face_indices] - sel_start, sel_totals) + np.arange(sel_totals.sum())
+        num_regions, region_labels = face_regions(sel_totals, loops_edge[sel_loops])
+    else:
+        region_labels = np.asarray(region_labels, dtype=np.int64)
+        assert len(region_labels) == len(face_indices)
+        num_regions = int(region_labels.max()) + 1 if len(face_indices) else 0
+    translations = np.asarray(translations, dtype=np.float64)
+    if translations.ndim == 1:
+        translations = np.broadcast_to(translations, (num_regions, 3))
+    assert translations.shape == (num_regions, 3)
+
+    bm = bmesh.new()
+    bm.from_mesh(mesh)
+    bm.faces.ensure_lookup_table()
+    faces = [bm.faces[i] for i in face_indices.tolist()]
+    wavefront_faces: List[BMFace] = []
+    side_edge_ring: List[BMEdge] = []
+    for region in range(num_regions):
+        region_faces = [faces[i] for i in np.flatnonzero(region_labels == region).tolist()]
+        region_wavefront, region_ring = bm_extrude_faces_move(
+            bm, region_faces, Vector(translations[region]), delete_input_faces
+        )
+        wavefront_faces.extend(region_wavefront)
+        side_edge_ring.extend(region_ring)
+    bm.edges.index_update()
+    bm.faces.index_update()
+    wavefront_indices = np.array([f.index for f in wavefront_faces], dtype=np.int64)
+    side_edge_indices = np.array([e.index for e in side_edge_ring], dtype=np.int64)
+    bm.to_mesh(mesh)
+    mesh.update()
+    bm.free()
+    return wavefront_indices, side_edge_indices
+
+
+def mesh_extrude_faces_move(
+    mesh: bpy.types.Mesh,
+    face_indices: np.ndarray,
+    translations: np.ndarray,
+    region_labels: Optional[np.ndarray] = None,
+    delete_input_faces: bool = True,
+):
+    """extrude_faces_move_arrays applied to a mesh, attributes and hide/select state of new elements are copied
+    from their source elements, returns wavefront face indices and side edge ring indices in the new mesh.
+    Meshes with shape keys or vertex groups go through a BMesh instead, which keeps those"""
+    face_indices = np.asarray(face_indices, dtype=np.int64)
+    if mesh_has_deform_data(mesh):
+        return _mesh_extrude_faces_move_bmesh(mesh, face_indices, translations, region_labels, delete_input_faces)
+
+    attributes = mesh_read_attributes(mesh, include_state=True)
+    new_geometry, src, wavefront_faces, side_edge_ring = extrude_faces_move_arrays(
+        mesh_read_geometry(mesh), face_indices, translations, region_labels, delete_input_faces
+    )
+    mesh_set_geometry(mesh, *new_geometry)
+    mesh_write_attributes(mesh, subset_attributes(attributes, *src))
+    return wavefront_faces, side_edge_ring
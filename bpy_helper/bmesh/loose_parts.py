@@ -1,119 +1,417 @@
-from typing import Callable, List
+from typing import Callable, List, Optional
 
+import bpy
 import numpy as np
 from mathutils import Vector
 
 import bmesh
 
-from .common import bmesh_to_object
+from ..mesh import MeshArrays, calc_faces_area_vector, group_by_labels, mesh_read_geometry, mesh_set_geometry
+from ..timer import span
 
 
-class BMRegion:
-    """Warning: this does not validate the BMesh, nor that the passed geometry belongs to same BMesh"""
+def connected_components(num_verts: int, edges_verts: np.ndarray):
+    """Label connected components of a graph given as (N, 2) array of vertex index pairs,
+    returns number of components and per-vertex label array,
+    components are numbered in order of their lowest vertex index (same order as bm_loose_parts)"""
+    labels = np.arange(num_verts)
+    v0 = edges_verts[:, 0]
+    v1 = edges_verts[:, 1]
+
+    while True:
+        l0 = labels[v0]
+        l1 = labels[v1]
+
+        # Edges whose vertices share a root stay inside one component forever
+        mask = l0 != l1
+        if not mask.any():
+            break
+        v0, v1, l0, l1 = v0[mask], v1[mask], l0[mask], l1[mask]
+
+        # Hook higher root under lower root
+        np.minimum.at(labels, np.maximum(l0, l1), np.minimum(l0, l1))
+
+        # Pointer jumping, until every vertex points to its root
+        while True:
+            next_labels = labels[labels]
+            if np.array_equal(next_labels, labels):
+                break
+            labels = next_labels
+
+    roots, labels = np.unique(labels, return_inverse=True)
+    return len(roots), labels.astype(np.int32)
+
+
+def _min_label_ignore_unlabeled(labels: np.ndarray, starts: np.ndarray):
+    """Minimum non-negative label per segment, -1 if segment has no labeled elements"""
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.int32)
+    big = np.iinfo(np.int32).max
+    seg_min = np.minimum.reduceat(np.where(labels < 0, big, labels), starts)
+    return np.where(seg_min == big, -1, seg_min).astype(np.int32)
+
+
+def label_loose_parts(
+    num_verts: int,
+    edges_verts: np.ndarray,
+    faces_loop_start: np.ndarray,
+    loops_vert: np.ndarray,
+    verts_mask: Optional[np.ndarray] = None,
+    edges_mask: Optional[np.ndarray] = None,
+    faces_mask: Optional[np.ndarray] = None,
+):
+    """Label loose parts from topology arrays, masks select elements included in the search
+    (all elements if None), returns number of parts, per-vertex, per-edge and per-face labels,
+    excluded elements get label -1"""
+    with span("label_loose_parts"):
+        if verts_mask is None:
+            verts_mask = np.ones(num_verts, dtype=bool)
+        if edges_mask is None:
+            edges_mask = np.ones(len(edges_verts), dtype=bool)
+        if faces_mask is None:
+            faces_mask = np.ones(len(faces_loop_start), dtype=bool)
+
+        # Only edges between two included verts connect parts
+        connecting = edges_mask & verts_mask[edges_verts[:, 0]] & verts_mask[edges_verts[:, 1]]
+        _, vert_labels = connected_components(num_verts, edges_verts[connecting])
+
+        # Renumber so only included verts are labeled
+        vert_labels = np.where(verts_mask, vert_labels, -1)
+        roots, included_labels = np.unique(vert_labels[verts_mask], return_inverse=True)
+        vert_labels[verts_mask] = included_labels
+        num_parts = len(roots)
+
+        # Edges and faces belong to the first part (in part order) that reaches any of their verts
+        edge_starts = np.arange(0, 2 * len(edges_verts), 2)
+        edge_labels = _min_label_ignore_unlabeled(vert_labels[edges_verts.ravel()], edge_starts)
+        edge_labels[~edges_mask] = -1
+        face_labels = _min_label_ignore_unlabeled(vert_labels[loops_vert], faces_loop_start)
+        face_labels[~faces_mask] = -1
+
+        return num_parts, vert_labels.astype(np.int32), edge_labels, face_labels
+
+
+def mesh_loose_parts_labels(mesh: bpy.types.Mesh, arrays: Optional[MeshArrays] = None):
+    """Array version of bm_loose_parts that does not build a BMesh,
+    returns number of parts, per-vertex, per-edge and per-face label arrays"""
+    if arrays is None:
+        arrays = MeshArrays(mesh)
+    return label_loose_parts(
+        len(mesh.vertices), arrays.get("edges_verts"), arrays.get("loop_start"), arrays.get("loops_vert")
+    )
+
+
+def _bm_read_geometry(bm: bmesh.types.BMesh):
+    """Same as mesh_read_geometry but for a BMesh, updates element indices"""
+    bm.verts.index_update()
+    bm.edges.index_update()
+    bm.faces.index_update()
+
+    verts_co = np.array([v.co for v in bm.verts], dtype=np.float32).reshape(-1, 3)
+    edges_verts = np.fromiter((v.index for e in bm.edges for v in e.verts), np.int32, len(bm.edges) * 2)
+    edges_verts.shape = -1, 2
+    faces_loop_total = np.fromiter((len(f.verts) for f in bm.faces), np.int32, len(bm.faces))
+    faces_loop_start = np.zeros(len(bm.faces), dtype=np.int32)
+    np.cumsum(faces_loop_total[:-1], out=faces_loop_start[1:])
+    loops_vert = np.fromiter((v.index for f in bm.faces for v in f.verts), np.int32, faces_loop_total.sum())
+    loops_edge = np.fromiter((l.edge.index for f in bm.faces for l in f.loops), np.int32, faces_loop_total.sum())
+
+    return verts_co, edges_verts, faces_loop_start, faces_loop_total, loops_vert, loops_edge
+
+
+class LooseParts:
+    """Loose parts stored as per-element label arrays over the source geometry arrays,
+    statistics for all parts are computed together on first access,
+    BMesh elements are only looked up when a region asks for them"""
+
+    __slots__ = (
+        "num_parts",
+        "vert_labels",
+        "edge_labels",
+        "face_labels",
+        "verts_co",
+        "edges_verts",
+        "faces_loop_start",
+        "faces_loop_total",
+        "loops_vert",
+        "loops_edge",
+        "bm",
+        "_groups",
+        "_stats",
+    )
 
     def __init__(
         self,
-        verts: List[bmesh.types.BMVert],
-        edges: List[bmesh.types.BMEdge],
-        faces: List[bmesh.types.BMFace],
+        num_parts: int,
+        vert_labels: np.ndarray,
+        edge_labels: np.ndarray,
+        face_labels: np.ndarray,
+        geometry,
+        bm: Optional[bmesh.types.BMesh] = None,
     ):
-        self.verts = verts
-        self.edges = edges
-        self.faces = faces
+        self.num_parts = num_parts
+        self.vert_labels = vert_labels
+        self.edge_labels = edge_labels
+        self.face_labels = face_labels
+        (
+            self.verts_co,
+            self.edges_verts,
+            self.faces_loop_start,
+            self.faces_loop_total,
+            self.loops_vert,
+            self.loops_edge,
+        ) = geometry
+        self.bm = bm
+        self._groups = None
+        self._stats = None
 
-        self._bb_min_cached = Vector()
-        self._bb_max_cached = Vector()
+    @classmethod
+    def from_mesh(cls, mesh: bpy.types.Mesh, arrays: Optional[MeshArrays] = None):
+        geometry = mesh_read_geometry(mesh, arrays)
+        verts_co, edges_verts, faces_loop_start, _, loops_vert, _ = geometry
+        labels = label_loose_parts(len(verts_co), edges_verts, faces_loop_start, loops_vert)
+        return cls(*labels, geometry)
 
-    def update_bounding_box(self):
-        co_arr = np.array([v.co for v in self.verts])
-        min_bb = Vector(co_arr.min(axis=0))
-        max_bb = Vector(co_arr.max(axis=0))
+    @classmethod
+    def from_bmesh(cls, bm: bmesh.types.BMesh, verts_mask=None, edges_mask=None, faces_mask=None):
+        geometry = _bm_read_geometry(bm)
+        verts_co, edges_verts, faces_loop_start, _, loops_vert, _ = geometry
+        labels = label_loose_parts(
+            len(verts_co), edges_verts, faces_loop_start, loops_vert, verts_mask, edges_mask, faces_mask
+        )
+        return cls(*labels, geometry, bm)
+
+    @property
+    def geometry(self):
+        """Source geometry arrays, same layout as mesh_read_geometry"""
+        return (
+            self.verts_co,
+            self.edges_verts,
+            self.faces_loop_start,
+            self.faces_loop_total,
+            self.loops_vert,
+            self.loops_edge,
+        )
+
+    def __len__(self):
+        return self.num_parts
+
+    def __getitem__(self, index: int) -> "BMRegion":
+        if isinstance(index, slice):
+            return [BMRegion(self, i) for i in range(*index.indices(self.num_parts))]
+        if index < 0:
+            index += self.num_parts
+        if not 0 <= index < self.num_parts:
+            raise IndexError("loose part index out of range")
+        return BMRegion(self, index)
+
+    def __iter__(self):
+        return (BMRegion(self, i) for i in range(self.num_parts))
+
+    @property
+    def groups(self):
+        """Sorted element order and per-part start offsets, for verts, edges and faces"""
+        if self._groups is None:
+            self._groups = (
+                group_by_labels(self.vert_labels, self.num_parts),
+                group_by_labels(self.edge_labels, self.num_parts),
+                group_by_labels(self.face_labels, self.num_parts),
+            )
+        return self._groups
+
+    def update_statistics(self):
+        """Compute bounding boxes and centroids of all parts in one segmented reduction"""
+        with span("loose_parts_statistics"):
+            self._stats = self._calc_statistics()
+
+    def _calc_statistics(self):
+        (vert_order, vert_starts), _, _ = self.groups
+        co_sorted = self.verts_co[vert_order]
+        starts = vert_starts[:-1]
+        if len(co_sorted) == 0:
+            empty = np.empty((0, 3), dtype=np.float32)
+            return empty, empty, empty
+        bb_min = np.minimum.reduceat(co_sorted, starts, axis=0)
+        bb_max = np.maximum.reduceat(co_sorted, starts, axis=0)
+        centroid = np.add.reduceat(co_sorted.astype(np.float64), starts, axis=0) / self.vert_counts[:, np.newaxis]
+        return bb_min, bb_max, centroid
 
-        self._bb_min_cached = min_bb
-        self._bb_max_cached = max_bb
+    def _get_stats(self):
+        if self._stats is None:
+            self.update_statistics()
+        return self._stats
+
+    @property
+    def bb_min(self) -> np.ndarray:
+        """(num_parts, 3) array, cached"""
+        return self._get_stats()[0]
+
+    @property
+    def bb_max(self) -> np.ndarray:
+        """(num_parts, 3) array, cached"""
+        return self._get_stats()[1]
+
+    @property
+    def bb_mean(self) -> np.ndarray:
+        """(num_parts, 3) array, cached"""
+        return 0.5 * (self.bb_min + self.bb_max)
+
+    @property
+    def centroid(self) -> np.ndarray:
+        """(num_parts, 3) mean of vertex locations per part, cached"""
+        return self._get_stats()[2]
+
+    @property
+    def vert_counts(self) -> np.ndarray:
+        return np.diff(self.groups[0][1])
+
+    @property
+    def edge_counts(self) -> np.ndarray:
+        return np.diff(self.groups[1][1])
+
+    @property
+    def face_counts(self) -> np.ndarray:
+        return np.diff(self.groups[2][1])
+
+    def _faces_area_vector(self):
+        return calc_faces_area_vector(self.verts_co, self.faces_loop_start, self.faces_loop_total, self.loops_vert)
+
+    @property
+    def areas(self) -> np.ndarray:
+        """Surface area of each part"""
+        faces_area = np.linalg.norm(self._faces_area_vector(), axis=1)
+        included = self.face_labels >= 0
+        return np.bincount(self.face_labels[included], weights=faces_area[included], minlength=self.num_parts)
+
+    @property
+    def volumes(self) -> np.ndarray:
+        """Enclosed volume of each part (divergence theorem), only meaningful for closed parts,
+        negative for parts with inward facing normals"""
+        # Cone from the origin to each face: a third of first vertex location dot area vector
+        faces_volume = np.einsum(
+            "ij,ij->i", self.verts_co[self.loops_vert[self.faces_loop_start]], self._faces_area_vector()
+        ) / 3
+        included = self.face_labels >= 0
+        return np.bincount(self.face_labels[included], weights=faces_volume[included], minlength=self.num_parts)
+
+
+class BMRegion:
+    """A single loose part, a view into LooseParts index arrays,
+    Warning: this does not validate the BMesh, nor that the BMesh wasn't modified since parts were labeled"""
+
+    __slots__ = ("parts", "index")
+
+    def __init__(self, parts: LooseParts, index: int):
+        self.parts = parts
+        self.index = index
+
+    def _indices(self, domain: int):
+        order, starts = self.parts.groups[domain]
+        return order[starts[self.index] : starts[self.index + 1]]
+
+    @property
+    def vert_indices(self) -> np.ndarray:
+        return self._indices(0)
+
+    @property
+    def edge_indices(self) -> np.ndarray:
+        return self._indices(1)
+
+    @property
+    def face_indices(self) -> np.ndarray:
+        return self._indices(2)
+
+    def _bm_elems(self, seq, indices):
+        if self.parts.bm is None:
+            raise RuntimeError("Loose parts were not computed from a BMesh")
+        seq.ensure_lookup_table()
+        return [seq[i] for i in indices]
+
+    @property
+    def verts(self):
+        """BMesh vertices of region, looked up on access"""
+        return self._bm_elems(self.parts.bm.verts, self.vert_indices)
+
+    @property
+    def edges(self):
+        """BMesh edges of region, looked up on access"""
+        return self._bm_elems(self.parts.bm.edges, self.edge_indices)
+
+    @property
+    def faces(self):
+        """BMesh faces of region, looked up on access"""
+        return self._bm_elems(self.parts.bm.faces, self.face_indices)
+
+    def update_bounding_box(self):
+        """Statistics are computed for all parts at once, kept for compatibility"""
+        self.parts.update_statistics()
 
     @property
     def bb_max(self):
         """Cached"""
-        return self._bb_max_cached
+        return Vector(self.parts.bb_max[self.index])
 
     @property
     def bb_min(self):
         """Cached"""
-        return self._bb_min_cached
+        return Vector(self.parts.bb_min[self.index])
 
     @property
     def bb_mean(self) -> Vector:
         """Cached"""
         return 0.5 * (self.bb_min + self.bb_max)
 
+    @property
+    def centroid(self) -> Vector:
+        """Cached"""
+        return Vector(self.parts.centroid[self.index])
+
+    def geometry(self):
+        """Geometry arrays of region with vertex indices local to the region,
+        same layout as mesh_read_geometry, edges and faces must not reference verts outside the region"""
+        parts = self.parts
+        vert_indices = self.vert_indices  # sorted, as grouping is stable
+        edge_indices = self.edge_indices
+        face_indices = self.face_indices
+
+        totals = parts.faces_loop_total[face_indices]
+        loop_start = np.zeros(len(face_indices), dtype=np.int32)
+        np.cumsum(totals[:-1], out=loop_start[1:])
+        loop_indices = np.repeat(parts.faces_loop_start[face_indices] - loop_start, totals) + np.arange(totals.sum())
+
+        return (
+            parts.verts_co[vert_indices],
+            np.searchsorted(vert_indices, parts.edges_verts[edge_indices]).astype(np.int32),
+            loop_start,
+            totals,
+            np.searchsorted(vert_indices, parts.loops_vert[loop_indices]).astype(np.int32),
+            np.searchsorted(edge_indices, parts.loops_edge[loop_indices]).astype(np.int32),
+        )
+
     def to_obj(self, name):
-        bm = bmesh.new(use_operators=False)
-        self.to_bmesh(bm)
-        obj = bmesh_to_object(bm, name)
-        bm.free()
+        mesh = bpy.data.meshes.new(name)
+        mesh_set_geometry(mesh, *self.geometry())
+        obj: bpy.types.Object = bpy.data.objects.new(name, mesh)
+        obj.use_fake_user = True
         return obj
 
     def to_bmesh(self, bm: bmesh.types.BMesh):
-        vert_map = dict()
-        for v in self.verts:
-            vert_map[v] = bm.verts.new(v.co)
-
-        for e in self.edges:
-            bm.edges.new((vert_map[e.verts[0]], vert_map[e.verts[1]]))
-
-        for f in self.faces:
-            bm.faces.new([vert_map[v] for v in f.verts])
-
-
-def _bm_grow_tagged(vert: bmesh.types.BMVert):
-    """Flood fill untagged linked geometry starting from a vertex, tags and returns them"""
-    verts = [vert]
-    edges: List[bmesh.types.BMEdge] = []
-    faces: List[bmesh.types.BMFace] = []
-
-    for vert in verts:
-        link_face: bmesh.types.BMFace
-        for link_face in vert.link_faces:
-            if link_face.tag:
-                continue
-            faces.append(link_face)
-            link_face.tag = True
-        link_edge: bmesh.types.BMEdge
-        for link_edge in vert.link_edges:
-            if link_edge.tag:
-                continue
-            link_edge.tag = True
-            edges.append(link_edge)
-            other_vert: bmesh.types.BMVert = link_edge.other_vert(vert)
-            if other_vert.tag:
-                continue
-            verts.append(other_vert)
-            other_vert.tag = True
-
-        vert.tag = True
-
-    # For debugging
-    # assert len(set(verts)) == len(verts)
-    # assert len(set(edges)) == len(edges)
-    # assert len(set(faces)) == len(faces)
-
-    return BMRegion(verts, edges, faces)
-
-
-def _set_bmelem_tags_false_filter(elems, filter_func):
-    """Sets tag for BMesh elements to False if they pass the filter (filter returns True),
-    otherwise set tag to True, if filter is None, all tags are set to False"""
+        verts_co, edges_verts, faces_loop_start, faces_loop_total, loops_vert, _ = self.geometry()
+        new_verts = [bm.verts.new(co) for co in verts_co.tolist()]
+
+        for v0, v1 in edges_verts.tolist():
+            bm.edges.new((new_verts[v0], new_verts[v1]))
+
+        for start, total in zip(faces_loop_start.tolist(), faces_loop_total.tolist()):
+            bm.faces.new([new_verts[i] for i in loops_vert[start : start + total].tolist()])
+
+
+def _filter_mask(elems, filter_func):
+    """Elements that don't pass the filter (filter returns True) are included in the search,
+    if filter is None, all elements are included"""
     if filter_func is None:
-        for e in elems:
-            e.tag = False
-    else:
-        # Defer setting of tags as filter might depend on original tag
-        tag_values = dict()
-        for e in elems:
-            tag_values[e] = False if filter_func(e) else True
-        for e in elems:
-            e.tag = tag_values[e]
+        return None
+    return np.fromiter((not filter_func(e) for e in elems), bool, len(elems))
 
 
 def bm_loose_parts(
@@ -121,25 +419,16 @@ def bm_loose_parts(
     verts_filter: Callable[[bmesh.types.BMVert], bool] = None,
     edges_filter: Callable[[bmesh.types.BMEdge], bool] = None,
     faces_filter: Callable[[bmesh.types.BMFace], bool] = None,
-):
+) -> List[BMRegion]:
+    """Returns list of BMRegions (in order of their first vertex), all sharing one LooseParts (region.parts)
+    for batched statistics, elements that pass a filter (filter returns True) are excluded from the search"""
     assert bm
     assert bm.is_valid
 
-    # Tag all elements as False to be included in the flood fill search,
-    # if filter is not None, tags that pass the filter (filter returns True)
-    # will be set to True so they don't get included in the search
-    _set_bmelem_tags_false_filter(bm.verts, verts_filter)
-    _set_bmelem_tags_false_filter(bm.edges, edges_filter)
-    _set_bmelem_tags_false_filter(bm.faces, faces_filter)
-
-    loose_parts: List[BMRegion] = []
-
-    for seed_vert in bm.verts:
-        if seed_vert.tag:
-            continue
-        # We could yield instead
-        # but tag could be modifed after yield
-        # so better to store results in a list
-        loose_parts.append(_bm_grow_tagged(seed_vert))
-
-    return loose_parts
+    parts = LooseParts.from_bmesh(
+        bm,
+        _filter_mask(bm.verts, verts_filter),
+        _filter_mask(bm.edges, edges_filter),
+        _filter_mask(bm.faces, faces_filter),
+    )
+    return list(parts)
@@ -0,0 +1,42 @@
+"""Process pool worker for minimum_bounding_boxes_points.
+
+Spawned workers run plain Python without bpy, and importing this module through the add-on package would run the
+add-on __init__, which imports bpy. So this file is imported as the top-level module _minimum_box_worker, and it loads
+the Blender-free bounding box modules from the bpy_helper directory under a private package name."""
+
+import importlib
+import importlib.util
+import os
+import sys
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+_PACKAGE = "_minimum_box_worker_bpy_helper"
+
+
+def _minimum_box_module():
+    name = _PACKAGE + ".bounding_box.minimum_box"
+    module = sys.modules.get(name)
+    if module is None:
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        spec = importlib.util.spec_from_file_location(
+            _PACKAGE, os.path.join(package_dir, "__init__.py"), submodule_search_locations=[package_dir]
+        )
+        package = importlib.util.module_from_spec(spec)
+        sys.modules[_PACKAGE] = package
+        spec.loader.exec_module(package)
+        module = importlib.import_module(name)
+    return module
+
+
+def shared_minimum_bounding_box(shm_name: str, total: int, start: int, stop: int):
+    """Reads points from shared memory instead of receiving them pickled"""
+    shm = SharedMemory(name=shm_name)
+    try:
+        shared_points = np.ndarray((total, 3), dtype=np.float32, buffer=shm.buf)
+        points = shared_points[start:stop].astype(np.float64)
+        del shared_points
+        return _minimum_box_module().minimum_bounding_box_points(points)
+    finally:
+        shm.close()
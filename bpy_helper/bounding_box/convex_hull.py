@@ -0,0 +1,178 @@
+import numpy as np
+
+
+def _hull_tolerance(points: np.ndarray):
+    return 10 * points.shape[1] * np.abs(points).max() * np.finfo(np.float64).eps
+
+
+def _face_plane(points: np.ndarray, a: int, b: int, c: int):
+    normal = np.cross(points[b] - points[a], points[c] - points[a])
+    length = np.linalg.norm(normal)
+    if length > 0:
+        normal /= length
+    return normal, normal.dot(points[a])
+
+
+def convex_hull_2d(points_2d: np.ndarray):
+    """Andrew's monotone chain, returns indices of hull vertices in counter-clockwise order"""
+    order = np.lexsort((points_2d[:, 1], points_2d[:, 0]))
+    pts = points_2d[order].tolist()
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    def half(indices):
+        chain = []
+        for i in indices:
+            while len(chain) >= 2 and cross(pts[chain[-2]], pts[chain[-1]], pts[i]) <= 0:
+                chain.pop()
+            chain.append(i)
+        return chain
+
+    lower = half(range(len(pts)))
+    upper = half(reversed(range(len(pts))))
+    return order[lower[:-1] + upper[:-1]]
+
+
+def _convex_hull_planar(points: np.ndarray, normal: np.ndarray):
+    """Hull of coplanar points as a triangle fan with normal pointing along the given plane normal"""
+    u = np.cross(normal, (1.0, 0.0, 0.0))
+    if np.linalg.norm(u) < 0.1:
+        u = np.cross(normal, (0.0, 1.0, 0.0))
+    u /= np.linalg.norm(u)
+    v = np.cross(normal, u)
+
+    ring = convex_hull_2d(np.stack((points.dot(u), points.dot(v)), axis=1))
+    return np.stack((np.full(len(ring) - 2, ring[0]), ring[1:-1], ring[2:]), axis=1)
+
+
+def convex_hull(points: np.ndarray, tolerance: float = None):
+    """Quickhull, returns (M, 3) array of triangle vertex indices into points,
+    winding is counter-clockwise when seen from outside, coplanar points give a single sided triangle fan"""
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 3:
+        raise ValueError("At least 3 points are needed to compute a convex hull")
+    if tolerance is None:
+        tolerance = _hull_tolerance(points)
+
+    # Initial simplex: extremes along longest axis, farthest from their line, farthest from their plane
+    axis = np.ptp(points, axis=0).argmax()
+    i0 = points[:, axis].argmin()
+    i1 = points[:, axis].argmax()
+    line_dir = points[i1] - points[i0]
+    if np.linalg.norm(line_dir) <= tolerance:
+        raise ValueError("Points are degenerate (coincident)")
+    i2 = np.linalg.norm(np.cross(points - points[i0], line_dir), axis=1).argmax()
+    if np.linalg.norm(np.cross(points[i2] - points[i0], line_dir)) <= tolerance * np.linalg.norm(line_dir):
+        raise ValueError("Points are degenerate (collinear)")
+    plane_normal, plane_offset = _face_plane(points, i0, i1, i2)
+    plane_dist = points.dot(plane_normal) - plane_offset
+    i3 = np.abs(plane_dist).argmax()
+    if abs(plane_dist[i3]) <= tolerance:
+        return _convex_hull_planar(points, plane_normal)
+
+    if plane_dist[i3] > 0:
+        # Make i0, i1, i2 face away from i3
+        i1, i2 = i2, i1
+
+    capacity = 64
+    face_verts = np.empty((capacity, 3), dtype=np.int64)
+    face_normals = np.empty((capacity, 3))
+    face_offsets = np.empty(capacity)
+    face_alive = np.zeros(capacity, dtype=bool)
+    num_faces = 0
+    edge_face = dict()  # Directed edge to the face it belongs to
+
+    def add_faces(tris):
+        """Add faces from a list of (a, b, c) vertex index tuples, returns their indices"""
+        nonlocal capacity, face_verts, face_normals, face_offsets, face_alive, num_faces
+        count = len(tris)
+        if num_faces + count > capacity:
+            old_capacity = capacity
+            while num_faces + count > capacity:
+                capacity *= 2
+            face_verts = np.resize(face_verts, (capacity, 3))
+            face_normals = np.resize(face_normals, (capacity, 3))
+            face_offsets = np.resize(face_offsets, capacity)
+            face_alive = np.concatenate((face_alive, np.zeros(capacity - old_capacity, dtype=bool)))
+
+        new_faces = np.arange(num_faces, num_faces + count)
+        tris = np.array(tris, dtype=np.int64).reshape(-1, 3)
+        tri_co = points[tris]
+        normals = np.cross(tri_co[:, 1] - tri_co[:, 0], tri_co[:, 2] - tri_co[:, 0])
+        lengths = np.linalg.norm(normals, axis=1)
+        normals[lengths > 0] /= lengths[lengths > 0, np.newaxis]
+
+        face_verts[new_faces] = tris
+        face_normals[new_faces] = normals
+        face_offsets[new_faces] = (normals * tri_co[:, 0]).sum(axis=1)
+        face_alive[new_faces] = True
+        for f, (a, b, c) in zip(new_faces.tolist(), tris.tolist()):
+            edge_face[(a, b)] = f
+            edge_face[(b, c)] = f
+            edge_face[(c, a)] = f
+        num_faces += count
+        return new_faces
+
+    add_faces(((i0, i1, i2), (i0, i3, i1), (i1, i3, i2), (i2, i3, i0)))
+
+    conflicts = dict()  # Face to (outside point indices, distances), points are assigned to one face
+
+    def assign(point_index: np.ndarray, faces: np.ndarray):
+        """Assign points to the face they are farthest above, points inside all faces are dropped"""
+        dists = points[point_index].dot(face_normals[faces].T) - face_offsets[faces]
+        best = dists.argmax(axis=1)
+        best_dist = dists[np.arange(len(point_index)), best]
+        outside = best_dist > tolerance
+        point_index, best, best_dist = point_index[outside], best[outside], best_dist[outside]
+
+        order = np.argsort(best, kind="stable")
+        splits = np.flatnonzero(np.diff(best[order])) + 1
+        for group in np.split(order, splits):
+            if len(group):
+                conflicts[int(faces[best[group[0]]])] = (point_index[group], best_dist[group])
+
+    assign(np.arange(len(points)), np.arange(4))
+
+    while conflicts:
+        f0, (conflict_index, conflict_dist) = conflicts.popitem()
+        apex = int(conflict_index[conflict_dist.argmax()])
+        apex_co = points[apex]
+
+        # Flood fill visible faces from the face the apex was assigned to, collecting horizon edges
+        visible = {f0}
+        hidden = set()
+        horizon = []
+        stack = [f0]
+        while stack:
+            f = stack.pop()
+            a, b, c = face_verts[f].tolist()
+            for u, v in ((a, b), (b, c), (c, a)):
+                g = edge_face[(v, u)]
+                if g in visible:
+                    continue
+                if g not in hidden:
+                    if face_normals[g].dot(apex_co) - face_offsets[g] > tolerance:
+                        visible.add(g)
+                        stack.append(g)
+                        continue
+                    hidden.add(g)
+                horizon.append((u, v))
+
+        orphans = [conflict_index]
+        for f in visible:
+            face_alive[f] = False
+            if f in conflicts:
+                orphans.append(conflicts.pop(f)[0])
+            a, b, c = face_verts[f].tolist()
+            for edge in ((a, b), (b, c), (c, a)):
+                if edge_face.get(edge) == f:
+                    del edge_face[edge]
+
+        new_faces = add_faces([(u, v, apex) for u, v in horizon])
+
+        # Points that were outside removed faces get reassigned to new faces
+        orphans = np.concatenate(orphans)
+        assign(orphans[orphans != apex], new_faces)
+
+    return face_verts[:num_faces][face_alive[:num_faces]]
@@ -0,0 +1,254 @@
+import importlib.util
+import math
+import multiprocessing
+import os
+import site
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from timeit import default_timer as timer
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+from ..timer import span
+from .convex_hull import _hull_tolerance, convex_hull
+
+
+def rotating_calipers(hull_points: np.ndarray, bases):
+    min_bb_basis = None
+    min_bb_min = None
+    min_bb_max = None
+    min_vol = math.inf
+    for basis in bases:
+        rot_points = hull_points.dot(np.transpose(basis))
+        # Reduced from:
+        # rot_points = hull_points.dot(np.linalg.inv(np.transpose(basis)).T)
+
+        bb_min = rot_points.min(axis=0)
+        bb_max = rot_points.max(axis=0)
+        volume = (bb_max - bb_min).prod()
+        if volume < min_vol:
+            min_bb_basis = basis
+            min_vol = volume
+
+            min_bb_min = bb_min
+            min_bb_max = bb_max
+
+    return np.array(min_bb_basis), min_bb_max, min_bb_min
+
+
+def deduplicate_bases(bases, tolerance: float = 1e-6):
+    """Drop bases spanning the same axes as an earlier basis (up to tolerance and sign of each axis),
+    kept bases stay in their original order and orientation"""
+    bases = np.asarray(bases, dtype=np.float64).reshape(-1, 3, 3)
+    if len(bases) == 0:
+        return bases
+
+    # Flip each axis so that its largest magnitude component is positive, axis sign does not change the box
+    max_component = np.abs(bases).argmax(axis=2)[..., np.newaxis]
+    signs = np.sign(np.take_along_axis(bases, max_component, axis=2))
+    signs[signs == 0] = 1
+    keys = np.round(bases * signs / tolerance).astype(np.int64).reshape(len(bases), 9)
+
+    _, first_index = np.unique(keys, axis=0, return_index=True)
+    return bases[np.sort(first_index)]
+
+
+def rotating_calipers_batched(hull_points: np.ndarray, bases, max_chunk_bytes: int = 64 * 2**20, tolerance=1e-6):
+    """Same as rotating_calipers but evaluates stacked (N, 3, 3) bases in chunks with einsum,
+    chunks are sized so that rotated points take at most max_chunk_bytes,
+    near duplicate bases are dropped first unless tolerance is None"""
+    hull_points = np.asarray(hull_points, dtype=np.float64)
+    if tolerance is None:
+        bases = np.asarray(bases, dtype=np.float64).reshape(-1, 3, 3)
+    else:
+        bases = deduplicate_bases(bases, tolerance)
+    if len(bases) == 0:
+        raise ValueError("No bounding box bases given")
+
+    chunk_size = max(1, max_chunk_bytes // (hull_points.shape[0] * 3 * hull_points.itemsize))
+
+    min_vol = math.inf
+    min_index = None
+    min_bb_min = None
+    min_bb_max = None
+    for chunk_start in range(0, len(bases), chunk_size):
+        chunk = bases[chunk_start : chunk_start + chunk_size]
+        # (chunk, 3, points), optimize lets einsum dispatch to a single matrix product
+        rot_points = np.einsum("bij,pj->bip", chunk, hull_points, optimize=True)
+
+        bb_min = rot_points.min(axis=2)
+        bb_max = rot_points.max(axis=2)
+        volumes = (bb_max - bb_min).prod(axis=1)
+
+        i = volumes.argmin()
+        if volumes[i] < min_vol:
+            min_vol = volumes[i]
+            min_index = chunk_start + i
+            min_bb_min = bb_min[i]
+            min_bb_max = bb_max[i]
+
+    return bases[min_index], min_bb_max, min_bb_min
+
+
+def benchmark_rotating_calipers(hull_sizes=(100, 1000, 5000), bases_per_point: int = 6, seed: int = 0):
+    """Compare rotating_calipers and rotating_calipers_batched on random points on a sphere,
+    a triangulated hull has about 2 faces per point and 3 bases per face"""
+    rng = np.random.default_rng(seed)
+    for hull_size in hull_sizes:
+        points = rng.normal(size=(hull_size, 3))
+        points /= np.linalg.norm(points, axis=1)[:, np.newaxis]
+        points *= (1.0, 2.0, 3.0)
+
+        bases, _ = np.linalg.qr(rng.normal(size=(hull_size * bases_per_point, 3, 3)))
+        bases = np.swapaxes(bases, 1, 2)
+
+        t0 = timer()
+        basis_ref, bb_max_ref, bb_min_ref = rotating_calipers(points, bases)
+        t1 = timer()
+        basis, bb_max, bb_min = rotating_calipers_batched(points, bases)
+        t2 = timer()
+
+        assert np.allclose((bb_max_ref - bb_min_ref).prod(), (bb_max - bb_min).prod())
+        print(
+            f"{hull_size} hull points, {len(bases)} bases: "
+            f"loop {t1 - t0:.4f} sec, batched {t2 - t1:.4f} sec, speedup {(t1 - t0) / (t2 - t1):.1f}x"
+        )
+
+
+def hull_bases(points: np.ndarray, hull_faces: np.ndarray):
+    """Candidate bounding box bases, one per hull triangle edge: (edge, co-tangent, face normal),
+    degenerate triangles are skipped relative to the size of the point cloud"""
+    tri_co = points[hull_faces]
+    face_normals = np.cross(tri_co[:, 1] - tri_co[:, 0], tri_co[:, 2] - tri_co[:, 0])
+    lengths = np.linalg.norm(face_normals, axis=1)
+    # Cross product length is twice the triangle area, compare with an area at the scale of the points
+    valid = lengths > _hull_tolerance(points) * np.ptp(points, axis=0).max()
+    if not valid.any():
+        raise ValueError("Convex hull has no non-degenerate faces")
+    tri_co = tri_co[valid]
+    face_normals = face_normals[valid] / lengths[valid, np.newaxis]
+
+    edge_vecs = tri_co - np.roll(tri_co, -1, axis=1)  # (faces, 3 edges, 3)
+    edge_vecs /= np.linalg.norm(edge_vecs, axis=2)[..., np.newaxis]
+    face_normals = np.broadcast_to(face_normals[:, np.newaxis], edge_vecs.shape)
+    co_tangents = np.cross(face_normals, edge_vecs)
+
+    return np.stack((edge_vecs, co_tangents, face_normals), axis=2).reshape(-1, 3, 3)
+
+
+def minimum_bounding_box_points(
+    points: np.ndarray, hull: Callable[[np.ndarray], np.ndarray] = convex_hull
+) -> np.ndarray:
+    """Minimum volume oriented bounding box of (N, 3) points, returns a 4x4 matrix
+    that maps the (-1, -1, -1) to (1, 1, 1) cube onto the box,
+    hull returns (M, 3) hull triangle vertex indices, the default does not need Blender"""
+    with span("minimum_bounding_box"):
+        return _minimum_bounding_box_points(points, hull)
+
+
+def _minimum_bounding_box_points(points: np.ndarray, hull: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+
+    with span("convex_hull"):
+        hull_faces = hull(points)
+        hull_points = points[np.unique(hull_faces)]
+
+    with span("hull_bases"):
+        bases = hull_bases(points, hull_faces)
+
+    with span("rotating_calipers"):
+        bb_basis, bb_max, bb_min = rotating_calipers_batched(hull_points, bases)
+
+    bb_dim = bb_max - bb_min
+    bb_center = (bb_max + bb_min) / 2
+
+    mat = np.identity(4)
+    mat[:3, :3] = bb_basis.T * (bb_dim / 2)
+    mat[:3, 3] = bb_center.dot(bb_basis)
+    return mat
+
+
+_WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_minimum_box_worker.py")
+
+
+def _worker_module():
+    """Load _minimum_box_worker as a top-level module, the name spawned workers import it by"""
+    module = sys.modules.get("_minimum_box_worker")
+    if module is None:
+        spec = importlib.util.spec_from_file_location("_minimum_box_worker", _WORKER_PATH)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["_minimum_box_worker"] = module
+        spec.loader.exec_module(module)
+    return module
+
+
+def minimum_bounding_boxes_points(
+    point_arrays: Sequence[np.ndarray], max_workers: Optional[int] = None, min_parallel_points: int = 500000
+) -> List[np.ndarray]:
+    """minimum_bounding_box_points for many (N, 3) arrays in a process pool, returns 4x4 matrices in input order,
+    arrays are copied once into a shared memory block so they are not pickled to the workers.
+    Workers are spawned (forking multithreaded Blender is unsafe) and only import _minimum_box_worker, never bpy.
+    Starting workers costs about a Python and numpy import each, so with fewer than min_parallel_points points
+    in total or a single worker, boxes are computed in this process"""
+    point_arrays = [np.asarray(points, dtype=np.float32).reshape(-1, 3) for points in point_arrays]
+    if len(point_arrays) == 0:
+        return []
+    counts = np.array([len(points) for points in point_arrays], dtype=np.int64)
+    offsets = np.zeros(len(point_arrays) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    total = int(offsets[-1])
+
+    num_workers = min(max_workers or os.cpu_count() or 1, len(point_arrays))
+    if num_workers <= 1 or total < min_parallel_points:
+        return [minimum_bounding_box_points(points) for points in point_arrays]
+
+    worker = _worker_module()
+    shm = SharedMemory(create=True, size=max(1, total * 3 * np.dtype(np.float32).itemsize))
+    try:
+        with span("minimum_bounding_boxes.copy_to_shared_memory"):
+            shared_points = np.ndarray((total, 3), dtype=np.float32, buffer=shm.buf)
+            for points, start in zip(point_arrays, offsets.tolist()):
+                shared_points[start : start + len(points)] = points
+            del shared_points
+
+        with span("minimum_bounding_boxes.process_pool"):
+            # Workers add the worker directory to sys.path before unpickling tasks that reference the worker module
+            with ProcessPoolExecutor(
+                num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=site.addsitedir,
+                initargs=(os.path.dirname(_WORKER_PATH),),
+            ) as executor:
+                # Submit largest first for better load balancing, collect in input order
+                futures = [None] * len(point_arrays)
+                for i in np.argsort(-counts, kind="stable").tolist():
+                    futures[i] = executor.submit(
+                        worker.shared_minimum_bounding_box, shm.name, total, int(offsets[i]), int(offsets[i + 1])
+                    )
+                return [future.result() for future in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def benchmark_minimum_bounding_boxes(
+    num_objects: int = 64, points_per_object: int = 20000, max_workers: Optional[int] = None, seed: int = 0
+):
+    """Compare throughput of minimum_bounding_boxes_points with computing the boxes one after another"""
+    rng = np.random.default_rng(seed)
+    point_arrays = [rng.normal(size=(points_per_object, 3)) * rng.uniform(0.5, 3, size=3) for _ in range(num_objects)]
+
+    t0 = timer()
+    serial = [minimum_bounding_box_points(points.astype(np.float32)) for points in point_arrays]
+    t1 = timer()
+    pooled = minimum_bounding_boxes_points(point_arrays, max_workers, min_parallel_points=0)
+    t2 = timer()
+
+    assert all(np.allclose(a, b) for a, b in zip(serial, pooled))
+    print(
+        f"{num_objects} objects, {points_per_object} points, {os.cpu_count()} cpus: "
+        f"serial {num_objects / (t1 - t0):.1f} objects/sec, pool {num_objects / (t2 - t1):.1f} objects/sec, "
+        f"speedup {(t1 - t0) / (t2 - t1):.2f}x"
+    )
@@ -1,13 +1,22 @@
-from cProfile import Profile
-import math
-from pstats import SortKey
-from timeit import default_timer as timer
+from typing import List, Optional
 
-import bmesh
 import bpy
 import numpy as np
 from mathutils import Matrix
 
+import bmesh
+
+from ..geometry_cache import obj_evaluated_geometry
+from ..timer import Profiler, span
+from .convex_hull import convex_hull
+from .minimum_box import (
+    deduplicate_bases,
+    minimum_bounding_box_points,
+    minimum_bounding_boxes_points,
+    rotating_calipers,
+    rotating_calipers_batched,
+)
+
 DEBUG = False
 
 CUBE_FACE_INDICES = (
@@ -27,108 +36,69 @@ def gen_cube_verts():
                 yield x, y, z
 
 
-def rotating_calipers(hull_points: np.ndarray, bases):
-    min_bb_basis = None
-    min_bb_min = None
-    min_bb_max = None
-    min_vol = math.inf
-    for basis in bases:
-        rot_points = hull_points.dot(np.transpose(basis))
-        # Reduced from:
-        # rot_points = hull_points.dot(np.linalg.inv(np.transpose(basis)).T)
-
-        bb_min = rot_points.min(axis=0)
-        bb_max = rot_points.max(axis=0)
-        volume = (bb_max - bb_min).prod()
-        if volume < min_vol:
-            min_bb_basis = basis
-            min_vol = volume
-
-            min_bb_min = bb_min
-            min_bb_max = bb_max
+def obj_evaluated_verts_co(obj: bpy.types.Object, depsgraph: bpy.types.Depsgraph = None) -> np.ndarray:
+    """(N, 3) read-only float32 array of evaluated mesh vertex locations in object space,
+    from the shared geometry cache"""
+    return obj_evaluated_geometry(obj, depsgraph).verts_co
 
-    return np.array(min_bb_basis), min_bb_max, min_bb_min
 
-
-def minimum_bounding_box(obj):
+def bmesh_convex_hull(points: np.ndarray) -> np.ndarray:
+    """Same as convex_hull but with bmesh.ops.convex_hull, vertices are passed with foreach_set,
+    n-gon hull faces are split into triangle fans"""
+    mesh = bpy.data.meshes.new("convex_hull")
+    mesh.vertices.add(len(points))
+    mesh.vertices.foreach_set("co", np.asarray(points, dtype=np.float32).ravel())
     bm = bmesh.new()
-    dg = bpy.context.evaluated_depsgraph_get()
-    bm.from_object(obj, dg)
+    bm.from_mesh(mesh)
+    bpy.data.meshes.remove(mesh)
+    bm.verts.index_update()
 
-    t0 = timer()
     chull_out = bmesh.ops.convex_hull(bm, input=bm.verts, use_existing_faces=False)
-    t1 = timer()
-    print(f"Convex-Hull calculated in {t1-t0} sec")
+    tris = []
+    for elem in chull_out["geom"]:
+        if not isinstance(elem, bmesh.types.BMFace):
+            continue
+        indices = [v.index for v in elem.verts]
+        tris.extend((indices[0], indices[i], indices[i + 1]) for i in range(1, len(indices) - 1))
+    bm.free()
+    return np.array(tris, dtype=np.int64).reshape(-1, 3)
+
 
-    chull_geom = chull_out["geom"]
-    chull_points = np.array([bmelem.co for bmelem in chull_geom if isinstance(bmelem, bmesh.types.BMVert)])
+def minimum_bounding_box(obj):
+    with span("evaluated_verts_co"):
+        co = obj_evaluated_verts_co(obj)
 
     # Create object from Convex-Hull (for debugging)
     if DEBUG:
-        t0 = timer()
-        for face in set(bm.faces) - set(chull_geom):
-            bm.faces.remove(face)
-        for edge in set(bm.edges) - set(chull_geom):
-            bm.edges.remove(edge)
-        t1 = timer()
-        print(f"Deleted non Convex-Hull edges and faces in {t1 - t0} sec")
-
+        hull_faces = convex_hull(co)
+        hull_verts = np.unique(hull_faces)
         chull_mesh = bpy.data.meshes.new(obj.name + "_convex_hull")
+        chull_mesh.from_pydata(
+            vertices=co[hull_verts].tolist(), edges=[], faces=np.searchsorted(hull_verts, hull_faces).tolist()
+        )
         chull_mesh.validate()
-        bm.to_mesh(chull_mesh)
         chull_obj = bpy.data.objects.new(chull_mesh.name, chull_mesh)
         chull_obj.matrix_world = obj.matrix_world
         bpy.context.scene.collection.objects.link(chull_obj)
 
-    bases = []
-
-    t0 = timer()
-    for elem in chull_geom:
-        if not isinstance(elem, bmesh.types.BMFace):
-            continue
-        if len(elem.verts) != 3:
-            continue
-
-        face_normal = elem.normal
-        if np.allclose(face_normal, 0, atol=0.00001):
-            continue
-
-        for e in elem.edges:
-            v0, v1 = e.verts
-            edge_vec = (v0.co - v1.co).normalized()
-            co_tangent = face_normal.cross(edge_vec)
-            basis = (edge_vec, co_tangent, face_normal)
-            bases.append(basis)
-
-    t1 = timer()
-    print(f"List of bases built in {t1-t0} sec")
-
-    t0 = timer()
-    bb_basis, bb_max, bb_min = rotating_calipers(chull_points, bases)
-    t1 = timer()
-    print(f"Rotating Calipers finished in {t1-t0} sec")
-
-    bm.free()
-
-    bb_basis_mat = bb_basis.T
-
-    bb_dim = bb_max - bb_min
-    bb_center = (bb_max + bb_min) / 2
+    # The C hull is much faster than the NumPy one on dense meshes
+    return Matrix(minimum_bounding_box_points(co, bmesh_convex_hull).tolist())
 
-    mat = (
-        Matrix.Translation(bb_center.dot(bb_basis))
-        @ Matrix(bb_basis_mat).to_4x4()
-        @ Matrix(np.identity(3) * bb_dim / 2).to_4x4()
-    )
 
-    return mat
+def minimum_bounding_boxes(objs: List[bpy.types.Object], max_workers: Optional[int] = None) -> List[Matrix]:
+    """minimum_bounding_box for many objects, evaluated vertices are extracted on the main thread
+    with a single depsgraph, hull and rotating calipers run in a process pool, matrices are in input order"""
+    with span("minimum_bounding_boxes.evaluated_verts_co"):
+        dg = bpy.context.evaluated_depsgraph_get()
+        point_arrays = [obj_evaluated_verts_co(obj, dg) for obj in objs]
+    return [Matrix(mat.tolist()) for mat in minimum_bounding_boxes_points(point_arrays, max_workers)]
 
 
 if __name__ == "__main__":
     obj = bpy.context.object
-    with Profile() as profile:
+    with Profiler() as profiler:
         mat = minimum_bounding_box(obj)
-    profile.print_stats(SortKey.TIME)
+    print(profiler.report())
 
     bb_mesh = bpy.data.meshes.new(obj.name + "_minimum_bounding_box")
     bb_mesh.from_pydata(vertices=list(gen_cube_verts()), edges=[], faces=CUBE_FACE_INDICES)
@@ -1,3 +1,8 @@
+from typing import Callable, List, Sequence
+
+import numpy as np
+
+
 def hex_to_rgb(color_str_hex: str):
     """Supports '123456', '#123456', '0x123456' and #123"""
     color_str_hex = color_str_hex.lstrip("#")
@@ -76,3 +81,123 @@ def hsv_to_rgb(color: tuple[float, float, float]) -> tuple[float, float, float]:
 
     else:
         return v, v1, v2
+
+
+def rgb_to_hsv_array(colors: np.ndarray) -> np.ndarray:
+    """Vectorized rgb_to_hsv, converts the first 3 channels of a (N, 3) or (N, 4) float array in place,
+    alpha is left as is, returns the same array"""
+    r = colors[:, 0].copy()
+    g = colors[:, 1].copy()
+    b = colors[:, 2].copy()
+
+    maxc = np.maximum(np.maximum(r, g), b)
+    minc = np.minimum(np.minimum(r, g), b)
+    delta = maxc - minc
+    grey = delta == 0
+
+    safe_delta = np.where(grey, 1, delta)
+    rc = (maxc - r) / safe_delta
+    gc = (maxc - g) / safe_delta
+    bc = (maxc - b) / safe_delta
+
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = (h / 6.0) % 1.0
+
+    colors[:, 0] = np.where(grey, 0.0, h)
+    colors[:, 1] = np.where(grey, 0.0, delta / np.where(maxc == 0, 1, maxc))
+    colors[:, 2] = maxc
+    return colors
+
+
+def hsv_to_rgb_array(colors: np.ndarray) -> np.ndarray:
+    """Vectorized hsv_to_rgb, converts the first 3 channels of a (N, 3) or (N, 4) float array in place,
+    alpha is left as is, returns the same array"""
+    h = colors[:, 0].copy()
+    s = colors[:, 1].copy()
+    v = colors[:, 2].copy()
+
+    i = np.trunc(h * 6.0)
+    f = (h * 6.0) - i
+
+    v1 = v * (1.0 - s)
+    v2 = v * (1.0 - s * f)
+    v3 = v * (1.0 - s * (1.0 - f))
+
+    i = i.astype(np.int64) % 6
+
+    # Rows are the (r, g, b) choices for sector i, same table as hsv_to_rgb
+    choices = np.stack((v, v1, v2, v3))
+    r_index = np.array((0, 2, 1, 1, 3, 0))[i]
+    g_index = np.array((3, 0, 0, 2, 1, 1))[i]
+    b_index = np.array((1, 1, 3, 0, 0, 2))[i]
+    rows = np.arange(len(colors))
+
+    colors[:, 0] = choices[r_index, rows]
+    colors[:, 1] = choices[g_index, rows]
+    colors[:, 2] = choices[b_index, rows]
+    return colors
+
+
+def hex_to_rgb_array(colors_str_hex: Sequence[str]) -> np.ndarray:
+    """Vectorized hex_to_rgb, returns a (N, 3) uint8 array"""
+    normalized = []
+    for color_str_hex in colors_str_hex:
+        color_str_hex = color_str_hex.lstrip("#")
+        if color_str_hex.startswith("0x"):
+            color_str_hex = color_str_hex[2:]
+        l = len(color_str_hex)
+        assert (l == 3) or (l == 6)
+        if l == 3:
+            color_str_hex = "".join(2 * c for c in color_str_hex)
+        normalized.append(color_str_hex)
+    return np.frombuffer(bytes.fromhex("".join(normalized)), dtype=np.uint8).reshape(-1, 3)
+
+
+def rgb_to_hex_array(colors: np.ndarray) -> List[str]:
+    """Vectorized rgb_to_hex for a (N, 3) array of integers in range [0, 255]"""
+    hex_str = np.ascontiguousarray(colors, dtype=np.uint8).tobytes().hex()
+    return ["#" + hex_str[i : i + 6] for i in range(0, len(hex_str), 6)]
+
+
+def color_attribute_get(mesh, name: str, srgb: bool = False) -> np.ndarray:
+    """Read a mesh color attribute into a (N, 4) float32 array with a single foreach_get"""
+    attr = mesh.color_attributes[name]
+    colors = np.empty(len(attr.data) * 4, dtype=np.float32)
+    attr.data.foreach_get("color_srgb" if srgb else "color", colors)
+    colors.shape = -1, 4
+    return colors
+
+
+def color_attribute_set(mesh, name: str, colors: np.ndarray, srgb: bool = False):
+    """Write a (N, 4) float32 array into a mesh color attribute with a single foreach_set"""
+    attr = mesh.color_attributes[name]
+    attr.data.foreach_set("color_srgb" if srgb else "color", np.ascontiguousarray(colors, dtype=np.float32).ravel())
+    mesh.update()
+
+
+def color_attribute_transform_hsv(
+    mesh, name: str, transform: Callable[[np.ndarray], None], srgb: bool = True
+) -> np.ndarray:
+    """Read a color attribute, convert to HSV, call transform on the (N, 4) HSVA array (modify it in place),
+    convert back and write it, returns the written colors"""
+    colors = color_attribute_get(mesh, name, srgb)
+    rgb_to_hsv_array(colors)
+    transform(colors)
+    hsv_to_rgb_array(colors)
+    color_attribute_set(mesh, name, colors, srgb)
+    return colors
+
+
+def color_attribute_adjust_hsv(
+    mesh, name: str, hue_shift: float = 0.0, saturation_factor: float = 1.0, value_factor: float = 1.0
+):
+    """Shift hue and scale saturation and value of a whole color attribute in one round trip"""
+
+    def adjust(hsva: np.ndarray):
+        hsva[:, 0] += hue_shift
+        hsva[:, 0] %= 1.0
+        hsva[:, 1] *= saturation_factor
+        np.clip(hsva[:, 1], 0.0, 1.0, out=hsva[:, 1])
+        hsva[:, 2] *= value_factor
+
+    return color_attribute_transform_hsv(mesh, name, adjust)
@@ -1,25 +1,85 @@
-import math
+from typing import Callable, Union
+
+import numpy as np
+
+float_or_array = Union[float, np.ndarray]
+
+
+def _float_or_array(result, value: float_or_array):
+    """Scalar input gives a Python float, like the math module versions of the easings"""
+    return float(result) if np.ndim(value) == 0 else result
+
 
 # https://easings.net/
-def ease_in_sine(value: float):
-    return 1 - math.cos((value * math.pi) / 2)
+# All easings accept floats or NumPy arrays
+def ease_in_sine(value: float_or_array):
+    return _float_or_array(1 - np.cos((value * np.pi) / 2), value)
+
+
+def ease_out_sine(value: float_or_array):
+    return _float_or_array(np.sin((value * np.pi) / 2), value)
+
+
+def ease_in_out_sine(value: float_or_array):
+    return _float_or_array(-(np.cos(np.pi * value) - 1) / 2, value)
+
+
+def ease_in_cubic(value: float_or_array):
+    return _float_or_array(value * value * value, value)
+
+
+def ease_out_cubic(value: float_or_array):
+    return _float_or_array(1 - (1 - value) ** 3, value)
+
+
+def ease_in_out_cubic(value: float_or_array):
+    return _float_or_array(np.where(value < 0.5, 4 * value * value * value, 1 - ((2 - 2 * value) ** 3) / 2), value)
 
 
-def ease_out_sine(value: float):
-    return math.sin((value * math.pi) / 2)
+class EasingLUT:
+    """Easing baked into a fixed resolution lookup table, evaluated with linear interpolation,
+    input is clamped to [0, 1]"""
 
+    __slots__ = ("table", "_scale")
 
-def ease_in_out_sine(value: float):
-    return -(math.cos(math.pi * value) - 1) / 2
+    def __init__(self, easing: Callable[[np.ndarray], np.ndarray], resolution: int = 1024):
+        assert resolution >= 2
+        self.table = np.asarray(easing(np.linspace(0.0, 1.0, resolution)), dtype=np.float64)
+        self._scale = resolution - 1
 
+    def __call__(self, value: float_or_array):
+        x = np.clip(value, 0.0, 1.0) * self._scale
+        i = np.minimum(x.astype(np.int64), self._scale - 1)
+        f = x - i
+        return _float_or_array(self.table[i] * (1 - f) + self.table[i + 1] * f, value)
 
-def ease_in_cubic(value: float):
-    return value * value * value
 
+def fcurve_set_keyframes(fcurve, frames: np.ndarray, values: np.ndarray):
+    """Replace keyframe points of an FCurve with (frame, value) pairs using a single foreach_set"""
+    co = np.empty((len(frames), 2), dtype=np.float32)
+    co[:, 0] = frames
+    co[:, 1] = values
 
-def ease_out_cubic(value: float):
-    return 1 - (1 - value) ** 3
+    keyframe_points = fcurve.keyframe_points
+    keyframe_points.clear()
+    keyframe_points.add(len(co))
+    keyframe_points.foreach_set("co", co.ravel())
+    fcurve.update()
 
 
-def ease_in_out_cubic(value: float):
-    return 4 * value * value * value if value < 0.5 else 1 - ((2 - 2 * value) ** 3) / 2
+def fcurve_bake_easing(
+    fcurve,
+    frame_start: float,
+    frame_end: float,
+    value_start: float,
+    value_end: float,
+    easing: Callable[[np.ndarray], np.ndarray],
+    frame_step: float = 1.0,
+):
+    """Key eased values from value_start to value_end on every frame_step frames between frame_start and frame_end,
+    easing can be any of the easing functions or an EasingLUT"""
+    num_frames = max(2, int(round((frame_end - frame_start) / frame_step)) + 1)
+    frames = np.linspace(frame_start, frame_end, num_frames)
+    t = np.linspace(0.0, 1.0, num_frames)
+    values = value_start + (value_end - value_start) * easing(t)
+    fcurve_set_keyframes(fcurve, frames, values)
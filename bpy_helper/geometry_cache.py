@@ -0,0 +1,225 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+import bpy
+import numpy as np
+from bpy.app.handlers import persistent
+
+from .mesh import MeshArrays
+
+
+class EvaluatedGeometry:
+    """Read-only arrays of an evaluated mesh in object space,
+    tris are loop triangle vertex indices and tri_polygons the polygon index of each triangle,
+    derived holds structures built from the arrays (e.g. BVH trees), dropped together with the entry,
+    add them with add_derived so that their size counts against the cache limit"""
+
+    __slots__ = ("verts_co", "tris", "tri_polygons", "derived", "_derived_nbytes", "_on_resize")
+
+    def __init__(self, verts_co: np.ndarray, tris: np.ndarray, tri_polygons: np.ndarray):
+        for arr in (verts_co, tris, tri_polygons):
+            arr.flags.writeable = False
+        self.verts_co = verts_co
+        self.tris = tris
+        self.tri_polygons = tri_polygons
+        self.derived = dict()
+        self._derived_nbytes: Dict[str, int] = dict()
+        self._on_resize: Optional[Callable[[int], None]] = None
+
+    @property
+    def nbytes(self):
+        return self.verts_co.nbytes + self.tris.nbytes + self.tri_polygons.nbytes + sum(self._derived_nbytes.values())
+
+    def add_derived(self, name: str, value, nbytes: int):
+        """Store value in derived, nbytes is its (estimated) size, the owning cache may evict entries to fit it"""
+        self.derived[name] = value
+        delta = nbytes - self._derived_nbytes.get(name, 0)
+        self._derived_nbytes[name] = nbytes
+        if self._on_resize is not None:
+            self._on_resize(delta)
+        return value
+
+
+def read_evaluated_geometry(obj: bpy.types.Object, depsgraph: bpy.types.Depsgraph) -> EvaluatedGeometry:
+    obj_eval = obj.evaluated_get(depsgraph)
+    mesh = obj_eval.to_mesh()
+    verts_co = MeshArrays(mesh).co
+
+    mesh.calc_loop_triangles()
+    tris = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("vertices", tris)
+    tris.shape = -1, 3
+    tri_polygons = np.empty(len(mesh.loop_triangles), dtype=np.int32)
+    mesh.loop_triangles.foreach_get("polygon_index", tri_polygons)
+
+    obj_eval.to_mesh_clear()
+    return EvaluatedGeometry(verts_co, tris, tri_polygons)
+
+
+# Bumped by the depsgraph handler for every original ID whose geometry was updated, keyed by ID pointer
+_update_versions: Dict[int, int] = dict()
+# Bumped on every frame change, animated geometry (armatures, shape keys, modifiers) changes without a
+# depsgraph update, which objects are animated is not known so all entries become stale
+_frame_version = 0
+
+
+def geometry_change_token(obj: bpy.types.Object):
+    """Changes whenever the evaluated geometry of obj may have changed: a different data block,
+    a geometry update reported to the depsgraph handler (also for modifier changes), or a frame change.
+    Versions are bumped once per depsgraph update by the handler, so this is only a few dict lookups"""
+    data_pointer = obj.data.as_pointer() if obj.data is not None else 0
+    return (
+        data_pointer,
+        _update_versions.get(obj.as_pointer(), 0),
+        _update_versions.get(data_pointer, 0),
+        _frame_version,
+    )
+
+
+# Set by unregister(), a disabled add-on must not install handlers again
+_auto_register = True
+
+
+def _ensure_handlers():
+    """Install the handlers on first use, returns whether they are installed"""
+    if _on_depsgraph_update_post not in bpy.app.handlers.depsgraph_update_post:
+        if not _auto_register:
+            return False
+        register()
+    return True
+
+
+class GeometryCache:
+    """Evaluated geometry of objects keyed by object and change token,
+    least recently used entries are evicted to stay within max_bytes.
+    Entries are per depsgraph mode (viewport or render), which evaluate modifiers differently.
+    Changes are detected by handlers installed on first use (or with register()),
+    after unregister() geometry is read fresh on every call and nothing is cached"""
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, obj: bpy.types.Object, depsgraph: Optional[bpy.types.Depsgraph] = None) -> EvaluatedGeometry:
+        if depsgraph is None:
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+        if not _ensure_handlers():
+            self.misses += 1
+            return read_evaluated_geometry(obj, depsgraph)
+        key = (obj.as_pointer(), depsgraph.mode)
+        token = geometry_change_token(obj)
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == token:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        if entry is not None:
+            self._remove(key)
+        geometry = read_evaluated_geometry(obj, depsgraph)
+        if geometry.nbytes <= self.max_bytes:
+            self._entries[key] = (token, geometry)
+            self.current_bytes += geometry.nbytes
+            geometry._on_resize = lambda delta: self._resized(key, delta)
+            self._evict()
+        return geometry
+
+    def _resized(self, key: tuple, delta: int):
+        # Derived data was added to the entry in use, older entries are evicted first
+        self._entries.move_to_end(key)
+        self.current_bytes += delta
+        self._evict()
+
+    def _remove(self, key: tuple):
+        _, geometry = self._entries.pop(key)
+        geometry._on_resize = None
+        self.current_bytes -= geometry.nbytes
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def invalidate(self, obj: Optional[bpy.types.Object] = None):
+        """Drop the entry of obj, or all entries if obj is None"""
+        if obj is None:
+            for _, geometry in self._entries.values():
+                geometry._on_resize = None
+            self._entries.clear()
+            self.current_bytes = 0
+        else:
+            pointer = obj.as_pointer()
+            for key in [key for key in self._entries if key[0] == pointer]:
+                self._remove(key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+GEOMETRY_CACHE = GeometryCache()
+
+
+def obj_evaluated_geometry(obj: bpy.types.Object, depsgraph: Optional[bpy.types.Depsgraph] = None):
+    """Evaluated geometry of obj from the shared cache"""
+    return GEOMETRY_CACHE.get(obj, depsgraph)
+
+
+@persistent
+def _on_depsgraph_update_post(scene, depsgraph):
+    for update in depsgraph.updates:
+        if not update.is_updated_geometry:
+            continue
+        pointer = update.id.original.as_pointer()
+        _update_versions[pointer] = _update_versions.get(pointer, 0) + 1
+
+
+@persistent
+def _on_frame_change_post(*args):
+    global _frame_version
+    _frame_version += 1
+
+
+@persistent
+def _on_load_post(*args):
+    # Pointers of a previous file may be reused by new data
+    _update_versions.clear()
+    GEOMETRY_CACHE.invalidate()
+
+
+def register():
+    global _auto_register
+    _auto_register = True
+    if _on_depsgraph_update_post in bpy.app.handlers.depsgraph_update_post:
+        return
+    bpy.app.handlers.depsgraph_update_post.append(_on_depsgraph_update_post)
+    bpy.app.handlers.frame_change_post.append(_on_frame_change_post)
+    bpy.app.handlers.load_post.append(_on_load_post)
+
+
+def unregister():
+    global _auto_register
+    _auto_register = False
+    if _on_depsgraph_update_post in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(_on_depsgraph_update_post)
+    if _on_frame_change_post in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.remove(_on_frame_change_post)
+    if _on_load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(_on_load_post)
+    GEOMETRY_CACHE.invalidate()
@@ -30,3 +30,111 @@ def fit_circle_through_points_2d(points_2d: np.ndarray):
     real_y = y_mean + Vc
     radius = alpha**0.5
     return real_x, real_y, radius
+
+
+def circles_through_3_points_2d(p1: np.ndarray, p2: np.ndarray, p3: np.ndarray, epsilon=1e-12):
+    """Circumcircles of many 2D point triplets given as (H, 2) arrays,
+    returns centers (H, 2), radii (H,) and a mask of non-collinear (valid) triplets"""
+    b = p2 - p1
+    c = p3 - p1
+    d = 2 * (b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0])
+    valid = np.abs(d) > epsilon
+    d = np.where(valid, d, 1)
+
+    b_sq = (b * b).sum(axis=1)
+    c_sq = (c * c).sum(axis=1)
+    ux = (c[:, 1] * b_sq - b[:, 1] * c_sq) / d
+    uy = (b[:, 0] * c_sq - c[:, 0] * b_sq) / d
+
+    centers = p1 + np.stack((ux, uy), axis=1)
+    radii = np.hypot(ux, uy)
+    return centers, radii, valid
+
+
+def circle_residuals_2d(points_2d: np.ndarray, centers: np.ndarray, radii: np.ndarray):
+    """Distances of points (N, 2) to boundaries of circles (H,), returns a (H, N) array"""
+    diff = points_2d[np.newaxis, :, :] - centers[:, np.newaxis, :]
+    return np.abs(np.hypot(diff[..., 0], diff[..., 1]) - radii[:, np.newaxis])
+
+
+def ransac_circle_2d(
+    points_2d: np.ndarray,
+    inlier_threshold: float,
+    num_hypotheses: int = 2048,
+    min_radius: float = 0.0,
+    max_radius: float = np.inf,
+    num_refine_iterations: int = 3,
+    max_chunk_bytes: int = 64 * 2**20,
+    rng: np.random.Generator = None,
+):
+    """Find the circle with most inliers using RANSAC, hypotheses from minimal 3 point samples
+    are evaluated together in memory-bounded chunks, the best one is refined with
+    fit_circle_through_points_2d on its inliers (LO-RANSAC), returns ((x, y, radius), inliers mask) or None"""
+    if rng is None:
+        rng = np.random.default_rng()
+    points_2d = np.asarray(points_2d, dtype=np.float64)
+    num_points = len(points_2d)
+    if num_points < 3:
+        return None
+
+    samples = rng.integers(0, num_points, size=(num_hypotheses, 3))
+    centers, radii, valid = circles_through_3_points_2d(*(points_2d[samples[:, i]] for i in range(3)))
+    valid &= (radii >= min_radius) & (radii <= max_radius)
+    centers = centers[valid]
+    radii = radii[valid]
+    if len(radii) == 0:
+        return None
+
+    chunk_size = max(1, max_chunk_bytes // (num_points * 8 * 3))
+    best_count = -1
+    best_index = None
+    for chunk_start in range(0, len(radii), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        counts = (circle_residuals_2d(points_2d, centers[chunk], radii[chunk]) < inlier_threshold).sum(axis=1)
+        i = counts.argmax()
+        if counts[i] > best_count:
+            best_count = counts[i]
+            best_index = chunk_start + i
+
+    best = slice(best_index, best_index + 1)
+    circle = (*centers[best_index], radii[best_index])
+    inliers = circle_residuals_2d(points_2d, centers[best], radii[best])[0] < inlier_threshold
+
+    # Local optimization, refit on inliers as long as that gains inliers
+    for _ in range(num_refine_iterations):
+        if inliers.sum() < 3:
+            break
+        x, y, radius = fit_circle_through_points_2d(points_2d[inliers])
+        if not np.isfinite(radius) or not (min_radius <= radius <= max_radius):
+            break
+        refined_inliers = circle_residuals_2d(points_2d, np.array([[x, y]]), np.array([radius]))[0] < inlier_threshold
+        if refined_inliers.sum() < inliers.sum():
+            break
+        circle = (x, y, radius)
+        inliers = refined_inliers
+
+    return circle, inliers
+
+
+def detect_circles_2d(
+    points_2d: np.ndarray,
+    inlier_threshold: float,
+    min_inliers: int = 10,
+    max_circles: int = 16,
+    **ransac_kwargs,
+):
+    """Extract several circles from one point cloud by running ransac_circle_2d repeatedly
+    and removing inliers of each found circle, returns a list of ((x, y, radius), inlier point indices)"""
+    points_2d = np.asarray(points_2d, dtype=np.float64)
+    remaining = np.arange(len(points_2d))
+    circles = []
+    while len(circles) < max_circles and len(remaining) >= max(3, min_inliers):
+        result = ransac_circle_2d(points_2d[remaining], inlier_threshold, **ransac_kwargs)
+        if result is None:
+            break
+        circle, inliers = result
+        if inliers.sum() < min_inliers:
+            break
+        circles.append((circle, remaining[inliers]))
+        remaining = remaining[~inliers]
+    return circles
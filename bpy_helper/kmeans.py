@@ -1,4 +1,6 @@
-from typing import Any, Iterable
+from typing import Any, Iterable, List, Optional, Union
+
+import numpy as np
 
 
 class KMeansNode:
@@ -29,21 +31,135 @@ class KMeansCluster(list):
         self.append(node)
 
 
-def k_means_min_max(nodes: Iterable[KMeansNode]):
-    """Divide nodes into two clusters, with min and max values as initial centroids"""
-    min_node = min(nodes, key=lambda node: node.value)
-    max_node = max(nodes, key=lambda node: node.value)
+def _sq_distances(data: np.ndarray, centroids: np.ndarray):
+    """(N, K) squared distances, expanded form to use a single matrix product"""
+    d = (data * data).sum(axis=1)[:, np.newaxis] - 2 * data.dot(centroids.T) + (centroids * centroids).sum(axis=1)
+    return np.maximum(d, 0, out=d)
 
-    min_cluster = KMeansCluster(min_node.value)
-    max_cluster = KMeansCluster(max_node.value)
 
-    for node in nodes:
-        dist_to_min = abs(min_cluster.centroid - node.value)
-        dist_to_max = abs(max_cluster.centroid - node.value)
+def assign_clusters(data: np.ndarray, centroids: np.ndarray, chunk_size: int = 2**16):
+    """Nearest centroid label and squared distance to it for every row of data, in chunks to bound memory"""
+    labels = np.empty(len(data), dtype=np.int64)
+    min_sq_dists = np.empty(len(data), dtype=data.dtype)
+    for start in range(0, len(data), chunk_size):
+        sq_dists = _sq_distances(data[start : start + chunk_size], centroids)
+        chunk_labels = sq_dists.argmin(axis=1)
+        labels[start : start + chunk_size] = chunk_labels
+        min_sq_dists[start : start + chunk_size] = sq_dists[np.arange(len(chunk_labels)), chunk_labels]
+    return labels, min_sq_dists
 
-        if dist_to_min < dist_to_max:
-            min_cluster.add_node(node)
+
+def k_means_plus_plus_init(data: np.ndarray, k: int, rng: np.random.Generator):
+    """Pick k initial centroids from data rows, each next one with probability proportional to
+    squared distance to the nearest already picked centroid"""
+    centroids = np.empty((k, data.shape[1]), dtype=data.dtype)
+    centroids[0] = data[rng.integers(len(data))]
+    min_sq_dists = _sq_distances(data, centroids[:1])[:, 0]
+    for i in range(1, k):
+        total = min_sq_dists.sum()
+        if total > 0:
+            index = rng.choice(len(data), p=min_sq_dists / total)
         else:
-            max_cluster.add_node(node)
+            index = rng.integers(len(data))
+        centroids[i] = data[index]
+        np.minimum(min_sq_dists, _sq_distances(data, centroids[i : i + 1])[:, 0], out=min_sq_dists)
+    return centroids
+
+
+def _cluster_sums(data: np.ndarray, labels: np.ndarray, k: int):
+    counts = np.bincount(labels, minlength=k)
+    sums = np.stack([np.bincount(labels, weights=data[:, d], minlength=k) for d in range(data.shape[1])], axis=1)
+    return sums, counts
+
+
+def k_means(
+    data: np.ndarray,
+    k: int,
+    init: Union[str, np.ndarray] = "k-means++",
+    max_iterations: int = 100,
+    tolerance: float = 1e-6,
+    batch_size: Optional[int] = None,
+    rng: Optional[np.random.Generator] = None,
+):
+    """K-means over (N, D) or (N,) data, iterates until centroids move less than tolerance,
+    init is "k-means++", "random" or a (k, D) array of initial centroids,
+    if batch_size is given, centroids are updated from random mini-batches of that size,
+    returns (k, D) centroids and (N,) labels, empty clusters keep their previous centroid"""
+    if rng is None:
+        rng = np.random.default_rng()
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    if len(data) == 0:
+        raise ValueError("k-means needs at least one sample")
+
+    if isinstance(init, str):
+        if init == "k-means++":
+            init_size = min(len(data), max(batch_size or 0, 256 * k))
+            init_data = data if batch_size is None else data[rng.integers(len(data), size=init_size)]
+            centroids = k_means_plus_plus_init(init_data, k, rng)
+        elif init == "random":
+            centroids = data[rng.choice(len(data), size=k, replace=len(data) < k)].copy()
+        else:
+            raise ValueError(f"Unknown k-means init method {init}")
+    else:
+        centroids = np.array(init, dtype=np.float64).reshape(k, data.shape[1])
+
+    tolerance_sq = tolerance * tolerance
+    if batch_size is None:
+        for _ in range(max_iterations):
+            labels, _ = assign_clusters(data, centroids)
+            sums, counts = _cluster_sums(data, labels, k)
+            nonempty = counts > 0
+            new_centroids = centroids.copy()
+            new_centroids[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+            shift_sq = ((new_centroids - centroids) ** 2).sum(axis=1).max()
+            centroids = new_centroids
+            if shift_sq <= tolerance_sq:
+                break
+    else:
+        # Mini-batch k-means (Sculley 2010), per-centroid learning rate is 1 / number of samples seen
+        seen = np.zeros(k, dtype=np.int64)
+        for _ in range(max_iterations):
+            batch = data[rng.integers(len(data), size=batch_size)]
+            batch_labels, _ = assign_clusters(batch, centroids)
+            sums, counts = _cluster_sums(batch, batch_labels, k)
+            seen += counts
+            nonempty = counts > 0
+            step = (sums[nonempty] - counts[nonempty, np.newaxis] * centroids[nonempty]) / seen[nonempty, np.newaxis]
+            centroids[nonempty] += step
+            if (step * step).sum(axis=1).max(initial=0) <= tolerance_sq:
+                break
+
+    labels, _ = assign_clusters(data, centroids)
+    return centroids, labels
+
+
+def k_means_nodes(nodes: Iterable[KMeansNode], k: int, **kwargs) -> List[KMeansCluster]:
+    """Node/cluster adapter for k_means, values of nodes can be floats or sequences of equal length"""
+    nodes = list(nodes)
+    centroids, labels = k_means(np.array([node.value for node in nodes], dtype=np.float64), k, **kwargs)
+    return _clusters_from_labels(nodes, centroids, labels)
+
+
+def _clusters_from_labels(nodes: List[KMeansNode], centroids: np.ndarray, labels: np.ndarray):
+    scalar = np.ndim(nodes[0].value) == 0
+    clusters = [KMeansCluster(float(c[0]) if scalar else c) for c in centroids]
+    for node, label in zip(nodes, labels.tolist()):
+        clusters[label].append(node)
+    return clusters
+
+
+def k_means_min_max(nodes: Iterable[KMeansNode], **kwargs):
+    """Divide nodes into two clusters, with min and max values as initial centroids,
+    nodes equally far from both centroids (e.g. all values equal) go to the max cluster"""
+    nodes = list(nodes)
+    min_node = min(nodes, key=lambda node: node.value)
+    max_node = max(nodes, key=lambda node: node.value)
+
+    values = np.array([node.value for node in nodes], dtype=np.float64)
+    # Ties go to the first centroid, so the max centroid comes first
+    centroids, labels = k_means(values, 2, init=np.array([max_node.value, min_node.value]), **kwargs)
+    max_cluster, min_cluster = _clusters_from_labels(nodes, centroids, labels)
 
     return min_cluster, max_cluster
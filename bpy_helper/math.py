@@ -51,6 +51,38 @@ def transform_normal(mat: Matrix, vec: Vector) -> Vector:
     return mat.inverted_safe().transposed() @ vec
 
 
+def quats_rotation_to_z(vectors: np.ndarray):
+    """(N, 4) WXYZ quaternions rotating each vector onto +Z,
+    same as Vector.rotation_difference((0, 0, 1)) for every row"""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    lengths = np.linalg.norm(vectors, axis=1)
+    unit = vectors / np.where(lengths > 0, lengths, 1)[:, np.newaxis]
+    # Half-way quaternion (1 + a.b, a x b) normalized, with a x Z = (a.y, -a.x, 0)
+    quats = np.stack((1 + unit[:, 2], unit[:, 1], -unit[:, 0], np.zeros(len(unit))), axis=1)
+    # Opposite vectors rotate half a turn around ortho_v3_v3 of the vector like Blender,
+    # which is (z, z, -x - y) as Z is the dominant axis, zero vectors give identity
+    opposite = (np.hypot(unit[:, 0], unit[:, 1]) <= np.finfo(np.float32).eps) & (unit[:, 2] < 0)
+    u = unit[opposite]
+    axis = np.stack((u[:, 2], u[:, 2], -u[:, 0] - u[:, 1]), axis=1)
+    quats[opposite, 0] = 0
+    quats[opposite, 1:] = axis / np.linalg.norm(axis, axis=1)[:, np.newaxis]
+    quats[lengths == 0] = (1.0, 0.0, 0.0, 0.0)
+    return quats / np.linalg.norm(quats, axis=1)[:, np.newaxis]
+
+
+def quats_to_matrices(quats: np.ndarray):
+    """(N, 3, 3) rotation matrices of (N, 4) WXYZ unit quaternions"""
+    w, x, y, z = np.asarray(quats, dtype=np.float64).T
+    return np.stack(
+        (
+            np.stack((1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)), axis=1),
+            np.stack((2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)), axis=1),
+            np.stack((2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)), axis=1),
+        ),
+        axis=1,
+    )
+
+
 def vector_mean(vectors: Iterable[Vector]):
     return sum((co / len(vectors) for co in vectors), Vector())
 
@@ -1,31 +1,432 @@
-from typing import Iterable, Union
+from typing import Iterable, Optional, Union
 
 import bpy
+import numpy as np
 from bpy.types import MeshVertex, Object
 from mathutils import Matrix, Vector
 
-import bmesh
 from bmesh.types import BMVert
 
-from .math import vector_mean
+from .math import quats_rotation_to_z, quats_to_matrices, vector_mean
 
 
-def shade_flat(mesh: bpy.types.Mesh):
-    num_poly = len(mesh.polygons)
-    mesh.polygons.foreach_set("use_smooth", (False,) * num_poly)
-    mesh.update()
+def shade_flat(mesh: bpy.types.Mesh, arrays: Optional["MeshArrays"] = None):
+    """With arrays given the change is written by arrays.flush()"""
+    if arrays is None:
+        arrays = MeshArrays(mesh)
+        arrays.modify("use_smooth")[:] = False
+        arrays.flush()
+    else:
+        arrays.modify("use_smooth")[:] = False
+
+
+def loops_prev_next(faces_loop_start: np.ndarray, faces_loop_total: np.ndarray):
+    """Previous and next loop index of every loop within its face"""
+    totals = faces_loop_total.astype(np.int64)
+    loop_face = np.repeat(np.arange(len(totals)), totals)
+    start = faces_loop_start.astype(np.int64)[loop_face]
+    total = totals[loop_face]
+    local = np.arange(len(loop_face)) - start
+    return start + (local - 1) % total, start + (local + 1) % total
+
+
+def calc_corner_angles(
+    verts_co: np.ndarray, faces_loop_start: np.ndarray, faces_loop_total: np.ndarray, loops_vert: np.ndarray
+):
+    """Angle of every face corner (loop) in radians"""
+    prev_loop, next_loop = loops_prev_next(faces_loop_start, faces_loop_total)
+    co = verts_co[loops_vert]
+    a = verts_co[loops_vert[prev_loop]] - co
+    b = verts_co[loops_vert[next_loop]] - co
+    a /= np.maximum(np.linalg.norm(a, axis=1), 1e-30)[:, np.newaxis]
+    b /= np.maximum(np.linalg.norm(b, axis=1), 1e-30)[:, np.newaxis]
+    return np.arccos(np.clip(np.einsum("ij,ij->i", a, b), -1.0, 1.0))
+
+
+def calc_faces_area_vector(
+    verts_co: np.ndarray, faces_loop_start: np.ndarray, faces_loop_total: np.ndarray, loops_vert: np.ndarray
+):
+    """(F, 3) face normals scaled by face area (Newell's method), exact for planar faces"""
+    _, next_loop = loops_prev_next(faces_loop_start, faces_loop_total)
+    co = verts_co[loops_vert].astype(np.float64)
+    crosses = np.cross(co, co[next_loop])
+    area_vectors = np.zeros((len(faces_loop_start), 3))
+    if len(crosses):
+        area_vectors[faces_loop_total > 0] = np.add.reduceat(crosses, faces_loop_start[faces_loop_total > 0], axis=0)
+    return 0.5 * area_vectors
+
+
+def calc_verts_shell_factor(mesh: bpy.types.Mesh, arrays: Optional["MeshArrays"] = None):
+    """Array version of BMVert.calc_shell_factor for all vertices,
+    corner angle weighted mean of 1 / cos(angle between vertex normal and face normal)"""
+    if arrays is None:
+        arrays = MeshArrays(mesh)
+    verts_co = arrays.co
+    faces_loop_start = arrays.get("loop_start")
+    faces_loop_total = arrays.get("loop_total")
+    loops_vert = arrays.get("loops_vert")
+    num_verts = len(verts_co)
+    verts_normal = arrays.vert_normals
+    faces_normal = arrays.face_normals
+
+    angles = calc_corner_angles(verts_co, faces_loop_start, faces_loop_total, loops_vert)
+    loops_face_normal = np.repeat(faces_normal, faces_loop_total, axis=0)
+    angle_cos = np.abs(np.einsum("ij,ij->i", verts_normal[loops_vert], loops_face_normal))
+    shell = np.where(angle_cos < 1e-8, 1.0, 1.0 / np.maximum(angle_cos, 1e-8))
+
+    accum_shell = np.bincount(loops_vert, weights=shell * angles, minlength=num_verts)
+    accum_angle = np.bincount(loops_vert, weights=angles, minlength=num_verts)
+    return np.divide(accum_shell, accum_angle, out=np.ones(num_verts), where=accum_angle != 0)
+
+
+def mesh_vertex_group_weights(mesh: bpy.types.Mesh, group_index: int):
+    """Weights of a vertex group (obj.vertex_groups[name].index) as an array, zero for unassigned vertices.
+    Deform weights have no foreach_get access, so this is a Python loop over every vertex and its groups,
+    O(vertices) interpreter work: call it once and reuse the array instead of calling it in per-frame code"""
+    pairs = [(v.index, g.weight) for v in mesh.vertices for g in v.groups if g.group == group_index]
+    weights = np.zeros(len(mesh.vertices), dtype=np.float32)
+    if pairs:
+        indices, values = zip(*pairs)
+        weights[np.array(indices)] = values
+    return weights
+
+
+def fatten_even(
+    mesh: bpy.types.Mesh,
+    distance: float = 1.0,
+    weights: Optional[Union[str, np.ndarray]] = None,
+    arrays: Optional["MeshArrays"] = None,
+):
+    """Move vertices along their normals keeping an even shell thickness,
+    weights scale the distance per vertex and can be an array or the name of a float point attribute,
+    vertex groups are not read here (no bulk access), pass mesh_vertex_group_weights as an array.
+    With arrays given the change is written by arrays.flush()"""
+    flush = arrays is None
+    if arrays is None:
+        arrays = MeshArrays(mesh)
+
+    if isinstance(weights, str):
+        attr = mesh.attributes[weights]
+        if attr.domain != "POINT" or attr.data_type != "FLOAT":
+            raise ValueError(f"Attribute {weights!r} is not a float point attribute")
+        weights = arrays.attribute(weights)[:, 0]
+
+    offset = calc_verts_shell_factor(mesh, arrays) * distance
+    if weights is not None:
+        offset *= weights
+    arrays.modify("co")[:] += arrays.vert_normals * offset[:, np.newaxis]
+
+    if flush:
+        arrays.flush()
+
+
+# Maps attribute data type to foreach key, number of components and buffer dtype
+_ATTRIBUTE_TYPES = {
+    "FLOAT": ("value", 1, np.float32),
+    "INT": ("value", 1, np.int32),
+    "INT8": ("value", 1, np.int32),
+    "BOOLEAN": ("value", 1, bool),
+    "FLOAT2": ("vector", 2, np.float32),
+    "FLOAT_VECTOR": ("vector", 3, np.float32),
+    "FLOAT_COLOR": ("color", 4, np.float32),
+    "BYTE_COLOR": ("color", 4, np.float32),
+}
+
+
+# Maps MeshArrays key to collection, foreach property, number of components, buffer dtype and writability
+_MESH_ARRAYS = {
+    "co": ("vertices", "co", 3, np.float32, True),
+    "vert_normals": ("vertices", "normal", 3, np.float32, False),
+    "edges_verts": ("edges", "vertices", 2, np.int32, True),
+    "loop_start": ("polygons", "loop_start", 1, np.int32, True),
+    "loop_total": ("polygons", "loop_total", 1, np.int32, False),
+    "face_normals": ("polygons", "normal", 3, np.float32, False),
+    "face_centers": ("polygons", "center", 3, np.float32, False),
+    "face_areas": ("polygons", "area", 1, np.float32, False),
+    "use_smooth": ("polygons", "use_smooth", 1, bool, True),
+    "loops_vert": ("loops", "vertex_index", 1, np.int32, True),
+    "loops_edge": ("loops", "edge_index", 1, np.int32, True),
+}
+
+# Arrays derived from vertex locations, refetched after locations are written
+_CO_DERIVED = ("vert_normals", "face_normals", "face_centers", "face_areas")
+
+
+class MeshArrays:
+    """Mesh data pulled lazily into reusable buffers with a single foreach_get per array,
+    pass one instance to several helpers so each array is fetched once,
+    arrays changed with modify() are written back together by flush().
+    Call invalidate() after changing the mesh by other means, buffers are reused when sizes match"""
+
+    __slots__ = ("mesh", "_buffers", "_valid", "_dirty")
+
+    def __init__(self, mesh: bpy.types.Mesh):
+        self.mesh = mesh
+        self._buffers = dict()
+        self._valid = set()
+        self._dirty = set()
+
+    def _buffer(self, key, shape, dtype):
+        buf = self._buffers.get(key)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self._buffers[key] = np.empty(shape, dtype=dtype)
+        return buf
+
+    def get(self, key: str) -> np.ndarray:
+        """Array of a key in _MESH_ARRAYS, shared, do not modify without calling modify()"""
+        if key in self._valid:
+            return self._buffers[key]
+        collection_name, prop, num_components, dtype, _ = _MESH_ARRAYS[key]
+        collection = getattr(self.mesh, collection_name)
+        shape = (len(collection), num_components) if num_components > 1 else (len(collection),)
+        buf = self._buffer(key, shape, dtype)
+        collection.foreach_get(prop, buf.reshape(-1))
+        self._valid.add(key)
+        return buf
+
+    def attribute(self, name: str) -> np.ndarray:
+        """(N, components) array of a generic attribute"""
+        key = ("attribute", name)
+        if key in self._valid:
+            return self._buffers[key]
+        attr = self.mesh.attributes[name]
+        foreach_key, num_components, dtype = _ATTRIBUTE_TYPES[attr.data_type]
+        buf = self._buffer(key, (len(attr.data), num_components), dtype)
+        attr.data.foreach_get(foreach_key, buf.reshape(-1))
+        self._valid.add(key)
+        return buf
+
+    def modify(self, key: str) -> np.ndarray:
+        """Array of a key (or ("attribute", name) tuple) to be changed in place, written back on flush"""
+        if isinstance(key, tuple):
+            arr = self.attribute(key[1])
+        else:
+            if not _MESH_ARRAYS[key][4]:
+                raise ValueError(f"{key!r} is read-only")
+            arr = self.get(key)
+        self._dirty.add(key)
+        return arr
+
+    def invalidate(self, keys: Iterable = None):
+        """Refetch arrays on next access, all arrays if keys is None, pending changes are dropped"""
+        if keys is None:
+            self._valid.clear()
+            self._dirty.clear()
+        else:
+            self._valid.difference_update(keys)
+            self._dirty.difference_update(keys)
+
+    def flush(self, update: bool = True):
+        """Write modified arrays back into the mesh"""
+        mesh = self.mesh
+        for key in self._dirty:
+            buf = self._buffers[key]
+            if isinstance(key, tuple):
+                attr = mesh.attributes[key[1]]
+                attr.data.foreach_set(_ATTRIBUTE_TYPES[attr.data_type][0], buf.reshape(-1))
+            else:
+                collection_name, prop, _, _, _ = _MESH_ARRAYS[key]
+                getattr(mesh, collection_name).foreach_set(prop, buf.reshape(-1))
+        if "co" in self._dirty:
+            self._valid.difference_update(_CO_DERIVED)
+        self._dirty.clear()
+        if update:
+            mesh.update()
+
+    @property
+    def co(self) -> np.ndarray:
+        return self.get("co")
+
+    @property
+    def vert_normals(self) -> np.ndarray:
+        return self.get("vert_normals")
+
+    @property
+    def face_normals(self) -> np.ndarray:
+        return self.get("face_normals")
+
+    def geometry(self):
+        """Same layout as mesh_read_geometry"""
+        return (
+            self.get("co"),
+            self.get("edges_verts"),
+            self.get("loop_start"),
+            self.get("loop_total"),
+            self.get("loops_vert"),
+            self.get("loops_edge"),
+        )
 
 
-def fatten_even(mesh: bpy.types.Mesh, distance: float = 1.0):
-    bm = bmesh.new(use_operators=False)
-    bm.from_mesh(mesh)
-    v: bmesh.types.BMVert
-    for v in bm.verts:
-        v.co += v.normal * v.calc_shell_factor() * distance
+def mesh_read_geometry(mesh: bpy.types.Mesh, arrays: Optional[MeshArrays] = None):
+    """Read mesh topology into arrays using foreach_get,
+    returns (verts_co, edges_verts, faces_loop_start, faces_loop_total, loops_vert, loops_edge),
+    arrays are shared with the MeshArrays when given"""
+    if arrays is None:
+        arrays = MeshArrays(mesh)
+    return arrays.geometry()
+
+
+def is_generic_attribute(attr: bpy.types.Attribute):
+    """Attributes handled by mesh_read_attributes"""
+    return (
+        not attr.name.startswith(".")
+        and attr.name != "position"
+        and attr.domain in ("POINT", "EDGE", "FACE", "CORNER")
+        and attr.data_type in _ATTRIBUTE_TYPES
+    )
+
+
+# Internal attributes with hide and select state (and UV select and pin layers), unlike other internal
+# attributes they don't store topology, so they can be subset like generic attributes
+_STATE_ATTRIBUTE_NAMES = {".hide_vert", ".hide_edge", ".hide_poly", ".select_vert", ".select_edge", ".select_poly"}
+_STATE_ATTRIBUTE_PREFIXES = (".vs.", ".es.", ".pn.")
+
+
+def is_state_attribute(attr: bpy.types.Attribute):
+    """Internal hide and select attributes, read by mesh_read_attributes with include_state"""
+    return attr.data_type == "BOOLEAN" and (
+        attr.name in _STATE_ATTRIBUTE_NAMES or attr.name.startswith(_STATE_ATTRIBUTE_PREFIXES)
+    )
+
+
+def mesh_has_deform_data(mesh: bpy.types.Mesh):
+    """Whether the mesh has shape keys or an object using it has vertex groups,
+    neither is an attribute, so rebuilding the mesh from arrays loses them"""
+    if mesh.shape_keys is not None:
+        return True
+    return any(obj.data == mesh and len(obj.vertex_groups) > 0 for obj in bpy.data.objects)
+
+
+def mesh_read_attributes(mesh: bpy.types.Mesh, arrays: Optional[MeshArrays] = None, include_state: bool = False):
+    """Read generic attributes into arrays, returns a list of (name, data_type, domain, array),
+    internal attributes (names starting with a dot) and positions are skipped,
+    except hide and select state if include_state"""
+    if arrays is None:
+        arrays = MeshArrays(mesh)
+    attributes = []
+    for attr in mesh.attributes:
+        if not (is_generic_attribute(attr) or (include_state and is_state_attribute(attr))):
+            continue
+        attributes.append((attr.name, attr.data_type, attr.domain, arrays.attribute(attr.name)))
+    return attributes
+
+
+def mesh_write_attributes(mesh: bpy.types.Mesh, attributes):
+    """Write attributes returned by mesh_read_attributes (possibly subset) back into a mesh"""
+    for name, data_type, domain, arr in attributes:
+        attr = mesh.attributes.get(name)
+        if attr is None:
+            attr = mesh.attributes.new(name, data_type, domain)
+        key, _, _ = _ATTRIBUTE_TYPES[data_type]
+        attr.data.foreach_set(key, arr.ravel())
+
+
+def mesh_set_geometry(
+    mesh: bpy.types.Mesh,
+    verts_co: np.ndarray,
+    edges_verts: np.ndarray,
+    faces_loop_start: np.ndarray,
+    faces_loop_total: np.ndarray,
+    loops_vert: np.ndarray,
+    loops_edge: np.ndarray,
+):
+    """Replace mesh geometry with arrays using a single foreach_set per property"""
+    mesh.clear_geometry()
+
+    mesh.vertices.add(len(verts_co))
+    mesh.vertices.foreach_set("co", np.ascontiguousarray(verts_co, dtype=np.float32).ravel())
+
+    mesh.edges.add(len(edges_verts))
+    mesh.edges.foreach_set("vertices", np.ascontiguousarray(edges_verts, dtype=np.int32).ravel())
+
+    mesh.loops.add(len(loops_vert))
+    mesh.loops.foreach_set("vertex_index", np.ascontiguousarray(loops_vert, dtype=np.int32))
+    mesh.loops.foreach_set("edge_index", np.ascontiguousarray(loops_edge, dtype=np.int32))
+
+    mesh.polygons.add(len(faces_loop_start))
+    mesh.polygons.foreach_set("loop_start", np.ascontiguousarray(faces_loop_start, dtype=np.int32))
+    # loop_total is read-only since Blender 4.0, it is derived from loop_start
+    if bpy.app.version < (4, 0, 0):
+        mesh.polygons.foreach_set("loop_total", np.ascontiguousarray(faces_loop_total, dtype=np.int32))
 
-    bm.to_mesh(mesh)
     mesh.update()
-    bm.free()
+
+
+def group_by_labels(labels: np.ndarray, num_groups: int):
+    """Stable order of elements sorted by label, and start offset of each label in that order,
+    elements with negative labels are dropped"""
+    order = np.argsort(labels, kind="stable")
+    order = order[labels[order] >= 0]
+    counts = np.bincount(labels[order], minlength=num_groups)
+    starts = np.zeros(num_groups + 1, dtype=np.int64)
+    np.cumsum(counts, out=starts[1:])
+    return order, starts
+
+
+def mesh_split_geometry(
+    verts_co: np.ndarray,
+    edges_verts: np.ndarray,
+    faces_loop_start: np.ndarray,
+    faces_loop_total: np.ndarray,
+    loops_vert: np.ndarray,
+    loops_edge: np.ndarray,
+    vert_labels: np.ndarray,
+    edge_labels: np.ndarray,
+    face_labels: np.ndarray,
+    num_groups: int,
+):
+    """Split geometry arrays into groups by per-element labels in a single sort pass,
+    elements with negative labels are dropped, edges and faces must only reference
+    vertices (and faces only edges) of their own group. Yields (geometry arrays, (vert_indices, edge_indices, face_indices, loop_indices))
+    per group, the index arrays map new elements to the original ones"""
+    vert_order, vert_starts = group_by_labels(vert_labels, num_groups)
+    edge_order, edge_starts = group_by_labels(edge_labels, num_groups)
+    face_order, face_starts = group_by_labels(face_labels, num_groups)
+
+    # Map from original vertex index to its index inside its group
+    vert_new_index = np.full(len(verts_co), -1, dtype=np.int32)
+    vert_new_index[vert_order] = np.arange(len(vert_order)) - np.repeat(vert_starts[:-1], np.diff(vert_starts))
+    edge_new_index = np.full(len(edges_verts), -1, dtype=np.int32)
+    edge_new_index[edge_order] = np.arange(len(edge_order)) - np.repeat(edge_starts[:-1], np.diff(edge_starts))
+
+    # Gather loops in the order of sorted faces
+    totals = faces_loop_total[face_order]
+    new_loop_start = np.zeros(len(face_order) + 1, dtype=np.int64)
+    np.cumsum(totals, out=new_loop_start[1:])
+    loop_order = np.repeat(faces_loop_start[face_order] - new_loop_start[:-1], totals) + np.arange(new_loop_start[-1])
+
+    sorted_edges_verts = vert_new_index[edges_verts[edge_order]]
+    sorted_loops_vert = vert_new_index[loops_vert[loop_order]]
+    sorted_loops_edge = edge_new_index[loops_edge[loop_order]]
+
+    for i in range(num_groups):
+        v0, v1 = vert_starts[i], vert_starts[i + 1]
+        e0, e1 = edge_starts[i], edge_starts[i + 1]
+        f0, f1 = face_starts[i], face_starts[i + 1]
+        l0, l1 = new_loop_start[f0], new_loop_start[f1]
+        geometry = (
+            verts_co[vert_order[v0:v1]],
+            sorted_edges_verts[e0:e1],
+            new_loop_start[f0:f1] - l0,
+            totals[f0:f1],
+            sorted_loops_vert[l0:l1],
+            sorted_loops_edge[l0:l1],
+        )
+        indices = (vert_order[v0:v1], edge_order[e0:e1], face_order[f0:f1], loop_order[l0:l1])
+        yield geometry, indices
+
+
+def subset_attributes(attributes, vert_indices, edge_indices, face_indices, loop_indices):
+    """Subset attributes returned by mesh_read_attributes using per-domain element indices,
+    negative indices give zero (default) values"""
+    domain_indices = {"POINT": vert_indices, "EDGE": edge_indices, "FACE": face_indices, "CORNER": loop_indices}
+    subsets = []
+    for name, data_type, domain, arr in attributes:
+        indices = np.asarray(domain_indices[domain])
+        subset = arr[indices]
+        subset[indices < 0] = 0
+        subsets.append((name, data_type, domain, subset))
+    return subsets
 
 
 def calc_mean_verts_normal(verts: Iterable[Union[MeshVertex, BMVert]]):
@@ -53,3 +454,59 @@ def align_object_to_verts(obj: Object, verts: Iterable[Union[MeshVertex, BMVert]
     obj.matrix_world = obj.matrix_world @ Matrix.Translation(avg_co)
     # rotate AFTER move
     obj.rotation_euler.rotate(rot_quat.conjugated())
+
+
+def groups_flattened(verts_co: np.ndarray, verts_normal: np.ndarray, group_ids: np.ndarray, num_groups: int = None):
+    """Grouped version of get_verts_flattened and calc_mean_verts_co for many groups at once,
+    elements with negative group ids are skipped (their flattened coordinates are zero).
+    Returns per-group mean normals (G, 3), centroids (G, 3) and WXYZ rotation quaternions (G, 4),
+    and per-element flattened coordinates (N, 2)"""
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    if num_groups is None:
+        num_groups = int(group_ids.max()) + 1 if len(group_ids) else 0
+
+    # Segmented sum of locations and normals in one reduceat over elements sorted by group
+    order, starts = group_by_labels(group_ids, num_groups)
+    counts = np.diff(starts)
+    data = np.concatenate((verts_co, verts_normal), axis=1).astype(np.float64)[order]
+    sums = np.zeros((num_groups, 6))
+    non_empty = counts > 0
+    if len(order):
+        sums[non_empty] = np.add.reduceat(data, starts[:-1][non_empty], axis=0)
+    means = sums / np.maximum(counts, 1)[:, np.newaxis]
+    centroids, mean_normals = means[:, :3], means[:, 3:]
+
+    rot_quats = quats_rotation_to_z(mean_normals)
+    # Only the first two rows of the rotation are needed for the flattened XY coordinates
+    rot_xy = quats_to_matrices(rot_quats)[:, :2]
+    valid = group_ids >= 0
+    flattened = np.zeros((len(group_ids), 2))
+    flattened[valid] = np.einsum("nij,nj->ni", rot_xy[group_ids[valid]], np.asarray(verts_co)[valid])
+    return mean_normals, centroids, rot_quats, flattened
+
+
+def mesh_groups_flattened(
+    mesh: bpy.types.Mesh, group_ids: np.ndarray, domain: str = "POINT", arrays: Optional[MeshArrays] = None
+):
+    """groups_flattened for vertex groups ids (domain "POINT") or face group ids (domain "FACE",
+    e.g. UV islands), face groups are computed over face corners and flattened coordinates are per corner"""
+    if arrays is None:
+        arrays = MeshArrays(mesh)
+    if domain == "POINT":
+        return groups_flattened(arrays.co, arrays.vert_normals, group_ids)
+    if domain == "FACE":
+        loops_vert = arrays.get("loops_vert")
+        loops_group = np.repeat(np.asarray(group_ids), arrays.get("loop_total"))
+        return groups_flattened(arrays.co[loops_vert], arrays.vert_normals[loops_vert], loops_group)
+    raise ValueError(f"Unsupported domain {domain!r}")
+
+
+def groups_alignment_matrices(centroids: np.ndarray, rot_quats: np.ndarray):
+    """(G, 4, 4) matrices placing an object at each group centroid rotated to the group plane,
+    like align_object_to_verts for an object with identity transform"""
+    matrices = np.zeros((len(centroids), 4, 4))
+    # Inverse of a unit quaternion rotation is its transpose
+    matrices[:, :3, :3] = quats_to_matrices(rot_quats).transpose(0, 2, 1)
+    matrices[:, :3, 3] = centroids
+    matrices[:, 3, 3] = 1
+    return matrices
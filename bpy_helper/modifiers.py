@@ -1,5 +1,5 @@
 import bpy
-from typing import List
+from typing import Iterable, List, Optional, Tuple
 
 
 def apply_modifiers(
@@ -7,28 +7,59 @@ def apply_modifiers(
     obj: bpy.types.Object,
     target_mods: List[bpy.types.Modifier],
 ):
-    for mod in target_mods:
-        assert mod.id_data == obj
+    apply_modifiers_batch(context, [(obj, target_mods)])
 
-    viewport_visibility_original = dict()
-    mod: bpy.types.Modifier
-    for mod in obj.modifiers:
-        viewport_visibility_original[mod] = mod.show_viewport
-        mod.show_viewport = False
-
-    for mod in target_mods:
-        mod.show_viewport = True
-
-    dg = context.evaluated_depsgraph_get()
-    mesh = bpy.data.meshes.new_from_object(obj.evaluated_get(dg))
-
-    for mod in target_mods:
-        obj.modifiers.remove(mod)
 
-    obj.data = mesh
+def apply_modifiers_batch(
+    context: bpy.types.Context,
+    targets: Iterable[Tuple[bpy.types.Object, List[bpy.types.Modifier]]],
+    free_replaced_meshes: bool = False,
+    chunk_size: Optional[int] = None,
+):
+    """Apply modifiers of many objects with a single depsgraph evaluation,
+    targets are (object, modifiers to apply) pairs, modifier visibility is set for all objects first
+    and restored afterwards. With free_replaced_meshes, meshes left without users are removed,
+    chunk_size evaluates that many objects at a time so freed memory is reused during the batch"""
+    targets = [(obj, list(mods)) for obj, mods in targets]
+    for obj, target_mods in targets:
+        for mod in target_mods:
+            assert mod.id_data == obj
+
+    if chunk_size is None:
+        chunk_size = max(len(targets), 1)
 
-    for mod in obj.modifiers:
-        mod.show_viewport = viewport_visibility_original[mod]
+    viewport_visibility_original = dict()
+    mod: bpy.types.Modifier
+    for obj, target_mods in targets:
+        for mod in obj.modifiers:
+            viewport_visibility_original[mod] = mod.show_viewport
+            mod.show_viewport = False
+        for mod in target_mods:
+            mod.show_viewport = True
+
+    try:
+        for chunk_start in range(0, len(targets), chunk_size):
+            chunk = targets[chunk_start : chunk_start + chunk_size]
+
+            # Extract all meshes before changing anything, so the evaluation stays valid
+            dg = context.evaluated_depsgraph_get()
+            new_meshes = [bpy.data.meshes.new_from_object(obj.evaluated_get(dg)) for obj, _ in chunk]
+
+            replaced_meshes = []
+            for (obj, target_mods), mesh in zip(chunk, new_meshes):
+                for mod in target_mods:
+                    viewport_visibility_original.pop(mod)
+                    obj.modifiers.remove(mod)
+                replaced_meshes.append(obj.data)
+                obj.data = mesh
+
+            if free_replaced_meshes:
+                for mesh in set(replaced_meshes):
+                    if mesh.users == 0:
+                        bpy.data.meshes.remove(mesh)
+    finally:
+        for mod, show_viewport in viewport_visibility_original.items():
+            mod.show_viewport = show_viewport
 
 
 def apply_modifier_by_name(obj: bpy.types.Object, modifier_name: str):
@@ -1,11 +1,22 @@
-from typing import List
+from typing import Iterable, List, Optional
 
 import bpy
+import numpy as np
 from mathutils import Matrix, Vector
 
 import bmesh
 
-from .bmesh.loose_parts import bm_loose_parts
+from .bmesh.loose_parts import LooseParts, mesh_loose_parts_labels
+from .mesh import (
+    _ATTRIBUTE_TYPES,
+    MeshArrays,
+    is_generic_attribute,
+    mesh_read_attributes,
+    mesh_set_geometry,
+    mesh_split_geometry,
+    mesh_write_attributes,
+    subset_attributes,
+)
 
 
 def obj_mesh_copy(obj: bpy.types.Object):
@@ -16,30 +27,187 @@ def obj_mesh_copy(obj: bpy.types.Object):
     return new_obj
 
 
-def obj_get_loose_parts(obj: bpy.types.Object):
-    bm = bmesh.new()
-    bm.from_mesh(obj.data)
-    loose_parts = [region.to_obj(obj.name) for region in bm_loose_parts(bm)]
-    bm.free()
-    return loose_parts
+def _obj_split_by_labels(
+    obj: bpy.types.Object,
+    arrays: MeshArrays,
+    vert_labels: np.ndarray,
+    edge_labels: np.ndarray,
+    face_labels: np.ndarray,
+    num_parts: int,
+    collection: Optional[bpy.types.Collection],
+):
+    mesh: bpy.types.Mesh = obj.data
+    attributes = mesh_read_attributes(mesh, arrays)
+    materials = list(mesh.materials)
+
+    part_objs = []
+    for part_geometry, part_indices in mesh_split_geometry(
+        *arrays.geometry(), vert_labels, edge_labels, face_labels, num_parts
+    ):
+        part_mesh = bpy.data.meshes.new(obj.name)
+        mesh_set_geometry(part_mesh, *part_geometry)
+        mesh_write_attributes(part_mesh, subset_attributes(attributes, *part_indices))
+        for material in materials:
+            part_mesh.materials.append(material)
+        part_obj = bpy.data.objects.new(obj.name, part_mesh)
+        part_obj.matrix_world = obj.matrix_world
+        part_objs.append(part_obj)
+
+    if collection is None:
+        for part_obj in part_objs:
+            part_obj.use_fake_user = True
+    else:
+        link = collection.objects.link
+        for part_obj in part_objs:
+            link(part_obj)
+    return part_objs
+
+
+def obj_split_by_vert_labels(
+    obj: bpy.types.Object, vert_labels: np.ndarray, collection: Optional[bpy.types.Collection] = None
+):
+    """Split a mesh object into one object per distinct vertex label (negative labels are dropped),
+    edges and faces with vertices of different labels are dropped, parts are ordered by label.
+    Parts are linked into collection when given, otherwise they get a fake user"""
+    assert obj.type == "MESH"
+    mesh: bpy.types.Mesh = obj.data
+    vert_labels = np.asarray(vert_labels)
+    assert len(vert_labels) == len(mesh.vertices)
+    arrays = MeshArrays(mesh)
+
+    # Compact labels to 0..num_parts - 1
+    valid = vert_labels >= 0
+    part_ids, compact = np.unique(vert_labels[valid], return_inverse=True)
+    labels = np.full(len(vert_labels), -1, dtype=np.int64)
+    labels[valid] = compact.ravel()
 
+    edges_labels = labels[arrays.get("edges_verts")]
+    edge_labels = np.where(edges_labels[:, 0] == edges_labels[:, 1], edges_labels[:, 0], -1)
 
-def obj_join_mesh_objects(objs: List[bpy.types.Object]):
-    bm = bmesh.new(use_operators=False)
+    face_labels = np.empty(0, dtype=np.int64)
+    if len(arrays.get("loop_start")):
+        loops_label = labels[arrays.get("loops_vert")]
+        faces_min = np.minimum.reduceat(loops_label, arrays.get("loop_start"))
+        faces_max = np.maximum.reduceat(loops_label, arrays.get("loop_start"))
+        face_labels = np.where(faces_min == faces_max, faces_min, -1)
 
+    return _obj_split_by_labels(obj, arrays, labels, edge_labels, face_labels, len(part_ids), collection)
+
+
+def obj_get_loose_parts(obj: bpy.types.Object, collection: Optional[bpy.types.Collection] = None):
+    """One object per loose part, see obj_split_by_vert_labels"""
+    mesh: bpy.types.Mesh = obj.data
+    arrays = MeshArrays(mesh)
+    num_parts, vert_labels, edge_labels, face_labels = mesh_loose_parts_labels(mesh, arrays)
+    return _obj_split_by_labels(obj, arrays, vert_labels, edge_labels, face_labels, num_parts, collection)
+
+
+def obj_join_mesh_objects(objs: List[bpy.types.Object], attribute_names: Optional[Iterable[str]] = None):
+    """Join mesh objects into a new object with world space geometry by concatenating their arrays,
+    every array is read with foreach_get straight into its slice of the joined buffers.
+    attribute_names limits the joined generic attributes (all by default),
+    objects missing an attribute get zero values, materials are merged (material_index is always joined
+    when there is more than one material)"""
     for obj in objs:
         if obj.type != "MESH":
-            bm.free()
             raise RuntimeError("Only mesh objects can be joined together")
-        bm.from_mesh(obj.data)
+    meshes = [obj.data for obj in objs]
+
+    # Attribute layout taken from the first mesh that has each attribute
+    specs = dict()
+    for mesh in meshes:
+        for attr in mesh.attributes:
+            if attr.name not in specs and is_generic_attribute(attr):
+                specs[attr.name] = (attr.data_type, attr.domain)
+    if attribute_names is not None:
+        attribute_names = set(attribute_names)
+        specs = {name: spec for name, spec in specs.items() if name in attribute_names}
+    # Faces of meshes without material indices use their first slot, always written when materials differ
+    if len({material for mesh in meshes for material in mesh.materials}) > 1:
+        specs["material_index"] = ("INT", "FACE")
+
+    counts = np.array(
+        [(len(mesh.vertices), len(mesh.edges), len(mesh.polygons), len(mesh.loops)) for mesh in meshes], dtype=np.int64
+    ).reshape(-1, 4)
+    offsets = np.zeros((len(meshes) + 1, 4), dtype=np.int64)
+    np.cumsum(counts, axis=0, out=offsets[1:])
+    num_verts, num_edges, num_faces, num_loops = offsets[-1].tolist()
+    domain_column = {"POINT": 0, "EDGE": 1, "FACE": 2, "CORNER": 3}
+
+    verts_co = np.empty((num_verts, 3), dtype=np.float32)
+    edges_verts = np.empty((num_edges, 2), dtype=np.int32)
+    faces_loop_start = np.empty(num_faces, dtype=np.int32)
+    faces_loop_total = np.empty(num_faces, dtype=np.int32)
+    loops_vert = np.empty(num_loops, dtype=np.int32)
+    loops_edge = np.empty(num_loops, dtype=np.int32)
+    attributes = []
+    for name, (data_type, domain) in specs.items():
+        _, num_components, dtype = _ATTRIBUTE_TYPES[data_type]
+        size = offsets[-1, domain_column[domain]]
+        attributes.append((name, data_type, domain, np.zeros((size, num_components), dtype=dtype)))
+
+    materials = []
+    material_index = dict()
+
+    for i, (obj, mesh) in enumerate(zip(objs, meshes)):
+        v0, e0, f0, l0 = offsets[i].tolist()
+        v1, e1, f1, l1 = offsets[i + 1].tolist()
+
+        mesh.vertices.foreach_get("co", verts_co[v0:v1].reshape(-1))
+        mesh.edges.foreach_get("vertices", edges_verts[e0:e1].reshape(-1))
+        mesh.polygons.foreach_get("loop_start", faces_loop_start[f0:f1])
+        mesh.polygons.foreach_get("loop_total", faces_loop_total[f0:f1])
+        mesh.loops.foreach_get("vertex_index", loops_vert[l0:l1])
+        mesh.loops.foreach_get("edge_index", loops_edge[l0:l1])
+
+        matrix = np.array(obj.matrix_world, dtype=np.float32)
+        co = verts_co[v0:v1]
+        co[:] = co @ matrix[:3, :3].T + matrix[:3, 3]
+        edges_verts[e0:e1] += v0
+        faces_loop_start[f0:f1] += l0
+        loops_vert[l0:l1] += v0
+        loops_edge[l0:l1] += e0
+
+        # Mirroring matrices flip the winding, reverse corners of each face keeping the first one
+        corner_order = None
+        if np.linalg.det(matrix[:3, :3]) < 0:
+            totals = faces_loop_total[f0:f1].repeat(faces_loop_total[f0:f1])
+            start = np.repeat(faces_loop_start[f0:f1] - l0, faces_loop_total[f0:f1])
+            local = np.arange(l1 - l0) - start
+            corner_order = start + (-local) % totals
+            loops_vert[l0:l1] = loops_vert[l0:l1][corner_order]
+            # Corner k now goes to the vertex that preceded it, along the edge of the preceding corner
+            loops_edge[l0:l1] = loops_edge[l0:l1][start + (-local - 1) % totals]
+
+        for name, data_type, domain, arr in attributes:
+            attr = mesh.attributes.get(name)
+            if attr is None or (attr.data_type, attr.domain) != (data_type, domain):
+                continue
+            column = domain_column[domain]
+            n0, n1 = offsets[i, column], offsets[i + 1, column]
+            attr.data.foreach_get(_ATTRIBUTE_TYPES[data_type][0], arr[n0:n1].reshape(-1))
+            if domain == "CORNER" and corner_order is not None:
+                arr[n0:n1] = arr[n0:n1][corner_order]
+
+        # Material indices are remapped to the merged material list
+        material_lut = np.zeros(max(len(mesh.materials), 1), dtype=np.int32)
+        for slot, material in enumerate(mesh.materials):
+            if material not in material_index:
+                material_index[material] = len(materials)
+                materials.append(material)
+            material_lut[slot] = material_index[material]
+        for name, _, _, arr in attributes:
+            if name == "material_index":
+                arr[f0:f1, 0] = material_lut[np.clip(arr[f0:f1, 0], 0, len(material_lut) - 1)]
 
     joined_mesh = bpy.data.meshes.new("Joined Mesh Object")
+    mesh_set_geometry(joined_mesh, verts_co, edges_verts, faces_loop_start, faces_loop_total, loops_vert, loops_edge)
+    mesh_write_attributes(joined_mesh, attributes)
+    for material in materials:
+        joined_mesh.materials.append(material)
+
     joined_obj = bpy.data.objects.new(joined_mesh.name, joined_mesh)
     joined_obj.use_fake_user = True
-    bm.to_mesh(joined_mesh)
-    joined_mesh.update()
-    bm.free()
-
     return joined_obj
 
 
@@ -113,17 +281,84 @@ def obj_copy_translation(obj_from: bpy.types.Object, obj_to: bpy.types.Object):
     obj_to.matrix_world.translation = obj_from.matrix_world.translation.copy()
 
 
-def obj_remove_small_parts(obj: bpy.types.Object):
-    assert obj.type == "MESH"
-    bm = bmesh.new(use_operators=False)
-    mesh: bpy.types.Mesh = obj.data
+def loose_parts_measure(parts: LooseParts, measure: str) -> np.ndarray:
+    """Size of every loose part by measure,
+    "BBOX_DIAGONAL", "VERTEX_COUNT", "AREA" or "VOLUME" (absolute enclosed volume)"""
+    if measure == "BBOX_DIAGONAL":
+        return np.linalg.norm(parts.bb_max - parts.bb_min, axis=1)
+    if measure == "VERTEX_COUNT":
+        return parts.vert_counts
+    if measure == "AREA":
+        return parts.areas
+    if measure == "VOLUME":
+        return np.abs(parts.volumes)
+    raise ValueError(f"Unsupported measure {measure!r}")
+
+
+def _mesh_remove_verts_bmesh(mesh: bpy.types.Mesh, verts_mask: np.ndarray):
+    """Remove masked vertices with their edges and faces in a BMesh round trip,
+    which keeps shape keys and vertex group weights"""
+    bm = bmesh.new()
     bm.from_mesh(mesh)
-    loose_parts = bm_loose_parts(bm)
-    for lp in loose_parts:
-        lp.update_bounding_box()
-    for lp in sorted(loose_parts, key=lambda lp: (lp.bb_max - lp.bb_min).length_squared)[:-1]:
-        for v in lp.verts:
-            bm.verts.remove(v)
+    bm.verts.ensure_lookup_table()
+    bmesh.ops.delete(bm, geom=[bm.verts[i] for i in np.flatnonzero(verts_mask).tolist()], context="VERTS")
     bm.to_mesh(mesh)
     mesh.update()
     bm.free()
+
+
+def obj_remove_small_parts(
+    obj: bpy.types.Object,
+    measure: str = "BBOX_DIAGONAL",
+    threshold: Optional[float] = None,
+    relative: bool = False,
+    keep_largest: Optional[int] = None,
+):
+    """Remove loose parts that are small by measure (see loose_parts_measure) in one mesh rebuild,
+    parts below threshold are removed, relative threshold is a fraction of the largest part measure,
+    keep_largest keeps at most that many of the largest remaining parts.
+    Without threshold and keep_largest only the largest part is kept. Returns number of removed parts.
+    The mesh is rebuilt from arrays with generic attributes and hide/select state, meshes with shape keys
+    or objects with vertex groups go through a BMesh instead, which keeps those"""
+    assert obj.type == "MESH"
+    mesh: bpy.types.Mesh = obj.data
+    arrays = MeshArrays(mesh)
+    parts = LooseParts.from_mesh(mesh, arrays)
+    if len(parts) == 0:
+        return 0
+
+    if threshold is None and keep_largest is None:
+        keep_largest = 1
+
+    sizes = loose_parts_measure(parts, measure)
+    keep_parts = np.ones(len(parts), dtype=bool)
+    if threshold is not None:
+        if relative:
+            threshold = threshold * sizes.max()
+        keep_parts &= sizes >= threshold
+    if keep_largest is not None:
+        # Stable order keeps the lowest part index among equal sizes, like argmax
+        largest = np.argsort(-sizes, kind="stable")
+        largest = largest[keep_parts[largest]][:keep_largest]
+        keep_parts[:] = False
+        keep_parts[largest] = True
+
+    num_removed = int(len(parts) - keep_parts.sum())
+    if num_removed == 0:
+        return 0
+
+    if mesh.shape_keys is not None or len(obj.vertex_groups) > 0:
+        _mesh_remove_verts_bmesh(mesh, ~keep_parts[parts.vert_labels])
+        return num_removed
+
+    def keep(labels):
+        included = labels >= 0
+        return np.where(included & keep_parts[np.where(included, labels, 0)], 0, -1)
+
+    attributes = mesh_read_attributes(mesh, arrays, include_state=True)
+    (kept_geometry, kept_indices), = mesh_split_geometry(
+        *parts.geometry, keep(parts.vert_labels), keep(parts.edge_labels), keep(parts.face_labels), 1
+    )
+    mesh_set_geometry(mesh, *kept_geometry)
+    mesh_write_attributes(mesh, subset_attributes(attributes, *kept_indices))
+    return num_removed
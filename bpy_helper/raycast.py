@@ -1,8 +1,14 @@
 from dataclasses import dataclass
+from typing import List, Optional
 
 import bpy
+import numpy as np
 from bpy_extras import view3d_utils
 from mathutils import Matrix, Vector
+from mathutils.bvhtree import BVHTree
+
+from .geometry_cache import obj_evaluated_geometry
+from .triangle_bvh import RayHitArrays, rays_aabb_intersect
 
 
 @dataclass(frozen=True)
@@ -33,3 +39,192 @@ def region_2d_to_ray_view3d(context: bpy.types.Context, x: int, y: int):
     ray_direction = view3d_utils.region_2d_to_vector_3d(region, region_view_3d, coord)
     ray_origin = view3d_utils.region_2d_to_origin_3d(region, region_view_3d, coord)
     return ray_origin, ray_direction
+
+
+def region_2d_to_rays(
+    coords: np.ndarray,
+    region_width: int,
+    region_height: int,
+    perspective_matrix,
+    view_matrix,
+    is_perspective: bool,
+    is_camera_view: bool = False,
+):
+    """(N, 3) world space ray origins and unit directions for (N, 2) region pixel coordinates,
+    same as view3d_utils.region_2d_to_origin_3d and region_2d_to_vector_3d for every coordinate.
+    Takes plain matrices and region size so it does not need a View3D region"""
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    persinv = np.linalg.inv(np.asarray(perspective_matrix, dtype=np.float64))
+    viewinv = np.linalg.inv(np.asarray(view_matrix, dtype=np.float64))
+    # Normalized device coordinates
+    dx = 2.0 * coords[:, 0] / region_width - 1.0
+    dy = 2.0 * coords[:, 1] / region_height - 1.0
+
+    if is_perspective:
+        ndc = np.stack((dx, dy, np.full(len(coords), -0.5), np.ones(len(coords))), axis=1)
+        points = ndc @ persinv.T
+        directions = points[:, :3] / points[:, 3:] - viewinv[:3, 3]
+        origins = np.broadcast_to(viewinv[:3, 3], directions.shape).copy()
+    else:
+        directions = np.broadcast_to(-viewinv[:3, 2], (len(coords), 3)).copy()
+        origins = dx[:, np.newaxis] * persinv[:3, 0] + dy[:, np.newaxis] * persinv[:3, 1] + persinv[:3, 3]
+        if not is_camera_view:
+            # Start at the near end of the view volume, the offset is scaled to the far clip already
+            origins -= persinv[:3, 2]
+
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    return origins, directions
+
+
+def region_2d_to_rays_view3d(context: bpy.types.Context, coords: np.ndarray):
+    """region_2d_to_rays for the region of context, matrices are read once"""
+    region = context.region
+    region_view_3d = context.region_data
+    return region_2d_to_rays(
+        coords,
+        region.width,
+        region.height,
+        region_view_3d.perspective_matrix,
+        region_view_3d.view_matrix,
+        region_view_3d.is_perspective,
+        region_view_3d.view_perspective == "CAMERA",
+    )
+
+
+def region_pixel_grid(region_width: int, region_height: int, step: int = 1):
+    """(N, 2) coordinates of every step-th pixel of a region, row by row from the bottom"""
+    ys, xs = np.mgrid[0:region_height:step, 0:region_width:step]
+    return np.stack((xs.ravel(), ys.ravel()), axis=1)
+
+
+def points_in_polygon_2d(points: np.ndarray, polygon: np.ndarray):
+    """Even-odd rule inside test of (N, 2) points against a closed (M, 2) polygon, one pass per polygon edge"""
+    points = np.asarray(points, dtype=np.float64)
+    polygon = np.asarray(polygon, dtype=np.float64)
+    x, y = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(polygon.tolist(), np.roll(polygon, -1, axis=0).tolist()):
+        if y0 == y1:
+            continue
+        crosses = (y0 > y) != (y1 > y)
+        inside ^= crosses & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+    return inside
+
+
+def lasso_pixel_coords(lasso: np.ndarray, region_width: int, region_height: int, step: int = 1):
+    """(N, 2) coordinates of every step-th region pixel inside a lasso polygon"""
+    lasso = np.asarray(lasso, dtype=np.float64)
+    x_min, y_min = np.maximum(np.floor(lasso.min(axis=0)), 0).astype(int)
+    x_max, y_max = np.minimum(np.ceil(lasso.max(axis=0)), (region_width - 1, region_height - 1)).astype(int)
+    ys, xs = np.mgrid[y_min : y_max + 1 : step, x_min : x_max + 1 : step]
+    coords = np.stack((xs.ravel(), ys.ravel()), axis=1)
+    return coords[points_in_polygon_2d(coords, lasso)]
+
+
+class RayHits(RayHitArrays):
+    """RayHitArrays of ray_cast_objects_batch with the objects that object_index refers to"""
+
+    __slots__ = ("objects",)
+
+    def __init__(self, num_rays: int, objects: List[bpy.types.Object]):
+        super().__init__(num_rays)
+        self.objects = objects
+
+    def __getitem__(self, index: int) -> RayHit:
+        if not self.is_hit[index]:
+            return RayHit(False, Vector(), Vector(), -1, None, Matrix())
+        obj = self.objects[self.object_index[index]]
+        return RayHit(
+            True,
+            Vector(self.location[index]),
+            Vector(self.normal[index]),
+            int(self.polygon_index[index]),
+            obj,
+            obj.matrix_world.copy(),
+        )
+
+
+# Estimated size of a BVHTree node (bounds of a 6-DOP and child pointers) per triangle
+_BVH_TREE_BYTES_PER_TRIANGLE = 96
+
+
+def obj_bvh_tree(obj: bpy.types.Object, depsgraph: Optional[bpy.types.Depsgraph] = None):
+    """BVHTree of the evaluated triangles in object space and the cached geometry it was built from,
+    the tree is kept with the geometry cache entry and rebuilt only when the object changes"""
+    geometry = obj_evaluated_geometry(obj, depsgraph)
+    bvh = geometry.derived.get("bvh_tree")
+    if bvh is None:
+        bvh = BVHTree.FromPolygons(geometry.verts_co.tolist(), geometry.tris.tolist(), all_triangles=True)
+        # The tree keeps its own copy of the vertices and triangles plus about one node per triangle
+        nbytes = geometry.verts_co.nbytes + geometry.tris.nbytes + len(geometry.tris) * _BVH_TREE_BYTES_PER_TRIANGLE
+        geometry.add_derived("bvh_tree", bvh, nbytes)
+    return bvh, geometry
+
+
+def ray_cast_objects_batch(
+    context: bpy.types.Context,
+    origins: np.ndarray,
+    directions: np.ndarray,
+    objects: Optional[List[bpy.types.Object]] = None,
+    max_distance: float = np.inf,
+) -> RayHits:
+    """Cast (N, 3) world space rays against mesh objects (visible mesh objects by default),
+    rays are only traced against objects whose bounding box they cross closer than the nearest hit so far"""
+    dg = context.evaluated_depsgraph_get()
+    if objects is None:
+        objects = [obj for obj in context.visible_objects if obj.type == "MESH"]
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    directions = directions / np.linalg.norm(directions, axis=1)[:, np.newaxis]
+
+    hits = RayHits(len(origins), objects)
+    hits.distance[:] = max_distance
+
+    for object_index, obj in enumerate(objects):
+        bvh, geometry = obj_bvh_tree(obj, dg)
+        if len(geometry.tris) == 0:
+            continue
+        aabb = geometry.derived.get("aabb")
+        if aabb is None:
+            aabb = (geometry.verts_co.min(axis=0), geometry.verts_co.max(axis=0))
+            geometry.add_derived("aabb", aabb, aabb[0].nbytes + aabb[1].nbytes)
+
+        matrix = np.array(obj.matrix_world)
+        matrix_inv = np.linalg.inv(matrix)
+        # Local directions are not normalized, so a local ray parameter equals the world distance
+        local_origins = origins @ matrix_inv[:3, :3].T + matrix_inv[:3, 3]
+        local_directions = directions @ matrix_inv[:3, :3].T
+
+        candidate, t_near, _ = rays_aabb_intersect(local_origins, local_directions, *aabb)
+        candidate &= t_near <= hits.distance
+        ray_indices = np.flatnonzero(candidate)
+        if len(ray_indices) == 0:
+            continue
+
+        local_lengths = np.linalg.norm(local_directions[ray_indices], axis=1)
+        ray_cast = bvh.ray_cast
+        found = []
+        for i, origin, direction, length in zip(
+            ray_indices.tolist(),
+            local_origins[ray_indices].tolist(),
+            local_directions[ray_indices].tolist(),
+            local_lengths.tolist(),
+        ):
+            location, normal, tri_index, distance = ray_cast(origin, direction, hits.distance[i] * length)
+            if location is not None:
+                found.append((i, *location, *normal, tri_index, distance / length))
+        if not found:
+            continue
+
+        found = np.array(found)
+        ray_index = found[:, 0].astype(np.int64)
+        hits.is_hit[ray_index] = True
+        hits.location[ray_index] = found[:, 1:4] @ matrix[:3, :3].T + matrix[:3, 3]
+        world_normals = found[:, 4:7] @ matrix_inv[:3, :3]
+        hits.normal[ray_index] = world_normals / np.linalg.norm(world_normals, axis=1)[:, np.newaxis]
+        hits.polygon_index[ray_index] = geometry.tri_polygons[found[:, 7].astype(np.int64)]
+        hits.object_index[ray_index] = object_index
+        hits.distance[ray_index] = found[:, 8]
+
+    hits.distance[~hits.is_hit] = np.inf
+    return hits
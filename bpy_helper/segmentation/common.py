@@ -1,20 +1,28 @@
+from typing import Optional
+
 import bpy
 import numpy as np
 
+from ..mesh import MeshArrays
 
-def pca(points: np.ndarray):
-    cov_mat = np.cov(points, rowvar=False, bias=True)
+
+def pca_from_covariance(cov_mat: np.ndarray):
+    """Eigenvector basis (columns, ascending eigenvalues) of a (3, 3) covariance matrix
+    or a stack of them with shape (S, 3, 3)"""
     eig_vals, eig_vecs = np.linalg.eigh(cov_mat)
 
     # ensure right-handed basis
     d = np.sign(np.linalg.det(eig_vecs))
-    if d < 0:
-        eig_vecs[:, 2] *= -1
+    eig_vecs[..., 2] *= np.where(d < 0, -1, 1)[..., np.newaxis]
 
     change_of_basis_mat: np.ndarray = eig_vecs
     return change_of_basis_mat
 
 
+def pca(points: np.ndarray):
+    return pca_from_covariance(np.cov(points, rowvar=False, bias=True))
+
+
 def pca_aligned_span(points: np.ndarray):
     """Returns PCA aligned bounding box dimensions and change of basis matrix"""
     change_of_basis_mat = pca(points)
@@ -47,15 +55,14 @@ def longest_span_direction(points: np.ndarray):
     return longest_span_direction
 
 
-def max_face_normal_by_global_z(obj: bpy.types.Object) -> np.ndarray:
+def max_face_normal_by_global_z(obj: bpy.types.Object, arrays: Optional[MeshArrays] = None) -> np.ndarray:
     up_vec = obj.matrix_world.col[2]
-    faces = obj.data.polygons
-    if len(faces) == 0:
+    if len(obj.data.polygons) == 0:
         raise RuntimeError(f"{obj} has 0 faces")
-    face_normals_arr = np.empty(len(faces) * 3)
-    faces.foreach_get("normal", face_normals_arr)
-    face_normals_arr.shape = -1, 3
-    return face_normals_arr[face_normals_arr.dot(up_vec).argmax()]
+    if arrays is None:
+        arrays = MeshArrays(obj.data)
+    face_normals_arr = arrays.face_normals
+    return face_normals_arr[face_normals_arr.dot(np.array(up_vec[:3], dtype=np.float32)).argmax()]
 
 
 def flatten(points: np.ndarray):
@@ -0,0 +1,146 @@
+from typing import Optional
+
+import bpy
+import numpy as np
+
+from ..mesh import MeshArrays
+from ..timer import span
+from .common import pca_from_covariance
+
+
+def face_adjacency_csr(faces_loop_total: np.ndarray, loops_edge: np.ndarray):
+    """Faces sharing an edge as a CSR graph, neighbours of face f are indices[indptr[f]:indptr[f + 1]],
+    loops must be in face order"""
+    num_faces = len(faces_loop_total)
+    loop_face = np.repeat(np.arange(num_faces), faces_loop_total)
+    order = np.argsort(loops_edge, kind="stable")
+    sorted_edges = loops_edge[order]
+    sorted_faces = loop_face[order]
+
+    # Pair every loop with every loop of the same edge (handles non-manifold edges)
+    edge_start = np.flatnonzero(np.r_[True, sorted_edges[1:] != sorted_edges[:-1]])
+    edge_count = np.diff(np.r_[edge_start, len(sorted_edges)])
+    loop_start = np.repeat(edge_start, edge_count)
+    loop_count = np.repeat(edge_count, edge_count)
+    src = np.repeat(np.arange(len(sorted_edges)), loop_count)
+    dst = np.repeat(loop_start, loop_count) + np.arange(len(src)) - np.repeat(np.cumsum(loop_count) - loop_count, loop_count)
+    a, b = sorted_faces[src], sorted_faces[dst]
+
+    # Faces sharing several edges are linked once
+    keys = np.sort(a[a != b].astype(np.int64) * num_faces + b[a != b])
+    keys = keys[np.r_[True, keys[1:] != keys[:-1]][: len(keys)]]
+    a, b = keys // num_faces, keys % num_faces
+
+    indptr = np.zeros(num_faces + 1, dtype=np.int64)
+    np.cumsum(np.bincount(a, minlength=num_faces), out=indptr[1:])
+    return indptr, b.astype(np.int32)
+
+
+def faces_curvature(faces_normal: np.ndarray, indptr: np.ndarray, indices: np.ndarray):
+    """Mean angle in radians between each face normal and the normals of its neighbours, zero for isolated faces"""
+    face = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    angles = np.arccos(np.clip(np.einsum("ij,ij->i", faces_normal[face], faces_normal[indices]), -1.0, 1.0))
+    degree = np.diff(indptr)
+    return np.bincount(face, weights=angles, minlength=len(degree)) / np.maximum(degree, 1)
+
+
+def _csr_neighbours(indptr: np.ndarray, indices: np.ndarray, faces: np.ndarray):
+    """Concatenated neighbours of faces in a CSR graph"""
+    counts = indptr[faces + 1] - indptr[faces]
+    offsets = np.repeat(indptr[faces] - np.cumsum(counts) + counts, counts)
+    return indices[offsets + np.arange(len(offsets))]
+
+
+def region_growing(
+    faces_normal: np.ndarray,
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    max_angle: float,
+    max_curvature: Optional[float] = None,
+):
+    """Grow face regions from seeds, smoothest unlabelled face first (see faces_curvature),
+    a region takes an unlabelled neighbouring face if its normal deviates less than max_angle (radians)
+    from the region normal (mean normal of the region faces so far), so a region does not drift along
+    a curved surface and cylinders or spheres are split. Faces with curvature above max_curvature join
+    regions but do not grow them further. Each frontier (all faces taken in the last step) is expanded at once.
+    Returns (number of regions, per-face labels), regions are numbered in the order they are grown"""
+    num_faces = len(faces_normal)
+    faces_normal = np.asarray(faces_normal, dtype=np.float64)
+    cos_max_angle = np.cos(max_angle)
+    with span("region_growing.seeds"):
+        curvature = faces_curvature(faces_normal, indptr, indices)
+        seeds = np.argsort(curvature, kind="stable")
+        grows = np.ones(num_faces, dtype=bool) if max_curvature is None else curvature <= max_curvature
+        # A seed without any neighbour within max_angle of its own normal stays a single face region
+        face = np.repeat(np.arange(num_faces), np.diff(indptr))
+        smooth = np.einsum("ij,ij->i", faces_normal[face], faces_normal[indices]) >= cos_max_angle
+        isolated = np.bincount(face[smooth], minlength=num_faces) == 0
+
+    labels = np.full(num_faces, -1, dtype=np.int64)
+    num_regions = 0
+    with span("region_growing.frontier"):
+        for seed in seeds.tolist():
+            if labels[seed] >= 0:
+                continue
+            labels[seed] = num_regions
+            if isolated[seed]:
+                num_regions += 1
+                continue
+            normal_sum = faces_normal[seed].copy()
+            frontier = np.array([seed]) if grows[seed] else np.empty(0, dtype=np.int64)
+            while len(frontier):
+                neighbours = _csr_neighbours(indptr, indices, frontier)
+                neighbours = np.unique(neighbours[labels[neighbours] < 0])
+                region_normal = normal_sum / max(np.linalg.norm(normal_sum), 1e-30)
+                taken = neighbours[faces_normal[neighbours].dot(region_normal) >= cos_max_angle]
+                labels[taken] = num_regions
+                normal_sum += faces_normal[taken].sum(axis=0)
+                frontier = taken[grows[taken]]
+            num_regions += 1
+    return num_regions, labels
+
+
+def segments_pca_frames(labels: np.ndarray, num_segments: int, points: np.ndarray, weights: np.ndarray = None):
+    """Weighted centroids (S, 3) and PCA bases (S, 3, 3) (see pca) of points grouped by segment labels,
+    computed with segmented sums instead of one pca call per segment"""
+    points = np.asarray(points, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(len(points))
+    # Center around the global mean for a numerically stable covariance
+    offset = points.mean(axis=0)
+    points = points - offset
+
+    total = np.maximum(np.bincount(labels, weights=weights, minlength=num_segments), 1e-30)
+    centroids = np.stack(
+        [np.bincount(labels, weights=weights * points[:, i], minlength=num_segments) for i in range(3)], axis=1
+    )
+    centroids /= total[:, np.newaxis]
+
+    cov = np.empty((num_segments, 3, 3))
+    for i in range(3):
+        for j in range(i, 3):
+            second_moment = np.bincount(labels, weights=weights * points[:, i] * points[:, j], minlength=num_segments)
+            cov[:, i, j] = cov[:, j, i] = second_moment / total - centroids[:, i] * centroids[:, j]
+
+    return centroids + offset, pca_from_covariance(cov)
+
+
+def mesh_segment_regions(
+    mesh: bpy.types.Mesh,
+    max_angle: float,
+    max_curvature: Optional[float] = None,
+    arrays: Optional[MeshArrays] = None,
+):
+    """Segment mesh faces with region_growing, returns number of segments, per-face labels,
+    and area weighted face center centroids and PCA frames of the segments"""
+    if arrays is None:
+        arrays = MeshArrays(mesh)
+    with span("mesh_segment_regions"):
+        with span("mesh_segment_regions.adjacency"):
+            indptr, indices = face_adjacency_csr(arrays.get("loop_total"), arrays.get("loops_edge"))
+        num_segments, labels = region_growing(arrays.face_normals, indptr, indices, max_angle, max_curvature)
+        with span("mesh_segment_regions.pca"):
+            centroids, frames = segments_pca_frames(
+                labels, num_segments, arrays.get("face_centers"), arrays.get("face_areas")
+            )
+    return num_segments, labels, centroids, frames
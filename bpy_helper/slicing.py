@@ -0,0 +1,188 @@
+from typing import List, Sequence
+
+import bpy
+import numpy as np
+from mathutils.geometry import delaunay_2d_cdt
+
+from .bmesh.loose_parts import connected_components
+from .timer import span
+
+
+class MeshSlices:
+    """Contours of all slicing planes, stored as one points array in contour order,
+    contour i is points[contour_starts[i]:contour_starts[i + 1]] and lies on plane contour_layers[i]"""
+
+    __slots__ = ("plane_normal", "offsets", "points", "contour_starts", "contour_layers", "contour_closed")
+
+    def __init__(self, plane_normal, offsets, points, contour_starts, contour_layers, contour_closed):
+        self.plane_normal = plane_normal
+        self.offsets = offsets
+        self.points = points
+        self.contour_starts = contour_starts
+        self.contour_layers = contour_layers
+        self.contour_closed = contour_closed
+
+    def __len__(self):
+        return len(self.contour_layers)
+
+    def contour(self, index: int) -> np.ndarray:
+        return self.points[self.contour_starts[index] : self.contour_starts[index + 1]]
+
+    def layer_contours(self, layer: int) -> List[np.ndarray]:
+        """(M, 3) point arrays of all contours on a plane"""
+        return [self.contour(i) for i in np.flatnonzero(self.contour_layers == layer).tolist()]
+
+
+def _chain_segments(num_nodes: int, segments: np.ndarray):
+    """Order nodes of segment chains (each node has at most one successor and one predecessor),
+    returns node order, per-chain start offsets and whether each chain is closed"""
+    num_chains, chain_labels = connected_components(num_nodes, segments)
+
+    pred = np.full(num_nodes, -1, dtype=np.int64)
+    pred[segments[:, 1]] = segments[:, 0]
+
+    # Open chains start at the node without predecessor, closed chains are cut at their lowest node
+    chain_open = np.zeros(num_chains, dtype=bool)
+    chain_open[chain_labels[pred < 0]] = True
+    first_node = np.full(num_chains, num_nodes, dtype=np.int64)
+    np.minimum.at(first_node, chain_labels, np.arange(num_nodes))
+    head = (pred < 0) | (~chain_open[chain_labels] & (np.arange(num_nodes) == first_node[chain_labels]))
+
+    # List ranking by pointer jumping, rank is the distance from the chain head
+    pred = np.where(head, np.arange(num_nodes), pred)
+    rank = np.where(head, 0, 1)
+    while True:
+        pred_pred = pred[pred]
+        if np.array_equal(pred_pred, pred):
+            break
+        rank = rank + rank[pred]
+        pred = pred_pred
+
+    order = np.lexsort((rank, chain_labels))
+    counts = np.bincount(chain_labels, minlength=num_chains)
+    chain_starts = np.zeros(num_chains + 1, dtype=np.int64)
+    np.cumsum(counts, out=chain_starts[1:])
+    return order, chain_starts, ~chain_open, chain_labels
+
+
+def slice_triangles(verts_co: np.ndarray, tris: np.ndarray, plane_normal, offsets: Sequence[float]) -> MeshSlices:
+    """Intersect a triangle mesh with many parallel planes (plane_normal . x = offset) in one sweep,
+    each triangle is only intersected with the planes its extent along the normal spans,
+    contours of closed meshes with outward normals are counter-clockwise seen from the plane normal side"""
+    verts_co = np.asarray(verts_co, dtype=np.float64)
+    tris = np.asarray(tris, dtype=np.int64).reshape(-1, 3)
+    plane_normal = np.asarray(plane_normal, dtype=np.float64)
+    plane_normal = plane_normal / np.linalg.norm(plane_normal)
+    offsets = np.sort(np.asarray(offsets, dtype=np.float64))
+
+    with span("slice_triangles.intersect"):
+        heights = verts_co.dot(plane_normal)
+        tri_heights = heights[tris]
+
+        # A vertex counts as above a plane if height >= offset, so a triangle crosses planes in (min, max]
+        first_plane = np.searchsorted(offsets, tri_heights.min(axis=1), side="right")
+        end_plane = np.searchsorted(offsets, tri_heights.max(axis=1), side="right")
+        counts = end_plane - first_plane
+
+        pair_tri = np.repeat(np.arange(len(tris)), counts)
+        pair_starts = np.cumsum(counts) - counts
+        pair_plane = first_plane[pair_tri] + np.arange(len(pair_tri)) - np.repeat(pair_starts, counts)
+
+        above = tri_heights[pair_tri] >= offsets[pair_plane][:, np.newaxis]
+        # Edge i goes from corner i to corner i + 1, enter: below -> above, leave: above -> below
+        above_next = np.roll(above, -1, axis=1)
+        leave_edge = (above & ~above_next).argmax(axis=1)
+        enter_edge = (~above & above_next).argmax(axis=1)
+
+        pair_index = np.arange(len(pair_tri))
+        tri_verts = tris[pair_tri]
+
+        def edge_verts(edge):
+            return tri_verts[pair_index, edge], tri_verts[pair_index, (edge + 1) % 3]
+
+        # Segment runs from the leaving edge to the entering edge
+        seg_start = np.stack(edge_verts(leave_edge), axis=1)
+        seg_end = np.stack(edge_verts(enter_edge), axis=1)
+        seg_edges = np.stack((seg_start, seg_end), axis=1)
+
+    with span("slice_triangles.weld"):
+        # Points are shared by triangles through their (plane, edge) key
+        edge_keys = np.sort(seg_edges, axis=2).reshape(-1, 2)
+        keys = np.stack((np.repeat(pair_plane, 2), edge_keys[:, 0], edge_keys[:, 1]), axis=1)
+        unique_keys, node_index = np.unique(keys, axis=0, return_inverse=True)
+        node_index = node_index.reshape(-1, 2)
+
+        node_plane = unique_keys[:, 0]
+        p = verts_co[unique_keys[:, 1]]
+        q = verts_co[unique_keys[:, 2]]
+        hp = heights[unique_keys[:, 1]]
+        hq = heights[unique_keys[:, 2]]
+        t = (offsets[node_plane] - hp) / np.where(hq == hp, 1, hq - hp)
+        node_co = p + t[:, np.newaxis] * (q - p)
+
+    with span("slice_triangles.chain"):
+        order, contour_starts, contour_closed, _ = _chain_segments(len(unique_keys), node_index)
+
+    return MeshSlices(
+        plane_normal,
+        offsets,
+        node_co[order],
+        contour_starts,
+        node_plane[order[contour_starts[:-1]]],
+        contour_closed,
+    )
+
+
+def mesh_read_triangles(mesh: bpy.types.Mesh):
+    """Vertex locations and loop triangle vertex indices of a mesh as arrays"""
+    verts_co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", verts_co)
+    verts_co.shape = -1, 3
+
+    mesh.calc_loop_triangles()
+    tris = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("vertices", tris)
+    tris.shape = -1, 3
+    return verts_co, tris
+
+
+def slice_mesh(mesh: bpy.types.Mesh, plane_normal, offsets: Sequence[float]) -> MeshSlices:
+    """slice_triangles for a mesh, in mesh local space"""
+    return slice_triangles(*mesh_read_triangles(mesh), plane_normal, offsets)
+
+
+def _plane_basis(plane_normal: np.ndarray):
+    u = np.cross(plane_normal, (1.0, 0.0, 0.0))
+    if np.linalg.norm(u) < 0.1:
+        u = np.cross(plane_normal, (0.0, 1.0, 0.0))
+    u /= np.linalg.norm(u)
+    v = np.cross(plane_normal, u)
+    return u, v
+
+
+def triangulate_layer_cap(slices: MeshSlices, layer: int, output_type: int = 1, epsilon: float = 0.00001):
+    """Triangulate contours of one layer with delaunay_2d_cdt (same settings as bisect_fill),
+    returns (M, 3) vertex locations and (F, 3) triangle vertex indices"""
+    contour_indices = np.flatnonzero(slices.contour_layers == layer)
+    if len(contour_indices) == 0:
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+
+    points = [slices.contour(i) for i in contour_indices.tolist()]
+    edges = []
+    offset = 0
+    for i, contour in zip(contour_indices.tolist(), points):
+        n = len(contour)
+        index = np.arange(offset, offset + n)
+        next_index = np.roll(index, -1) if slices.contour_closed[i] else index[1:]
+        edges.append(np.stack((index[: len(next_index)], next_index), axis=1))
+        offset += n
+    points = np.concatenate(points)
+    edges = np.concatenate(edges)
+
+    u, v = _plane_basis(slices.plane_normal)
+    points_2d = np.stack((points.dot(u), points.dot(v)), axis=1)
+
+    verts_co, _, faces, _, _, _ = delaunay_2d_cdt(points_2d.tolist(), edges.tolist(), [], output_type, epsilon)
+    verts_2d = np.array(verts_co, dtype=np.float64).reshape(-1, 2)
+    verts_3d = verts_2d[:, :1] * u + verts_2d[:, 1:] * v + slices.offsets[layer] * slices.plane_normal
+    return verts_3d, np.array([f for f in faces if len(f) == 3], dtype=np.int64).reshape(-1, 3)
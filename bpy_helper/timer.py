@@ -1,5 +1,11 @@
-from contextlib import contextmanager
+import json
+import os
+import threading
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager, nullcontext
 from timeit import default_timer
+from typing import Deque, Dict, List, Optional, Tuple
 
 
 @contextmanager
@@ -8,3 +14,172 @@ def timer(msg: str):
     yield
     t1 = default_timer()
     print(f"{msg} finished in {t1 - t0:.4f} seconds.")
+
+
+class SpanStats:
+    """Accumulated timings of a span at one position (path of parent span names) in the span tree"""
+
+    __slots__ = ("path", "count", "total", "min", "max", "allocated_bytes")
+
+    def __init__(self, path: Tuple[str, ...]):
+        self.path = path
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.allocated_bytes = 0
+
+    @property
+    def name(self):
+        return self.path[-1]
+
+    @property
+    def parent(self):
+        return self.path[:-1]
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def add(self, duration: float, allocated_bytes: int):
+        self.count += 1
+        self.total += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+        self.allocated_bytes += allocated_bytes
+
+
+class Profiler:
+    """Records nested spans while active, use as a context manager or with enable_profiling/disable_profiling,
+    track_allocations uses tracemalloc to record net allocated bytes per span (slow),
+    only the last max_events trace events are kept (all if None), stats cover every span"""
+
+    def __init__(self, track_allocations: bool = False, max_events: Optional[int] = 100000):
+        self.track_allocations = track_allocations
+        self.stats: Dict[Tuple[str, ...], SpanStats] = dict()
+        self.events: Deque[dict] = deque(maxlen=max_events)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._t0 = default_timer()
+        self._started_tracemalloc = False
+        self._previous: Optional["Profiler"] = None
+
+    def __enter__(self):
+        self._previous = _active_profiler
+        enable_profiling(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        disable_profiling()
+        if self._previous is not None:
+            enable_profiling(self._previous)
+        self._previous = None
+
+    def _stack(self) -> List[str]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name: str):
+        stack = self._stack()
+        stack.append(name)
+        path = tuple(stack)
+        mem0 = tracemalloc.get_traced_memory()[0] if self.track_allocations else 0
+        t0 = default_timer()
+        try:
+            yield
+        finally:
+            t1 = default_timer()
+            allocated = tracemalloc.get_traced_memory()[0] - mem0 if self.track_allocations else 0
+            stack.pop()
+            with self._lock:
+                stats = self.stats.get(path)
+                if stats is None:
+                    stats = self.stats[path] = SpanStats(path)
+                stats.add(t1 - t0, allocated)
+                self.events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (t0 - self._t0) * 1e6,
+                        "dur": (t1 - t0) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "args": {"allocated_bytes": allocated},
+                    }
+                )
+
+    def clear(self):
+        """Drop recorded stats and trace events"""
+        with self._lock:
+            self.stats.clear()
+            self.events.clear()
+
+    def children(self, path: Tuple[str, ...] = ()):
+        """Stats of spans directly nested in span at path, top level spans if path is empty"""
+        return [stats for stats in self.stats.values() if stats.parent == path]
+
+    def by_name(self) -> Dict[str, SpanStats]:
+        """Stats merged over all positions of each span name in the span tree"""
+        merged = dict()
+        for stats in self.stats.values():
+            total = merged.get(stats.name)
+            if total is None:
+                total = merged[stats.name] = SpanStats((stats.name,))
+            total.count += stats.count
+            total.total += stats.total
+            total.min = min(total.min, stats.min)
+            total.max = max(total.max, stats.max)
+            total.allocated_bytes += stats.allocated_bytes
+        return merged
+
+    def report(self) -> str:
+        lines = [f"{'span':<48}{'count':>8}{'total':>12}{'mean':>12}{'min':>12}{'max':>12}{'bytes':>14}"]
+        for path in sorted(self.stats):
+            stats = self.stats[path]
+            label = "  " * (len(path) - 1) + stats.name
+            lines.append(
+                f"{label:<48}{stats.count:>8}{stats.total:>12.6f}{stats.mean:>12.6f}"
+                f"{stats.min:>12.6f}{stats.max:>12.6f}{stats.allocated_bytes:>14}"
+            )
+        return "\n".join(lines)
+
+    def to_chrome_trace(self) -> dict:
+        """Trace in Chrome trace event format, can be opened in chrome://tracing or Perfetto"""
+        with self._lock:
+            return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, filepath: str):
+        with open(filepath, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+_active_profiler: Optional[Profiler] = None
+_NULL_SPAN = nullcontext()
+
+
+def enable_profiling(profiler: Profiler):
+    global _active_profiler
+    if profiler.track_allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        profiler._started_tracemalloc = True
+    _active_profiler = profiler
+
+
+def disable_profiling():
+    global _active_profiler
+    profiler = _active_profiler
+    _active_profiler = None
+    if profiler is not None and profiler._started_tracemalloc:
+        tracemalloc.stop()
+        profiler._started_tracemalloc = False
+
+
+def span(name: str):
+    """Time the enclosed block as a span of the active profiler,
+    returns a shared no-op context manager when profiling is disabled"""
+    if _active_profiler is None:
+        return _NULL_SPAN
+    return _active_profiler.span(name)
@@ -0,0 +1,454 @@
+from timeit import default_timer as timer
+from typing import Optional
+
+import numpy as np
+
+from .timer import span
+
+
+class RayHitArrays:
+    """Results of a batch of queries with the RayHit fields as arrays, objects are referenced by index,
+    polygon_index and object_index are -1 where nothing was hit"""
+
+    __slots__ = ("is_hit", "location", "normal", "polygon_index", "object_index", "distance")
+
+    def __init__(self, num_rays: int):
+        self.is_hit = np.zeros(num_rays, dtype=bool)
+        self.location = np.zeros((num_rays, 3))
+        self.normal = np.zeros((num_rays, 3))
+        self.polygon_index = np.full(num_rays, -1, dtype=np.int32)
+        self.object_index = np.full(num_rays, -1, dtype=np.int32)
+        self.distance = np.full(num_rays, np.inf)
+
+    def __len__(self):
+        return len(self.is_hit)
+
+
+def rays_aabb_intersect(origins: np.ndarray, directions: np.ndarray, bb_min: np.ndarray, bb_max: np.ndarray):
+    """Slab test of rays against axis aligned boxes (one box or one per ray), returns (hit mask, entry distance,
+    exit distance), distances are in units of the direction length"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv_dir = 1.0 / directions
+        t0 = (bb_min - origins) * inv_dir
+        t1 = (bb_max - origins) * inv_dir
+    # Rays parallel to a slab and inside it give nan, they must not limit the interval
+    t_near = np.max(np.where(np.isnan(t0), -np.inf, np.minimum(t0, t1)), axis=1)
+    t_far = np.min(np.where(np.isnan(t0), np.inf, np.maximum(t0, t1)), axis=1)
+    return (t_near <= t_far) & (t_far >= 0), t_near, t_far
+
+
+def rays_triangles_intersect(
+    origins: np.ndarray, directions: np.ndarray, v0: np.ndarray, e1: np.ndarray, e2: np.ndarray, epsilon=1e-12
+):
+    """Möller-Trumbore for pairs of rays and triangles (first vertex and two edge vectors), double sided,
+    returns ray distance of each pair, inf where the ray misses"""
+    p = np.cross(directions, e2)
+    det = np.einsum("ij,ij->i", e1, p)
+    valid = np.abs(det) > epsilon
+    inv_det = 1.0 / np.where(valid, det, 1.0)
+    s = origins - v0
+    u = np.einsum("ij,ij->i", s, p) * inv_det
+    q = np.cross(s, e1)
+    v = np.einsum("ij,ij->i", directions, q) * inv_det
+    t = np.einsum("ij,ij->i", e2, q) * inv_det
+    valid &= (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+    return np.where(valid, t, np.inf)
+
+
+def closest_points_on_segments(points: np.ndarray, a: np.ndarray, b: np.ndarray):
+    """Closest point on each segment (a, b) to each point, pairwise, zero length segments give a"""
+    ab = b - a
+    length_sq = np.einsum("...j,...j->...", ab, ab)
+    t = np.einsum("...j,...j->...", points - a, ab) / np.where(length_sq > 0, length_sq, 1)
+    return a + ab * np.clip(t, 0, 1)[..., np.newaxis]
+
+
+def closest_points_on_triangles(points: np.ndarray, a: np.ndarray, b: np.ndarray, c: np.ndarray):
+    """Closest point on each triangle (a, b, c) to each point, pairwise (Ericson, Real-Time Collision Detection),
+    degenerate triangles (collapsed edges, collinear vertices) are treated as their three edges"""
+
+    def dot(x, y):
+        return np.einsum("ij,ij->i", x, y)
+
+    ab = b - a
+    ac = c - a
+    ap = points - a
+    bp = points - b
+    cp = points - c
+    d1, d2 = dot(ab, ap), dot(ac, ap)
+    d3, d4 = dot(ab, bp), dot(ac, bp)
+    d5, d6 = dot(ab, cp), dot(ac, cp)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    def ratio(numerator, denominator):
+        return (numerator / np.where(denominator > 0, denominator, 1))[:, np.newaxis]
+
+    # va + vb + vc is the squared length of ab x ac, the region tests below are only reliable
+    # when it is not vanishing relative to the edge lengths
+    denom = va + vb + vc
+    degenerate = denom <= 1e-10 * dot(ab, ab) * dot(ac, ac)
+    result = a + ab * ratio(vb, denom) + ac * ratio(vc, denom)
+
+    # Voronoi regions in reverse order of precedence, so earlier tests win
+    regions = (
+        ((va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0), lambda: b + (c - b) * ratio(d4 - d3, (d4 - d3) + (d5 - d6))),
+        ((vb <= 0) & (d2 >= 0) & (d6 <= 0), lambda: a + ac * ratio(d2, d2 - d6)),
+        ((d6 >= 0) & (d5 <= d6), lambda: c),
+        ((vc <= 0) & (d1 >= 0) & (d3 <= 0), lambda: a + ab * ratio(d1, d1 - d3)),
+        ((d3 >= 0) & (d4 <= d3), lambda: b),
+        ((d1 <= 0) & (d2 <= 0), lambda: a),
+    )
+    for mask, region_point in regions:
+        if mask.any():
+            result[mask] = region_point()[mask]
+
+    if degenerate.any():
+        p, edges = points[degenerate], (a[degenerate], b[degenerate], c[degenerate])
+        candidates = np.stack([closest_points_on_segments(p, edges[i], edges[i - 1]) for i in range(3)])
+        nearest = ((candidates - p) ** 2).sum(axis=2).argmin(axis=0)
+        result[degenerate] = candidates[nearest, np.arange(len(p))]
+    return result
+
+
+def _segments(starts: np.ndarray, counts: np.ndarray):
+    """Segment index and position of every element of consecutive ranges [start, start + count)"""
+    seg = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    return seg, np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+
+
+class TriangleBVH:
+    """Bounding volume hierarchy over triangles in flat node arrays, built with median splits along
+    the longest centroid extent, all nodes of a level are split together in one sort.
+    Node i covers triangles tri_order[node_start[i]:node_start[i] + node_count[i]],
+    inner nodes have children node_left[i] and node_left[i] + 1, leaves have node_left[i] == -1"""
+
+    __slots__ = (
+        "tri_polygons",
+        "tri_order",
+        "tri_v0",
+        "tri_e1",
+        "tri_e2",
+        "tri_normals",
+        "node_bb_min",
+        "node_bb_max",
+        "node_left",
+        "node_start",
+        "node_count",
+    )
+
+    def __init__(self, verts_co: np.ndarray, tris: np.ndarray, tri_polygons: Optional[np.ndarray] = None, leaf_size=4):
+        tris = np.asarray(tris, dtype=np.int64).reshape(-1, 3)
+        if len(tris) == 0:
+            raise ValueError("At least one triangle is needed to build a BVH")
+        tri_co = np.asarray(verts_co, dtype=np.float64)[tris]
+        self.tri_polygons = np.arange(len(tris)) if tri_polygons is None else np.asarray(tri_polygons)
+        self.tri_v0 = tri_co[:, 0]
+        self.tri_e1 = tri_co[:, 1] - tri_co[:, 0]
+        self.tri_e2 = tri_co[:, 2] - tri_co[:, 0]
+        normals = np.cross(self.tri_e1, self.tri_e2)
+        lengths = np.linalg.norm(normals, axis=1)
+        self.tri_normals = normals / np.where(lengths > 0, lengths, 1)[:, np.newaxis]
+
+        with span("triangle_bvh.build"):
+            self._build(tri_co, leaf_size)
+
+    def _build(self, tri_co: np.ndarray, leaf_size: int):
+        centroids = tri_co.mean(axis=1)
+        order = np.arange(len(tri_co))
+
+        level = np.array([0])
+        starts = np.array([0])
+        counts = np.array([len(tri_co)])
+        all_starts = [starts]
+        all_counts = [counts]
+        parents, lefts = [], []
+        num_nodes = 1
+
+        while True:
+            split = counts > leaf_size
+            if not split.any():
+                break
+            split_nodes, split_starts, split_counts = level[split], starts[split], counts[split]
+            seg, pos = _segments(split_starts, split_counts)
+            tri = order[pos]
+            c = centroids[tri]
+
+            # Sort triangles of each node along the longest extent of its centroids
+            seg_starts = np.cumsum(split_counts) - split_counts
+            extent = np.maximum.reduceat(c, seg_starts) - np.minimum.reduceat(c, seg_starts)
+            axis = extent.argmax(axis=1)
+            key = c[np.arange(len(c)), axis[seg]]
+            order[pos] = tri[np.lexsort((key, seg))]
+
+            half = split_counts // 2
+            left = num_nodes + 2 * np.arange(len(split_nodes))
+            parents.append(split_nodes)
+            lefts.append(left)
+            num_nodes += 2 * len(split_nodes)
+
+            level = np.stack((left, left + 1), axis=1).ravel()
+            starts = np.stack((split_starts, split_starts + half), axis=1).ravel()
+            counts = np.stack((half, split_counts - half), axis=1).ravel()
+            all_starts.append(starts)
+            all_counts.append(counts)
+
+        self.tri_order = order
+        self.node_start = np.concatenate(all_starts)
+        self.node_count = np.concatenate(all_counts)
+        self.node_left = np.full(num_nodes, -1, dtype=np.int64)
+        for nodes, left in zip(parents, lefts):
+            self.node_left[nodes] = left
+
+        # Leaf bounds in one segmented reduction (leaves partition tri_order), then inner bounds bottom up
+        tri_min = tri_co.min(axis=1)[order]
+        tri_max = tri_co.max(axis=1)[order]
+        self.node_bb_min = np.empty((num_nodes, 3))
+        self.node_bb_max = np.empty((num_nodes, 3))
+        leaves = np.flatnonzero(self.node_left < 0)
+        leaves = leaves[np.argsort(self.node_start[leaves], kind="stable")]
+        self.node_bb_min[leaves] = np.minimum.reduceat(tri_min, self.node_start[leaves])
+        self.node_bb_max[leaves] = np.maximum.reduceat(tri_max, self.node_start[leaves])
+        for nodes, left in zip(reversed(parents), reversed(lefts)):
+            self.node_bb_min[nodes] = np.minimum(self.node_bb_min[left], self.node_bb_min[left + 1])
+            self.node_bb_max[nodes] = np.maximum(self.node_bb_max[left], self.node_bb_max[left + 1])
+
+    def __len__(self):
+        return len(self.node_left)
+
+    def _leaf_pairs(self, query: np.ndarray, nodes: np.ndarray):
+        """Expand (query, leaf node) pairs into (query, triangle) pairs"""
+        counts = self.node_count[nodes]
+        seg, pos = _segments(self.node_start[nodes], counts)
+        return query[seg], self.tri_order[pos]
+
+    def _greedy_leaves(self, queries: np.ndarray, node_distance):
+        """Leaf reached by each query when always descending into the nearer child"""
+        node = np.zeros(len(queries), dtype=np.int64)
+        inner = np.flatnonzero(self.node_left[node] >= 0)
+        while len(inner):
+            query, left = queries[inner], self.node_left[node[inner]]
+            node[inner] = left + (node_distance(query, left + 1) < node_distance(query, left))
+            inner = inner[self.node_left[node[inner]] >= 0]
+        return node
+
+    def _traverse(self, queries: np.ndarray, best: np.ndarray, node_distance, test_leaves):
+        """Breadth first traversal of (query, node) pairs, nodes farther than the best distance of their query
+        are skipped, best is seeded from the leaf of a greedy descent so pruning starts at the root"""
+        test_leaves(queries, self._greedy_leaves(queries, node_distance))
+        pair_query = queries
+        pair_node = np.zeros(len(queries), dtype=np.int64)
+        while len(pair_query):
+            distance = node_distance(pair_query, pair_node)
+            keep = np.isfinite(distance) & (distance <= best[pair_query])
+            pair_query, pair_node = pair_query[keep], pair_node[keep]
+
+            leaf = self.node_left[pair_node] < 0
+            if leaf.any():
+                # Nearest leaf of each query first, it usually tightens best enough to skip the others
+                leaf_query, leaf_node, leaf_distance = pair_query[leaf], pair_node[leaf], distance[keep][leaf]
+                order = np.lexsort((leaf_distance, leaf_query))
+                first = np.r_[True, leaf_query[order][1:] != leaf_query[order][:-1]]
+                test_leaves(leaf_query[order[first]], leaf_node[order[first]])
+                rest = order[~first]
+                rest = rest[leaf_distance[rest] <= best[leaf_query[rest]]]
+                test_leaves(leaf_query[rest], leaf_node[rest])
+
+            inner_query, inner_node = pair_query[~leaf], pair_node[~leaf]
+            pair_query = np.repeat(inner_query, 2)
+            pair_node = (self.node_left[inner_node][:, np.newaxis] + (0, 1)).ravel()
+
+    @staticmethod
+    def _update_minimum(best: np.ndarray, query: np.ndarray, value: np.ndarray):
+        """Lower best[query] to value, returns the mask of pairs that set a new minimum, NaN values are ignored"""
+        previous = best[query]
+        np.fmin.at(best, query, value)
+        return (value < previous) & (value == best[query])
+
+    def ray_cast(self, origins: np.ndarray, directions: np.ndarray, max_distance: float = np.inf, chunk_size=8192):
+        """Nearest hit of every ray (like BVHTree.ray_cast) for a chunk of rays at a time"""
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        directions = directions / np.linalg.norm(directions, axis=1)[:, np.newaxis]
+        num_rays = len(origins)
+        best = np.full(num_rays, float(max_distance))
+        best_tri = np.full(num_rays, -1, dtype=np.int64)
+
+        def node_distance(ray, node):
+            hit, t_near, _ = rays_aabb_intersect(
+                origins[ray], directions[ray], self.node_bb_min[node], self.node_bb_max[node]
+            )
+            return np.where(hit, t_near, np.inf)
+
+        def test_leaves(ray, node):
+            tri_ray, tri = self._leaf_pairs(ray, node)
+            t = rays_triangles_intersect(
+                origins[tri_ray], directions[tri_ray], self.tri_v0[tri], self.tri_e1[tri], self.tri_e2[tri]
+            )
+            better = self._update_minimum(best, tri_ray, t)
+            best_tri[tri_ray[better]] = tri[better]
+
+        with span("triangle_bvh.ray_cast"):
+            for chunk_start in range(0, num_rays, chunk_size):
+                rays = np.arange(chunk_start, min(chunk_start + chunk_size, num_rays))
+                self._traverse(rays, best, node_distance, test_leaves)
+
+        hits = RayHitArrays(num_rays)
+        is_hit = best_tri >= 0
+        tri = best_tri[is_hit]
+        hits.is_hit = is_hit
+        hits.location[is_hit] = origins[is_hit] + directions[is_hit] * best[is_hit][:, np.newaxis]
+        hits.normal[is_hit] = self.tri_normals[tri]
+        hits.polygon_index[is_hit] = self.tri_polygons[tri]
+        hits.object_index[is_hit] = 0
+        hits.distance[is_hit] = best[is_hit]
+        return hits
+
+    def find_nearest(self, points: np.ndarray, max_distance: float = np.inf, chunk_size=8192):
+        """Nearest surface point to every point (like BVHTree.find_nearest),
+        is_hit is False for points without any triangle within max_distance"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        num_points = len(points)
+        # Squared distances
+        best = np.full(num_points, float(max_distance) ** 2)
+        best_tri = np.full(num_points, -1, dtype=np.int64)
+        best_co = np.zeros((num_points, 3))
+
+        def node_distance(point, node):
+            p = points[point]
+            outside = np.maximum(np.maximum(self.node_bb_min[node] - p, p - self.node_bb_max[node]), 0)
+            return (outside**2).sum(axis=1)
+
+        def test_leaves(point, node):
+            tri_point, tri = self._leaf_pairs(point, node)
+            v0 = self.tri_v0[tri]
+            co = closest_points_on_triangles(points[tri_point], v0, v0 + self.tri_e1[tri], v0 + self.tri_e2[tri])
+            better = self._update_minimum(best, tri_point, ((co - points[tri_point]) ** 2).sum(axis=1))
+            best_tri[tri_point[better]] = tri[better]
+            best_co[tri_point[better]] = co[better]
+
+        with span("triangle_bvh.find_nearest"):
+            for chunk_start in range(0, num_points, chunk_size):
+                chunk = np.arange(chunk_start, min(chunk_start + chunk_size, num_points))
+                self._traverse(chunk, best, node_distance, test_leaves)
+
+        hits = RayHitArrays(num_points)
+        is_hit = best_tri >= 0
+        tri = best_tri[is_hit]
+        hits.is_hit = is_hit
+        hits.location[is_hit] = best_co[is_hit]
+        hits.normal[is_hit] = self.tri_normals[tri]
+        hits.polygon_index[is_hit] = self.tri_polygons[tri]
+        hits.object_index[is_hit] = 0
+        hits.distance[is_hit] = np.sqrt(best[is_hit])
+        return hits
+
+
+def check_triangle_bvh(num_tris: int = 2000, num_queries: int = 500, seed: int = 0):
+    """Compare TriangleBVH.ray_cast and find_nearest with brute force over all triangles of a random soup,
+    three quarters of the triangles are degenerate (collapsed edges, collinear or coincident vertices),
+    whose distances are checked against their edges as segments, raises AssertionError on a mismatch"""
+    rng = np.random.default_rng(seed)
+    verts_co = rng.uniform(-1, 1, size=(num_tris, 3))[:, np.newaxis] + rng.normal(scale=0.1, size=(num_tris, 3, 3))
+    kind = rng.integers(4, size=num_tris)
+    verts_co[kind == 1, 1] = verts_co[kind == 1, 0]
+    collinear = kind == 2
+    verts_co[collinear, 2] = verts_co[collinear, 0] + 2 * (verts_co[collinear, 1] - verts_co[collinear, 0])
+    verts_co[kind == 3] = verts_co[kind == 3, :1]
+    verts_co = verts_co.reshape(-1, 3)
+    tris = np.arange(3 * num_tris).reshape(-1, 3)
+    bvh = TriangleBVH(verts_co, tris)
+
+    points = rng.uniform(-1.5, 1.5, size=(num_queries, 3))
+    nearest = bvh.find_nearest(points)
+    v = verts_co[tris][np.newaxis]
+    p = points[:, np.newaxis]
+    a, b, c = (np.broadcast_to(v[:, :, i], (num_queries, num_tris, 3)).reshape(-1, 3) for i in range(3))
+    co = closest_points_on_triangles(np.repeat(points, num_tris, axis=0), a, b, c)
+    sq_distance = ((co - np.repeat(points, num_tris, axis=0)) ** 2).sum(axis=1).reshape(num_queries, num_tris)
+    assert np.isfinite(sq_distance).all()
+    edges_sq_distance = np.min(
+        [((closest_points_on_segments(p, v[:, :, i], v[:, :, i - 1]) - p) ** 2).sum(axis=2) for i in range(3)], axis=0
+    )
+    degenerate = kind > 0
+    assert np.allclose(sq_distance[:, degenerate], edges_sq_distance[:, degenerate], atol=1e-12)
+    assert (sq_distance <= edges_sq_distance + 1e-12).all()
+    assert nearest.is_hit.all() and np.isfinite(nearest.location).all()
+    assert np.allclose(nearest.distance, np.sqrt(sq_distance.min(axis=1)), atol=1e-9)
+
+    directions = rng.normal(size=(num_queries, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    ray_hits = bvh.ray_cast(points, directions)
+    t = rays_triangles_intersect(
+        np.repeat(points, num_tris, axis=0), np.repeat(directions, num_tris, axis=0), a, b - a, c - a
+    ).reshape(num_queries, num_tris)
+    ref_distance = np.fmin.reduce(t, axis=1)
+    ref_hit = np.isfinite(ref_distance)
+    assert (ray_hits.is_hit == ref_hit).all()
+    assert np.allclose(ray_hits.distance[ref_hit], ref_distance[ref_hit], atol=1e-9)
+    print(f"TriangleBVH matches brute force: {num_tris} triangles ({degenerate.sum()} degenerate), {num_queries} queries")
+
+
+def benchmark_triangle_bvh(num_tris: int = 20000, num_queries: int = 20000, seed: int = 0):
+    """Compare TriangleBVH with mathutils.bvhtree.BVHTree (when available) on a noisy UV sphere,
+    rays start outside and aim inside the sphere, nearest queries use the ray origins"""
+    rng = np.random.default_rng(seed)
+    rings = max(2, int(np.sqrt(num_tris / 4)))
+    segments = 2 * rings
+    theta, phi = np.meshgrid(np.linspace(0, np.pi, rings + 1), np.linspace(0, 2 * np.pi, segments, endpoint=False))
+    radius = 1 + rng.uniform(-0.02, 0.02, size=theta.shape)
+    verts_co = np.stack(
+        (radius * np.sin(theta) * np.cos(phi), radius * np.sin(theta) * np.sin(phi), radius * np.cos(theta)), axis=-1
+    ).reshape(-1, 3)
+    # Grid index is segment * (rings + 1) + ring, every quad is split into two triangles
+    ring, segment = np.meshgrid(np.arange(rings), np.arange(segments))
+    v00 = (segment * (rings + 1) + ring).ravel()
+    v10 = ((segment + 1) % segments * (rings + 1) + ring).ravel()
+    tris = np.concatenate((np.stack((v00, v10, v10 + 1), axis=1), np.stack((v00, v10 + 1, v00 + 1), axis=1)))
+    num_tris = len(tris)
+
+    origins = rng.normal(size=(num_queries, 3))
+    origins *= 3 / np.linalg.norm(origins, axis=1)[:, np.newaxis]
+    directions = rng.uniform(-1, 1, size=(num_queries, 3)) - origins
+
+    t0 = timer()
+    bvh = TriangleBVH(verts_co, tris)
+    t1 = timer()
+    ray_hits = bvh.ray_cast(origins, directions)
+    t2 = timer()
+    nearest = bvh.find_nearest(origins)
+    t3 = timer()
+    bvh_times = (t1 - t0, t2 - t1, t3 - t2)
+    print(
+        f"TriangleBVH {num_tris} triangles, {num_queries} queries: build {t1 - t0:.4f} sec, "
+        f"ray_cast {t2 - t1:.4f} sec ({ray_hits.is_hit.sum()} hits), find_nearest {t3 - t2:.4f} sec"
+    )
+
+    try:
+        from mathutils.bvhtree import BVHTree
+    except ImportError:
+        print("mathutils not available, skipping BVHTree comparison")
+        return
+
+    t0 = timer()
+    tree = BVHTree.FromPolygons(verts_co.tolist(), tris.tolist(), all_triangles=True)
+    t1 = timer()
+    ref_ray = [tree.ray_cast(o, d) for o, d in zip(origins.tolist(), directions.tolist())]
+    t2 = timer()
+    ref_nearest = [tree.find_nearest(p) for p in origins.tolist()]
+    t3 = timer()
+    print(f"BVHTree: build {t1 - t0:.4f} sec, ray_cast {t2 - t1:.4f} sec, find_nearest {t3 - t2:.4f} sec")
+    for name, bvh_time, ref_time in zip(("build", "ray_cast", "find_nearest"), bvh_times, (t1 - t0, t2 - t1, t3 - t2)):
+        print(f"{name} speedup: {ref_time / bvh_time:.2f}x")
+
+    ref_hit = np.array([hit[0] is not None for hit in ref_ray])
+    ref_distance = np.array([hit[3] if hit[0] is not None else np.inf for hit in ref_ray])
+    both = ref_hit & ray_hits.is_hit
+    print(
+        f"ray hits agree: {np.count_nonzero(ref_hit == ray_hits.is_hit)}/{num_queries}, "
+        f"max distance difference {np.abs(ref_distance[both] - ray_hits.distance[both]).max(initial=0):.2e}, "
+        f"max nearest distance difference "
+        f"{np.abs(np.array([hit[3] for hit in ref_nearest]) - nearest.distance).max(initial=0):.2e}"
+    )